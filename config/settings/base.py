@@ -274,6 +274,25 @@ CELERY_TASK_TIME_LIMIT = 5 * 60
 CELERY_TASK_SOFT_TIME_LIMIT = 60
 # http://docs.celeryproject.org/en/latest/userguide/configuration.html#beat-scheduler
 CELERY_BEAT_SCHEDULER = "django_celery_beat.schedulers:DatabaseScheduler"
+# Entries here are synced into django_celery_beat's tables when beat starts.
+CELERY_BEAT_SCHEDULE = {
+    "ingest-result-submissions": {
+        "task": "experiments.tasks.ingest_result_submissions",
+        "schedule": 60.0,
+    },
+    "prune-deployments": {
+        "task": "experiments.tasks.prune_deployments",
+        "schedule": env.float("DEPLOYMENT_PRUNE_INTERVAL", default=24 * 60 * 60),
+    },
+    "fetch-repo-origins": {
+        "task": "experiments.tasks.fetch_repo_origins",
+        "schedule": env.float("REPO_FETCH_INTERVAL", default=15 * 60),
+    },
+    "sync-mturk-hits": {
+        "task": "mturk.tasks.sync_mturk_hits",
+        "schedule": env.float("MTURK_SYNC_INTERVAL", default=5 * 60),
+    },
+}
 # django-allauth
 # ------------------------------------------------------------------------------
 ACCOUNT_ALLOW_REGISTRATION = env.bool("DJANGO_ACCOUNT_ALLOW_REGISTRATION", True)
@@ -310,6 +329,21 @@ CORS_URLS_REGEX = r"^/api/.*$"
 ADD_REVERSION_ADMIN = True
 REPO_DIR = str(ROOT_DIR / "deployment_assets" / "repos")
 DEPLOYMENT_DIR = str(ROOT_DIR / "deployment_assets" / "workdirs")
+# worktree, archive or blobstore, see experiments.utils.deploy
+DEPLOYMENT_BACKEND = env("DEPLOYMENT_BACKEND", default="archive")
+# must be on the same filesystem as DEPLOYMENT_DIR for files to be hardlinked
+DEPLOYMENT_BLOB_DIR = str(ROOT_DIR / "deployment_assets" / "blobs")
+# prune_deployments keeps deployments with results this recent and previews
+# used this recently, then evicts previews until under DEPLOYMENT_MAX_BYTES (0 for no cap)
+DEPLOYMENT_RESULT_GRACE_DAYS = env.int("DEPLOYMENT_RESULT_GRACE_DAYS", default=30)
+DEPLOYMENT_PREVIEW_TTL_DAYS = env.int("DEPLOYMENT_PREVIEW_TTL_DAYS", default=7)
+DEPLOYMENT_MAX_BYTES = env.int("DEPLOYMENT_MAX_BYTES", default=0)
+# A failed deployment is retried by serving at most DEPLOYMENT_MAX_ATTEMPTS
+# times, DEPLOYMENT_RETRY_DELAY seconds apart. Publishing resets the count.
+# Rows left deploying longer than DEPLOYMENT_STALE_AFTER seconds are requeued.
+DEPLOYMENT_MAX_ATTEMPTS = env.int("DEPLOYMENT_MAX_ATTEMPTS", default=3)
+DEPLOYMENT_RETRY_DELAY = env.int("DEPLOYMENT_RETRY_DELAY", default=60)
+DEPLOYMENT_STALE_AFTER = env.int("DEPLOYMENT_STALE_AFTER", default=10 * 60)
 NON_REPO_FILES_DIR = str(ROOT_DIR / "deployment_assets" / "non_repo_files")
 
 # These values are determined by the nginx.conf location directives
@@ -322,3 +356,37 @@ LOGIN_REDIRECT_URL="/"
 
 BASE_URL = env("BASE_URL", default="http://0.0.0.0:8000")
 
+# Rendered experiment contexts are cached per (experiment_repo_id, commit) in an
+# in-process LRU in front of the default cache.
+EXPERIMENT_CONTEXT_CACHE_SIZE = env.int("EXPERIMENT_CONTEXT_CACHE_SIZE", default=512)
+EXPERIMENT_CONTEXT_LOCAL_TTL = env.int("EXPERIMENT_CONTEXT_LOCAL_TTL", default=300)
+
+# Number of Result rows fetched per round trip when streaming exports.
+RESULT_EXPORT_CHUNK_SIZE = env.int("RESULT_EXPORT_CHUNK_SIZE", default=100)
+
+# "sync" saves results inside the participant's POST, "async" stages the raw
+# body and lets experiments.tasks.ingest_result_submissions create the Results.
+RESULT_INGESTION_MODE = env("RESULT_INGESTION_MODE", default="sync")
+RESULT_INGESTION_BATCH_SIZE = env.int("RESULT_INGESTION_BATCH_SIZE", default=200)
+
+# batch_assignment_create runs as a celery task above this many subjects.
+BATCH_ASSIGNMENT_ASYNC_THRESHOLD = env.int("BATCH_ASSIGNMENT_ASYNC_THRESHOLD", default=500)
+# AssignSubject runs as a celery task above this many subject/battery pairs.
+ASSIGN_SUBJECTS_ASYNC_THRESHOLD = env.int("ASSIGN_SUBJECTS_ASYNC_THRESHOLD", default=2000)
+
+# Open git.Repo handles kept per process, and commits remembered as valid.
+GIT_REPO_POOL_SIZE = env.int("GIT_REPO_POOL_SIZE", default=32)
+GIT_VALID_COMMIT_CACHE_SIZE = env.int("GIT_VALID_COMMIT_CACHE_SIZE", default=4096)
+# Blobs larger than this are left out of clones and fetches until needed.
+GIT_BLOB_SIZE_LIMIT = env("GIT_BLOB_SIZE_LIMIT", default="1m")
+
+# Concurrent mturk api calls per BotoWrapper operation, and how many times a
+# throttled call is retried with backoff before giving up.
+MTURK_MAX_WORKERS = env.int("MTURK_MAX_WORKERS", default=8)
+MTURK_MAX_RETRIES = env.int("MTURK_MAX_RETRIES", default=5)
+# Connections each shared mturk client keeps open, at least MTURK_MAX_WORKERS.
+MTURK_MAX_POOL_CONNECTIONS = env.int(
+    "MTURK_MAX_POOL_CONNECTIONS", default=max(10, MTURK_MAX_WORKERS * 2)
+)
+# Upper bound on mturk api calls per second from one BotoWrapper, 0 for none.
+MTURK_REQUESTS_PER_SECOND = env.float("MTURK_REQUESTS_PER_SECOND", default=10)
@@ -204,7 +204,7 @@ class BatteryForm(ModelForm):
 
     class Meta:
         model = models.Battery
-        fields = ["title", "consent", "instructions", "advertisement", "status"]
+        fields = ["title", "consent", "instructions", "advertisement", "status", "order_scheme"]
         widgets = {
             "title": forms.TextInput(),
             "consent": TinyMCE(attrs={'cols': 80, 'rows': 12}),
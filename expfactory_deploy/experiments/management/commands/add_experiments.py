@@ -1,8 +1,12 @@
 from pathlib import Path
 
 from django.core.management.base import BaseCommand, CommandError
-from experiments.models import ExperimentRepo
-from experiments.utils.repo import find_new_experiments
+from experiments.utils.repo import (
+    find_repos,
+    last_scanned_commits,
+    record_scans,
+    scan_repos,
+)
 
 
 class Command(BaseCommand):
@@ -12,8 +16,33 @@ class Command(BaseCommand):
         parser.add_argument(
             "repo_locations", nargs="+", type=lambda p: Path(p).absolute()
         )
+        parser.add_argument(
+            "--jobs", "-j", type=int, default=1,
+            help="number of processes used to scan repositories in parallel"
+        )
 
     def handle(self, *args, **options):
-        for repo_location in options["repo_locations"]:
-            find_new_experiments(repo_location)
-        self.stdout.write(self.style.SUCCESS("finished searching for experiments"))
+        if options["jobs"] < 1:
+            raise CommandError("--jobs must be at least 1")
+        repo_dirs = [
+            repo_dir
+            for repo_location in options["repo_locations"]
+            for repo_dir in find_repos(repo_location)
+        ]
+        scans = []
+        for scan, elapsed in scan_repos(repo_dirs, last_scanned_commits(), options["jobs"]):
+            mode = "incremental" if scan.incremental else "full"
+            self.stdout.write(
+                f"{scan.path}: {len(scan.valid)} valid, {len(scan.errors)} errors "
+                f"({mode} scan, {elapsed:.2f}s)"
+            )
+            scans.append(scan)
+        created_repos, created_experiments, deactivated, errors = record_scans(scans)
+        for experiment in deactivated:
+            self.stdout.write(f"{experiment.location} no longer exists, marked inactive")
+        for error in errors:
+            self.stderr.write(error)
+        self.stdout.write(self.style.SUCCESS(
+            f"finished searching for experiments, {len(created_repos)} new repositories "
+            f"and {len(created_experiments)} new experiments"
+        ))
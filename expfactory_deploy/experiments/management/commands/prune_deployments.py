@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from experiments.utils.deploy import prune_deployments
+
+
+class Command(BaseCommand):
+    help = "Remove deployed experiment files no battery, recent result or preview needs"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--max-bytes", type=int, default=None, help="override DEPLOYMENT_MAX_BYTES")
+        parser.add_argument("--dry-run", action="store_true", help="report what would be removed")
+
+    def handle(self, *args, **options):
+        report = prune_deployments(max_bytes=options["max_bytes"], dry_run=options["dry_run"])
+        verb = "would remove" if options["dry_run"] else "removed"
+        self.stdout.write(self.style.SUCCESS(
+            f"{verb} {report['deployments']} deployments, {report['directories']} directories "
+            f"and {report['blobs']} blobs, {report['bytes'] / 2**20:.1f} MiB reclaimed"
+        ))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from experiments.models import Assignment, AssignmentProgress
+
+
+class Command(BaseCommand):
+    help = "Rebuild AssignmentProgress rows from Result rows"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--battery", type=int, nargs="*", help="only rebuild assignments for these battery ids")
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        assignments = Assignment.objects.order_by("id")
+        if options["battery"]:
+            assignments = assignments.filter(battery__in=options["battery"])
+        ids = list(assignments.values_list("id", flat=True))
+        batch_size = options["batch_size"]
+        for start in range(0, len(ids), batch_size):
+            with transaction.atomic():
+                AssignmentProgress.rebuild(ids[start:start + batch_size])
+        self.stdout.write(self.style.SUCCESS(f"rebuilt progress for {len(ids)} assignments"))
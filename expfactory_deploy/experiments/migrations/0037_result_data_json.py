@@ -0,0 +1,44 @@
+import ast
+import json
+
+from django.db import migrations
+
+BATCH_SIZE = 500
+
+
+def repr_to_json(apps, schema_editor):
+    """
+    Results used to be saved from a python dict, so data holds its repr
+    instead of json. Convert those rows once so exports can copy data as is.
+    """
+    Result = apps.get_model("experiments", "Result")
+    batch = []
+    for result in Result.objects.only("id", "data").iterator(chunk_size=BATCH_SIZE):
+        if not result.data:
+            continue
+        try:
+            json.loads(result.data)
+            continue
+        except ValueError:
+            pass
+        try:
+            result.data = json.dumps(ast.literal_eval(result.data))
+        except (ValueError, SyntaxError, RecursionError, MemoryError):
+            continue
+        batch.append(result)
+        if len(batch) >= BATCH_SIZE:
+            Result.objects.bulk_update(batch, ["data"])
+            batch = []
+    if batch:
+        Result.objects.bulk_update(batch, ["data"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("experiments", "0036_assignmentprogress"),
+    ]
+
+    operations = [
+        migrations.RunPython(repr_to_json, migrations.RunPython.noop),
+    ]
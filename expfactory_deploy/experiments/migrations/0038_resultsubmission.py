@@ -0,0 +1,79 @@
+# Generated by Django 4.1.3 on 2026-10-18 17:51
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import model_utils.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("experiments", "0037_result_data_json"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ResultSubmission",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "created",
+                    model_utils.fields.AutoCreatedField(
+                        default=django.utils.timezone.now,
+                        editable=False,
+                        verbose_name="created",
+                    ),
+                ),
+                (
+                    "modified",
+                    model_utils.fields.AutoLastModifiedField(
+                        default=django.utils.timezone.now,
+                        editable=False,
+                        verbose_name="modified",
+                    ),
+                ),
+                (
+                    "status",
+                    model_utils.fields.StatusField(
+                        choices=[
+                            ("pending", "pending"),
+                            ("processed", "processed"),
+                            ("failed", "failed"),
+                        ],
+                        default="pending",
+                        max_length=100,
+                        no_check_for_status=True,
+                    ),
+                ),
+                ("idempotency_key", models.TextField(unique=True)),
+                ("assignment_id", models.IntegerField()),
+                ("experiment_id", models.IntegerField()),
+                ("body", models.TextField()),
+                ("error", models.TextField(blank=True)),
+                (
+                    "result",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        to="experiments.result",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="resultsubmission",
+            index=models.Index(
+                fields=["status", "id"], name="experiments_status_6c2356_idx"
+            ),
+        ),
+    ]
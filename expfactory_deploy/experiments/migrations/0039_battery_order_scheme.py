@@ -0,0 +1,27 @@
+# Generated by Django 4.1.3 on 2026-10-18 17:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("experiments", "0038_resultsubmission"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="battery",
+            name="order_scheme",
+            field=models.CharField(
+                choices=[
+                    ("uniform", "Uniform shuffle"),
+                    ("latin_square", "Balanced latin square"),
+                    ("counterbalanced", "Counterbalanced"),
+                ],
+                default="uniform",
+                help_text="How experiment orders are generated when random_order is set",
+                max_length=32,
+            ),
+        ),
+    ]
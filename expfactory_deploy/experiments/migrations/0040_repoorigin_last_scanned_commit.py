@@ -0,0 +1,18 @@
+# Generated by Django 4.1.3 on 2026-10-18 17:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("experiments", "0039_battery_order_scheme"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="repoorigin",
+            name="last_scanned_commit",
+            field=models.TextField(blank=True),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 4.1.3 on 2026-10-18 17:58
+
+from django.db import migrations, models
+import model_utils.fields
+
+
+def mark_existing_ready(apps, schema_editor):
+    # origins created before this migration were cloned during the request
+    RepoOrigin = apps.get_model("experiments", "RepoOrigin")
+    RepoOrigin.objects.update(status="ready")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("experiments", "0040_repoorigin_last_scanned_commit"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="repoorigin",
+            name="error",
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name="repoorigin",
+            name="last_fetched",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="repoorigin",
+            name="status",
+            field=model_utils.fields.StatusField(
+                choices=[
+                    ("queued", "queued"),
+                    ("cloning", "cloning"),
+                    ("ready", "ready"),
+                    ("failed", "failed"),
+                ],
+                default="queued",
+                max_length=100,
+                no_check_for_status=True,
+            ),
+        ),
+        migrations.RunPython(mark_existing_ready, migrations.RunPython.noop),
+    ]
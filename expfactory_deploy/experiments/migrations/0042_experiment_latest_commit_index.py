@@ -0,0 +1,23 @@
+# Generated by Django 4.1.3 on 2026-10-18 18:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("experiments", "0041_repoorigin_status"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="experimentrepo",
+            name="latest_commit",
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name="repoorigin",
+            name="indexed_commit",
+            field=models.TextField(blank=True),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.1.3 on 2026-10-18 18:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("experiments", "0042_experiment_latest_commit_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="deployment",
+            name="duration",
+            field=models.DurationField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="deployment",
+            name="size",
+            field=models.BigIntegerField(
+                blank=True, help_text="bytes on disk", null=True
+            ),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.3 on 2026-10-18 18:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("experiments", "0043_deployment_duration_size"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="deployment",
+            name="last_used",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
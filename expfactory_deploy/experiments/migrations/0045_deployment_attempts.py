@@ -0,0 +1,18 @@
+# Generated by Django 4.1.3 on 2026-10-18 18:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("experiments", "0044_deployment_last_used"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="deployment",
+            name="attempts",
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -1,24 +1,25 @@
 import datetime
 import os
-import random
 import uuid
 from collections import defaultdict
 from pathlib import Path
 
-import git
 import reversion
 from django.conf import settings
-from django.db import models
-from django.db.models import Q
+from django.db import models, transaction
+from django.db.models import Case, Count, Exists, F, Max, OuterRef, Q, Value, When, Window
 from django.dispatch import receiver
 from django.urls import reverse
+from django.utils import timezone
 from giturlparse import parse
 from model_utils import Choices
 from model_utils.fields import MonitorField, StatusField
 from model_utils.models import StatusModel, TimeStampedModel
 from taggit.managers import TaggableManager
 
+from .utils import deploy as deploy
 from .utils import repo as repo
+from .utils.ordering import generate_orders
 from users.models import Group
 
 @reversion.register()
@@ -53,12 +54,21 @@ class SubjectTaskStatusModel(StatusModel):
 
 
 class RepoOrigin(models.Model):
-    """ Location of a repository that contains an experiment """
+    """ Location of a repository that contains an experiment. Cloning and
+    fetching happen in celery tasks, status tracks where the clone is at.
+    """
 
+    STATUS = Choices("queued", "cloning", "ready", "failed")
+    status = StatusField(default="queued")
     url = models.TextField(unique=True)
     path = models.TextField(unique=True)
     name = models.TextField(blank=True, unique=True)
     active = models.BooleanField(default=True)
+    last_scanned_commit = models.TextField(blank=True)
+    # commit the ExperimentRepo.latest_commit index was last brought up to
+    indexed_commit = models.TextField(blank=True)
+    last_fetched = models.DateTimeField(blank=True, null=True)
+    error = models.TextField(blank=True)
 
     def __str__(self):
         return self.url
@@ -73,7 +83,7 @@ class RepoOrigin(models.Model):
         return repo.is_valid_commit(self.path, commit)
 
     def checkout_commit(self, commit):
-        base_repo = git.Repo(self.path)
+        base_repo = repo.open_repo(self.path)
         stem = Path(self.path).stem
         deploy_to = str(Path(settings.DEPLOYMENT_DIR, stem, commit))
         if deploy_to in base_repo.git.worktree("list"):
@@ -85,22 +95,128 @@ class RepoOrigin(models.Model):
             return deploy_to
 
     def pull_origin(self):
-        repo.pull_origin(self.path)
-        self.update_dependents()
+        """ Fetch from the remote and fast forward the checkout. Only the
+        fast forward and update_dependents hold the repo lock that deployments
+        also take, the network part doesn't block them. """
+        repo.fetch_origin(self.path)
+        with repo.repo_lock(self.path):
+            repo.fast_forward(self.path)
+            with transaction.atomic():
+                report = self.update_dependents()
+        self.last_fetched = timezone.now()
+        self.error = ""
+        self.save(update_fields=["last_fetched", "error"])
+        return report
+
+    def update_latest_commits(self):
+        """ Bring ExperimentRepo.latest_commit up to date for this origin with
+        one git log walk. Only commits since indexed_commit are read unless an
+        experiment has no latest_commit yet or history was rewritten. Returns
+        the origin's experiment repos. """
+        head = self.get_latest_commit()
+        exp_repos = list(ExperimentRepo.objects.filter(origin=self.id))
+        unindexed = any(not exp_repo.latest_commit for exp_repo in exp_repos)
+        if head == self.indexed_commit and not unindexed:
+            return exp_repos
+        since = None
+        if self.indexed_commit and not unindexed and repo.is_ancestor(
+            repo.open_repo(self.path), self.indexed_commit, head
+        ):
+            since = self.indexed_commit
+
+        def relative(location):
+            rel = os.path.relpath(location, self.path)
+            return "" if rel == "." else rel.replace(os.sep, "/")
+
+        found = repo.last_commits_by_dir(
+            self.path, {relative(exp_repo.location) for exp_repo in exp_repos}, since
+        )
+        changed = []
+        for exp_repo in exp_repos:
+            latest = found.get(relative(exp_repo.location))
+            if latest is None and since is None:
+                # no history for the directory, fall back to the whole repository
+                latest = head
+            if latest and latest != exp_repo.latest_commit:
+                exp_repo.latest_commit = latest
+                changed.append(exp_repo)
+        ExperimentRepo.objects.bulk_update(changed, ['latest_commit'])
+        self.indexed_commit = head
+        RepoOrigin.objects.filter(id=self.id).update(indexed_commit=head)
+        return exp_repos
+
+    def latest_commits(self):
+        """ {experiment_repo_id: latest commit} for this origin's experiments. """
+        return {
+            exp_repo.id: exp_repo.latest_commit
+            for exp_repo in self.update_latest_commits()
+        }
 
     def update_dependents(self):
-        latest = self.get_latest_commit()
-        instances = ExperimentInstance.objects.filter(experiment_repo_id__origin=self.id).exclude(commit=latest)
-        # we will want to filter battexps on use_latest in production
-        battexps = BatteryExperiments.objects.filter(experiment_instance__id__in=instances.values_list('id', flat=True))
-        for battexp in battexps:
-            new_instance, _ = ExperimentInstance.objects.get_or_create(experiment_repo_id=battexp.experiment_instance.experiment_repo_id, commit=latest)
-            battexp.experiment_instance = new_instance
-            battexp.save()
+        """ Move use_latest BatteryExperiments of draft and template batteries
+        onto the latest commit of their experiment. Missing ExperimentInstances
+        are bulk created and every eligible row is repointed with one UPDATE,
+        published batteries are never touched. Returns a report of what moved:
+        {"created_instances": [instance ids],
+         "updated": [(battery_experiment_id, battery_id, experiment_repo_id, old_commit, new_commit)]}
+        """
+        report = {"created_instances": [], "updated": []}
+        latest = self.latest_commits()
+        eligible = BatteryExperiments.objects.filter(
+            use_latest=True,
+            battery__status__in=[Battery.STATUS.draft, Battery.STATUS.template],
+            experiment_instance__experiment_repo_id__in=latest.keys(),
+        ).values_list(
+            'id', 'battery_id', 'experiment_instance__experiment_repo_id', 'experiment_instance__commit'
+        )
+        stale = [row for row in eligible if row[3] != latest[row[2]]]
+        if not stale:
+            return report
+
+        exp_repo_ids = {row[2] for row in stale}
+        instances = {}
+        for instance_id, exp_repo_id, commit in ExperimentInstance.objects.filter(
+            experiment_repo_id__in=exp_repo_ids, commit__in={latest[i] for i in exp_repo_ids}
+        ).order_by('-id').values_list('id', 'experiment_repo_id', 'commit'):
+            if commit == latest[exp_repo_id]:
+                instances[exp_repo_id] = instance_id
+        missing = [
+            ExperimentInstance(experiment_repo_id_id=exp_repo_id, commit=latest[exp_repo_id])
+            for exp_repo_id in exp_repo_ids if exp_repo_id not in instances
+        ]
+        if missing:
+            ExperimentInstance.objects.bulk_create(missing)
+            # not every backend returns primary keys from bulk_create
+            for instance_id, exp_repo_id in ExperimentInstance.objects.filter(
+                experiment_repo_id__in=[instance.experiment_repo_id_id for instance in missing],
+                commit__in={instance.commit for instance in missing},
+            ).order_by('-id').values_list('id', 'experiment_repo_id'):
+                if exp_repo_id not in instances:
+                    instances[exp_repo_id] = instance_id
+                    report["created_instances"].append(instance_id)
+
+        by_repo = defaultdict(list)
+        for batt_exp_id, battery_id, exp_repo_id, commit in stale:
+            by_repo[exp_repo_id].append(batt_exp_id)
+            report["updated"].append((batt_exp_id, battery_id, exp_repo_id, commit, latest[exp_repo_id]))
+        BatteryExperiments.objects.filter(id__in=[row[0] for row in stale]).update(
+            experiment_instance=Case(
+                *[
+                    When(id__in=batt_exp_ids, then=Value(instances[exp_repo_id]))
+                    for exp_repo_id, batt_exp_ids in by_repo.items()
+                ],
+                default=F('experiment_instance'),
+                output_field=models.IntegerField(),
+            )
+        )
+        return report
 
     def clone(self):
-        os.makedirs(self.path, exist_ok=True)
-        repo = git.Repo.clone_from(self.url, self.path)
+        repo.clone(self.url, self.path)
+        self.status = self.STATUS.ready
+        self.last_fetched = timezone.now()
+        self.error = ""
+        self.save(update_fields=["status", "last_fetched", "error"])
 
     @property
     def display_url(self):
@@ -128,17 +244,22 @@ class ExperimentRepo(models.Model):
     framework = models.ForeignKey(Framework, null=True, on_delete=models.SET_NULL)
     active = models.BooleanField(default=True)
     cogat_id = models.TextField(blank=True)
+    # last commit that touched location, kept up to date by
+    # RepoOrigin.update_latest_commits
+    latest_commit = models.TextField(blank=True)
     tags = TaggableManager()
 
     def get_absolute_url(self):
         return reverse("experiments:experiment-repo-detail", kwargs={"pk": self.pk})
 
-    """ We may want to just look at latest commit for files in its directory(location)
-        instead of getting entire repos latest commit, case where exp removed from repo
-        at some point. """
-
     def get_latest_commit(self):
-        return self.origin.get_latest_commit()
+        """ Last commit that touched this experiment's directory, rather than
+        the repository's HEAD, so commits to other experiments don't create
+        new instances of this one. """
+        if not self.latest_commit:
+            self.origin.update_latest_commits()
+            self.refresh_from_db(fields=['latest_commit'])
+        return self.latest_commit
 
     @property
     def url(self):
@@ -175,12 +296,100 @@ class ExperimentInstance(models.Model):
         return self.experiment_repo_id.origin.is_valid_commit(self.commit)
 
     def deploy_static(self):
-        return self.experiment_repo_id.origin.checkout_commit(self.commit)
+        """ Path to this instance's files on disk, or None if they have not
+        been materialized yet. See tasks.deploy_experiment_instances. """
+        return (
+            Deployment.objects.filter(experiment_instance=self, status=Deployment.STATUS.ready)
+            .values_list("path", flat=True)
+            .first()
+        )
+
+    def materialize(self):
+        return deploy.materialize(self)
 
     def __str__(self):
         return f"{self.commit}"
 
 
+class Deployment(TimeStampedModel):
+    """ Files for an ExperimentInstance checked out on disk for nginx to serve.
+    Rows are queued when a battery is published or previewed and filled in by
+    a celery task so no git calls happen while serving participants.
+    """
+
+    STATUS = Choices("queued", "deploying", "ready", "failed")
+    status = StatusField(default="queued")
+    experiment_instance = models.OneToOneField(
+        ExperimentInstance, on_delete=models.CASCADE, related_name="deployment"
+    )
+    path = models.TextField(blank=True)
+    error = models.TextField(blank=True)
+    duration = models.DurationField(blank=True, null=True)
+    size = models.BigIntegerField(blank=True, null=True, help_text="bytes on disk")
+    # set when previewed, prune_deployments evicts least recently used previews first
+    last_used = models.DateTimeField(blank=True, null=True)
+
+    attempts = models.IntegerField(default=0)
+
+    @property
+    def gave_up(self):
+        return (
+            self.status == self.STATUS.failed
+            and self.attempts >= settings.DEPLOYMENT_MAX_ATTEMPTS
+        )
+
+    @classmethod
+    def queue(cls, instance_ids, retry=False):
+        """ Make sure a deployment exists for each instance id and return the
+        ids a deploy task should be sent for: rows created here, failed rows
+        queued again and rows stuck in deploying by a worker that died.
+        Failed rows are retried at most DEPLOYMENT_MAX_ATTEMPTS times, no
+        sooner than DEPLOYMENT_RETRY_DELAY seconds apart, unless retry is set
+        (publishing a battery) which starts the count over.
+        """
+        instance_ids = set(instance_ids)
+        now = timezone.now()
+        existing = set(
+            cls.objects.filter(experiment_instance_id__in=instance_ids).values_list(
+                "experiment_instance_id", flat=True
+            )
+        )
+        created = instance_ids - existing
+        cls.objects.bulk_create(
+            [cls(experiment_instance_id=instance_id) for instance_id in created],
+            ignore_conflicts=True,
+        )
+
+        failed = cls.objects.filter(
+            experiment_instance_id__in=existing, status=cls.STATUS.failed
+        )
+        if retry:
+            failed.update(attempts=0)
+        else:
+            failed = failed.filter(
+                attempts__lt=settings.DEPLOYMENT_MAX_ATTEMPTS,
+                modified__lt=now - datetime.timedelta(seconds=settings.DEPLOYMENT_RETRY_DELAY),
+            )
+        stuck = Q(status=cls.STATUS.deploying) & Q(
+            modified__lt=now - datetime.timedelta(seconds=settings.DEPLOYMENT_STALE_AFTER)
+        )
+        requeue = set(failed.values_list("id", flat=True)) | set(
+            cls.objects.filter(stuck, experiment_instance_id__in=existing).values_list(
+                "id", flat=True
+            )
+        )
+        # each row only moves back to queued once, so only one caller sends its task
+        requeued = []
+        for deployment_id in requeue:
+            if cls.objects.filter(
+                Q(status=cls.STATUS.failed) | stuck, id=deployment_id
+            ).update(status=cls.STATUS.queued, modified=now):
+                requeued.append(deployment_id)
+        return list(created) + list(
+            cls.objects.filter(id__in=requeued).values_list("experiment_instance_id", flat=True)
+        )
+
+
 @reversion.register()
 class Battery(TimeStampedModel, StatusField):
     """when a battery is "created" its a template.
@@ -203,6 +412,15 @@ class Battery(TimeStampedModel, StatusField):
     instructions = models.TextField(blank=True)
     advertisement = models.TextField(blank=True)
     random_order = models.BooleanField(default=True)
+    ORDER_SCHEME = Choices(
+        ("uniform", "Uniform shuffle"),
+        ("latin_square", "Balanced latin square"),
+        ("counterbalanced", "Counterbalanced"),
+    )
+    order_scheme = models.CharField(
+        max_length=32, choices=ORDER_SCHEME, default=ORDER_SCHEME.uniform,
+        help_text="How experiment orders are generated when random_order is set"
+    )
     public = models.BooleanField(default=False)
     inter_task_break = models.DurationField(default=datetime.timedelta())
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
@@ -272,9 +490,30 @@ class Result(TimeStampedModel, SubjectTaskStatusModel):
     )
     # in case we want to collect results without an assignment
     subject = models.ForeignKey(Subject, on_delete=models.CASCADE, null=True)
+    # json text of the body posted by the experiment
     data = models.TextField(blank=True)
 
 
+class ResultSubmission(TimeStampedModel):
+    """ Raw body posted by an experiment when results are ingested
+    asynchronously. tasks.ingest_result_submissions validates these and turns
+    them into Result rows in batches. idempotency_key keeps client retries from
+    creating duplicate results.
+    """
+    STATUS = Choices("pending", "processed", "failed")
+    status = StatusField(default="pending")
+    idempotency_key = models.TextField(unique=True)
+    # ids as posted, they are only looked up when the submission is ingested
+    assignment_id = models.IntegerField()
+    experiment_id = models.IntegerField()
+    body = models.TextField()
+    error = models.TextField(blank=True)
+    result = models.ForeignKey(Result, on_delete=models.SET_NULL, blank=True, null=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "id"])]
+
+
 class Assignment(SubjectTaskStatusModel):
     """ Associate a subject with a battery deployment that they should complete """
     subject = models.ForeignKey(Subject, on_delete=models.CASCADE)
@@ -292,45 +531,90 @@ class Assignment(SubjectTaskStatusModel):
     ''' does not account for redos '''
     @property
     def result_status(self):
-        results = self.results
+        progress = self.get_progress()
         status = defaultdict(lambda: 0)
-        status['total'] = len(results)
-        for result in results:
-            status[result.status] += 1
+        status['total'] = progress.total
+        status[Result.STATUS.completed] = progress.completed
+        status[Result.STATUS.failed] = progress.failed
         return status
 
+    def get_progress(self):
+        progress = (
+            AssignmentProgress.objects.filter(assignment=self.id)
+            .select_related("current__experiment_instance")
+            .first()
+        )
+        if progress is None:
+            AssignmentProgress.rebuild([self.id])
+            progress = AssignmentProgress.objects.get(assignment=self.id)
+        return progress
+
     def save(self, *args, **kwargs):
-        if self.pk == None and self.battery.random_order:
-            self.ordering = ExperimentOrder.objects.create(battery=self.battery)
-            self.ordering.generate_order_items()
+        if self.pk == None and self.battery.random_order and self.ordering_id is None:
+            self.ordering = ExperimentOrder.bulk_generate(self.battery, 1)[0]
         super().save(*args, **kwargs)
 
     def get_next_experiment(self):
-        if self.ordering == None:
+        """ Returns the next experiment instance the subject has not finished
+        for this battery and how many are left, in a constant number of queries.
+        Experiments with a staged ResultSubmission waiting to be ingested count
+        as finished.
+        """
+        finished = Result.objects.filter(
+            subject=self.subject_id,
+            battery_experiment__battery=self.battery_id,
+            status__in=[Result.STATUS.completed, Result.STATUS.failed],
+        )
+        staged = ResultSubmission.objects.filter(
+            assignment_id=self.id, status=ResultSubmission.STATUS.pending
+        )
+        if self.ordering_id is None:
             order = "?" if self.battery.random_order else "order"
             batt_exps = (
-                BatteryExperiments.objects.filter(battery=self.battery)
+                BatteryExperiments.objects.filter(battery=self.battery_id)
+                .filter(~Exists(finished.filter(
+                    battery_experiment__experiment_instance=OuterRef("experiment_instance")
+                )))
+                .filter(~Exists(staged.filter(experiment_id=OuterRef("experiment_instance"))))
                 .select_related("experiment_instance")
                 .order_by(order)
             )
         else:
-            batt_exps = self.ordering.experimentorderitem_set.all().order_by("order")
-        experiments = [x.experiment_instance for x in batt_exps]
-        exempt = list(
-            Result.objects.filter(
-                Q(status=Result.STATUS.completed) | Q(status=Result.STATUS.failed),
-                subject=self.subject,
-            ).values_list('battery_experiment__experiment_instance', flat=True)
-        )
-        unfinished = [exp for exp in experiments if exp.id not in exempt]
-        if len(unfinished):
+            batt_exps = (
+                ExperimentOrderItem.objects.filter(experiment_order=self.ordering_id)
+                .filter(~Exists(finished.filter(
+                    battery_experiment__experiment_instance=OuterRef("battery_experiment__experiment_instance")
+                )))
+                .filter(~Exists(staged.filter(
+                    experiment_id=OuterRef("battery_experiment__experiment_instance")
+                )))
+                .select_related("battery_experiment__experiment_instance")
+                .order_by("order")
+            )
+        # the window count is computed after filtering, so one row gives us both
+        # the next experiment and the number remaining.
+        next_exp = batt_exps.annotate(
+            remaining=Window(expression=Count("id")), any_staged=Exists(staged)
+        ).first()
+
+        if next_exp is not None:
             if self.status == "not-started":
                 self.status = "started"
                 self.save()
-            return unfinished[0], len(unfinished)
+            remaining = next_exp.remaining
+            any_staged = next_exp.any_staged
+            if self.ordering_id is not None:
+                next_exp = next_exp.battery_experiment
+            # ingesting a staged submission decrements remaining again, leave
+            # it to be recomputed once the submission is a Result
+            AssignmentProgress.set_next(
+                self, next_exp, None if any_staged else remaining
+            )
+            return next_exp.experiment_instance, remaining
         else:
             self.status = "completed"
             self.save()
+            AssignmentProgress.set_next(self, None, 0)
             return None, 0
 
     class Meta:
@@ -340,6 +624,148 @@ class Assignment(SubjectTaskStatusModel):
             )
         ]
 
+class AssignmentProgress(models.Model):
+    """ Denormalized result counts for an assignment so serving and status pages
+    don't have to scan Result rows. Updated by Results.post and
+    get_next_experiment, rebuilt with the rebuild_assignment_progress command.
+    remaining and current are None when they need to be recomputed.
+    """
+    assignment = models.OneToOneField(Assignment, on_delete=models.CASCADE, related_name="progress")
+    completed = models.IntegerField(default=0)
+    failed = models.IntegerField(default=0)
+    remaining = models.IntegerField(blank=True, null=True)
+    current = models.ForeignKey(
+        BatteryExperiments, on_delete=models.SET_NULL, blank=True, null=True, related_name="+"
+    )
+    last_activity = models.DateTimeField(blank=True, null=True)
+
+    @property
+    def total(self):
+        return self.completed + self.failed
+
+    @classmethod
+    def set_next(cls, assignment, battery_experiment, remaining):
+        updated = cls.objects.filter(assignment=assignment.id).update(
+            current=battery_experiment, remaining=remaining
+        )
+        if not updated:
+            cls.rebuild([assignment.id])
+            cls.objects.filter(assignment=assignment.id).update(
+                current=battery_experiment, remaining=remaining
+            )
+
+    @classmethod
+    def record_result(cls, result):
+        """ Count a newly saved result. Call inside the transaction that saved it. """
+        cls.record_results([result])
+
+    @classmethod
+    def record_results(cls, results):
+        """ Count newly saved results, one update per assignment. remaining only
+        drops for experiments with no earlier finished result, so a repeated
+        "finished" post is not counted twice. Call inside the transaction that
+        saved the results.
+        """
+        counts = defaultdict(lambda: {"completed": 0, "failed": 0})
+        new_results = defaultdict(lambda: defaultdict(int))
+        for result in results:
+            if result.assignment_id is None:
+                continue
+            counter = "failed" if result.status == Result.STATUS.failed else "completed"
+            counts[result.assignment_id][counter] += 1
+            new_results[result.assignment_id][result.battery_experiment_id] += 1
+        if not counts:
+            return
+        missing = []
+        now = timezone.now()
+        with transaction.atomic():
+            # concurrent posts for an assignment wait here, then see each other's results
+            list(cls.objects.select_for_update().filter(assignment__in=counts).order_by("assignment"))
+            finished_counts = {
+                (assignment_id, batt_exp_id): count
+                for assignment_id, batt_exp_id, count in Result.objects.filter(
+                    assignment__in=counts,
+                    status__in=[Result.STATUS.completed, Result.STATUS.failed],
+                )
+                .values_list("assignment", "battery_experiment")
+                .annotate(count=Count("id"))
+            }
+            for assignment_id, count in counts.items():
+                finished = sum(
+                    1
+                    for batt_exp_id, new in new_results[assignment_id].items()
+                    if finished_counts.get((assignment_id, batt_exp_id), 0) <= new
+                )
+                updated = cls.objects.filter(assignment=assignment_id).update(
+                    completed=F("completed") + count["completed"],
+                    failed=F("failed") + count["failed"],
+                    remaining=Case(
+                        When(remaining__gt=finished, then=F("remaining") - finished),
+                        When(remaining__isnull=False, then=0),
+                        default=None,
+                    ),
+                    current=None,
+                    last_activity=now,
+                )
+                if not updated:
+                    missing.append(assignment_id)
+            if missing:
+                cls.rebuild(missing)
+
+    @classmethod
+    def rebuild(cls, assignment_ids):
+        """ Recompute progress from Result rows for the given assignments.
+        The assignment rows are locked so concurrent rebuilds run one after
+        the other instead of colliding on the one to one.
+        """
+        with transaction.atomic():
+            assignments = list(
+                Assignment.objects.select_for_update()
+                .filter(id__in=assignment_ids)
+                .order_by("id")
+                .values_list("id", "battery")
+            )
+            cls._rebuild(assignments)
+
+    @classmethod
+    def _rebuild(cls, assignments):
+        assignment_ids = [assignment_id for assignment_id, _ in assignments]
+        finished = [Result.STATUS.completed, Result.STATUS.failed]
+        counts = {
+            row["assignment"]: row
+            for row in Result.objects.filter(assignment__in=assignment_ids)
+            .values("assignment")
+            .annotate(
+                completed=Count("id", filter=Q(status=Result.STATUS.completed)),
+                failed=Count("id", filter=Q(status=Result.STATUS.failed)),
+                finished_experiments=Count(
+                    "battery_experiment", filter=Q(status__in=finished), distinct=True
+                ),
+                last_activity=Max("modified"),
+            )
+        }
+        experiment_counts = dict(
+            BatteryExperiments.objects.filter(battery__assignment__id__in=assignment_ids)
+            .values("battery")
+            .annotate(count=Count("id", distinct=True))
+            .values_list("battery", "count")
+        )
+        progress = []
+        for assignment_id, battery_id in assignments:
+            row = counts.get(assignment_id, {})
+            remaining = experiment_counts.get(battery_id, 0) - row.get("finished_experiments", 0)
+            progress.append(cls(
+                assignment_id=assignment_id,
+                completed=row.get("completed", 0),
+                failed=row.get("failed", 0),
+                remaining=max(remaining, 0),
+                current=None,
+                last_activity=row.get("last_activity"),
+            ))
+        cls.objects.filter(assignment__in=assignment_ids).delete()
+        cls.objects.bulk_create(progress)
+
+
 class ExperimentOrderItem(models.Model):
     battery_experiment = models.ForeignKey(
         BatteryExperiments, on_delete=models.CASCADE
@@ -361,11 +787,36 @@ class ExperimentOrder(models.Model):
     battery = models.ForeignKey(Battery, on_delete=models.CASCADE)
     auto_generated = models.BooleanField(default=True)
 
-    def generate_order_items(self):
-        experiments = list(BatteryExperiments.objects.filter(battery=self.battery).values_list('id', flat=True))
-        random.shuffle(experiments)
-        order_items = []
-        for index, exp in enumerate(experiments):
-            order_items.append(ExperimentOrderItem(battery_experiment_id=exp, experiment_order=self, order=index))
-        ExperimentOrderItems.bulk_create(order_items)
+    @classmethod
+    def bulk_generate(cls, battery, count):
+        """ Create count orders for battery using its order_scheme. The
+        battery's experiments and the number of orders it already has are
+        each read once, then orders and their items are written with one
+        bulk insert each.
+
+        Schemes that continue a cycle count the orders already handed out to
+        assignments, so orders whose assignment was dropped don't skip rows.
+        The battery row is locked until the caller's transaction commits, so
+        concurrent batches see each other's assignments and don't start from
+        the same offset.
+        """
+        with transaction.atomic():
+            experiments = list(
+                BatteryExperiments.objects.filter(battery=battery)
+                .order_by('order', 'id').values_list('id', flat=True)
+            )
+            offset = 0
+            if battery.order_scheme != Battery.ORDER_SCHEME.uniform:
+                Battery.objects.select_for_update().filter(id=battery.id).first()
+                offset = Assignment.objects.filter(
+                    battery=battery, ordering__auto_generated=True
+                ).count()
+            permutations = generate_orders(battery.order_scheme, experiments, count, offset)
+            orders = cls.objects.bulk_create([cls(battery=battery) for i in range(count)])
+            ExperimentOrderItem.objects.bulk_create([
+                ExperimentOrderItem(battery_experiment_id=exp, experiment_order=order, order=index)
+                for order, permutation in zip(orders, permutations)
+                for index, exp in enumerate(permutation)
+            ])
+        return orders
 
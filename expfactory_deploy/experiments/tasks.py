@@ -0,0 +1,231 @@
+import json
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from config import celery_app
+from experiments import models as models
+from experiments.utils import deploy as deploy_utils
+from experiments.utils.repo import repo_lock
+from experiments.utils.assignments import assign_subjects, batch_assignments
+
+
+@celery_app.task()
+def deploy_experiment_instances(instance_ids):
+    """Materialize the files for experiment instances queued with
+    Deployment.queue."""
+    deployments = models.Deployment.objects.filter(
+        experiment_instance__in=instance_ids
+    ).exclude(status=models.Deployment.STATUS.ready)
+    return {
+        deployment.experiment_instance_id: deploy(deployment.id)
+        for deployment in deployments
+    }
+
+
+def deploy(deployment_id):
+    """Check out the worktree for a single deployment and record the result.
+    Returns the deployment's status afterwards.
+    """
+    Deployment = models.Deployment
+    # Claim the row so concurrent tasks don't both run the checkout. modified
+    # is when the claim was made, Deployment.queue reclaims rows left in
+    # deploying for longer than DEPLOYMENT_STALE_AFTER.
+    claimed = Deployment.objects.filter(
+        id=deployment_id, status=Deployment.STATUS.queued
+    ).update(
+        status=Deployment.STATUS.deploying,
+        attempts=F("attempts") + 1,
+        modified=timezone.now(),
+    )
+    deployment = Deployment.objects.select_related(
+        "experiment_instance__experiment_repo_id__origin"
+    ).get(id=deployment_id)
+    if not claimed:
+        return deployment.status
+
+    instance = deployment.experiment_instance
+    start = time.perf_counter()
+    try:
+        # git worktree commands on a single repository must not overlap.
+        with repo_lock(instance.experiment_repo_id.origin.path):
+            path = instance.materialize()
+    except Exception as e:
+        path = False
+        deployment.error = str(e)
+
+    if path:
+        deployment.status = Deployment.STATUS.ready
+        deployment.path = path
+        deployment.error = ""
+        deployment.duration = timedelta(seconds=time.perf_counter() - start)
+        deployment.size = deploy_utils.deployed_size(instance, path)
+        deployment.last_used = timezone.now()
+        try:
+            deploy_utils.cache_jspsych_context(instance, path)
+        except Exception as e:
+            # the files are in place, views.jspsych_context tries again
+            deployment.error = f"Could not build the jspsych context: {e}"
+    else:
+        deployment.status = Deployment.STATUS.failed
+        if not deployment.error:
+            deployment.error = f"Commit {instance.commit} is not valid for {instance.experiment_repo_id.origin.url}"
+    deployment.save()
+    return deployment.status
+
+
+@celery_app.task()
+def ingest_result_submissions(batch_size=None):
+    """Turn pending ResultSubmissions into Result rows, batch_size at a time.
+    Rows are locked with skip_locked so several workers can drain the table.
+    """
+    batch_size = batch_size or settings.RESULT_INGESTION_BATCH_SIZE
+    ingested = 0
+    while True:
+        with transaction.atomic():
+            submissions = list(
+                models.ResultSubmission.objects.select_for_update(skip_locked=True)
+                .filter(status=models.ResultSubmission.STATUS.pending)
+                .order_by("id")[:batch_size]
+            )
+            if not submissions:
+                return ingested
+            ingest(submissions)
+            ingested += len(submissions)
+
+
+def ingest(submissions):
+    Submission = models.ResultSubmission
+    assignments = models.Assignment.objects.in_bulk(
+        {submission.assignment_id for submission in submissions}
+    )
+    battery_ids = {assignment.battery_id for assignment in assignments.values()}
+    batt_exps = {
+        (battery_id, instance_id): batt_exp_id
+        for batt_exp_id, battery_id, instance_id in models.BatteryExperiments.objects.filter(
+            battery__in=battery_ids,
+            experiment_instance__in={submission.experiment_id for submission in submissions},
+        ).values_list("id", "battery", "experiment_instance")
+    }
+
+    results = []
+    started = set()
+    for submission in submissions:
+        assignment = assignments.get(submission.assignment_id)
+        batt_exp_id = None
+        if assignment is not None:
+            batt_exp_id = batt_exps.get((assignment.battery_id, submission.experiment_id))
+        if batt_exp_id is None:
+            submission.status = Submission.STATUS.failed
+            submission.error = "No matching assignment and battery experiment"
+            continue
+        try:
+            data = json.loads(submission.body)
+        except ValueError as e:
+            submission.status = Submission.STATUS.failed
+            submission.error = f"Invalid json: {e}"
+            continue
+
+        submission.status = Submission.STATUS.processed
+        if assignment.status == "not-started":
+            started.add(assignment.id)
+        if isinstance(data, dict) and data.get("status") == "finished":
+            submission.result = models.Result(
+                assignment=assignment,
+                battery_experiment_id=batt_exp_id,
+                subject_id=assignment.subject_id,
+                data=submission.body,
+                status="completed",
+            )
+            results.append(submission.result)
+
+    models.Result.objects.bulk_create(results)
+    models.AssignmentProgress.record_results(results)
+    if started:
+        models.Assignment.objects.filter(id__in=started, status="not-started").update(
+            status="started", started_at=timezone.now()
+        )
+    Submission.objects.bulk_update(submissions, ["status", "error", "result"])
+
+
+@celery_app.task()
+def generate_batch_assignments(battery_id, num_subjects, file_name):
+    """Large batch_assignment_create requests run here and write the urls to
+    file_name in default storage. Returns the name the file was saved under,
+    views.batch_assignment_download serves it from there."""
+    battery = models.Battery.objects.get(id=battery_id)
+    urls = batch_assignments(battery, num_subjects)
+    return default_storage.save(file_name, ContentFile("\n".join(urls) + "\n"))
+
+
+@celery_app.task(bind=True)
+def bulk_assign_subjects(self, subject_ids, battery_ids):
+    """Background version of AssignSubject for large selections. Progress is
+    reported through the task state so assign_subjects_status can poll it."""
+    def on_progress(done, total, created):
+        self.update_state(
+            state="PROGRESS",
+            meta={"batteries_done": done, "batteries_total": total, "created": created},
+        )
+    return {"created": assign_subjects(subject_ids, battery_ids, on_progress)}
+
+
+@celery_app.task(soft_time_limit=30 * 60, time_limit=31 * 60)
+def clone_repo_origin(origin_id):
+    """Clone a newly added RepoOrigin. The row is claimed by moving it from
+    queued to cloning so the clone only runs once."""
+    RepoOrigin = models.RepoOrigin
+    claimed = RepoOrigin.objects.filter(
+        id=origin_id, status__in=[RepoOrigin.STATUS.queued, RepoOrigin.STATUS.failed]
+    ).update(status=RepoOrigin.STATUS.cloning)
+    origin = RepoOrigin.objects.get(id=origin_id)
+    if not claimed:
+        return origin.status
+    try:
+        origin.clone()
+    except Exception as e:
+        origin.status = RepoOrigin.STATUS.failed
+        origin.error = str(e)
+        origin.save(update_fields=["status", "error"])
+    return origin.status
+
+
+@celery_app.task(soft_time_limit=10 * 60, time_limit=11 * 60)
+def fetch_repo_origin(origin_id):
+    """Fetch a cloned RepoOrigin and move use_latest experiments forward,
+    returning how many instances were created and battery experiments moved.
+    A failed fetch leaves the clone usable, so only the error is recorded."""
+    origin = models.RepoOrigin.objects.get(id=origin_id)
+    if origin.status != models.RepoOrigin.STATUS.ready:
+        return False
+    try:
+        report = origin.pull_origin()
+    except Exception as e:
+        models.RepoOrigin.objects.filter(id=origin_id).update(error=str(e))
+        return False
+    return {
+        "created_instances": len(report["created_instances"]),
+        "updated": len(report["updated"]),
+    }
+
+
+@celery_app.task()
+def fetch_repo_origins():
+    """Periodic entry point, queues a fetch for every active cloned origin."""
+    origin_ids = models.RepoOrigin.objects.filter(
+        active=True, status=models.RepoOrigin.STATUS.ready
+    ).values_list("id", flat=True)
+    for origin_id in origin_ids:
+        fetch_repo_origin.delay(origin_id)
+    return len(origin_ids)
+
+
+@celery_app.task()
+def prune_deployments():
+    return deploy_utils.prune_deployments()
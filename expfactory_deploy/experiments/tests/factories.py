@@ -0,0 +1,20 @@
+from django.contrib.auth import get_user_model
+
+from experiments import models
+
+
+def make_battery(num_experiments, random_order=False):
+    user, _ = get_user_model().objects.get_or_create(username="battery_owner")
+    origin, _ = models.RepoOrigin.objects.get_or_create(
+        url="https://github.com/expfactory/experiments.git", path="/tmp/experiments", name="experiments"
+    )
+    battery = models.Battery.objects.create(
+        title=f"battery_{num_experiments}", status="draft", random_order=random_order, user=user
+    )
+    for i in range(num_experiments):
+        repo = models.ExperimentRepo.objects.create(
+            name=f"task_{i}", origin=origin, location=f"/tmp/experiments/task_{i}"
+        )
+        instance = models.ExperimentInstance.objects.create(experiment_repo_id=repo, commit="abc123")
+        models.BatteryExperiments.objects.create(battery=battery, experiment_instance=instance, order=i)
+    return battery
@@ -0,0 +1,51 @@
+from django.test import TestCase
+
+from experiments import models
+from experiments.tests.factories import make_battery
+from experiments.utils.cache import LRUCache, TieredCache
+
+
+class LRUCacheTests(TestCase):
+    def test_evicts_least_recently_used(self):
+        evicted = []
+        lru = LRUCache(maxsize=2, on_evict=lambda k, v: evicted.append(k))
+        lru.set("a", 1)
+        lru.set("b", 2)
+        lru.get("a")
+        lru.set("c", 3)
+        self.assertEqual(evicted, ["b"])
+        self.assertIn("a", lru)
+        self.assertNotIn("b", lru)
+
+    def test_ttl_expiry(self):
+        lru = LRUCache(maxsize=2, ttl=-1)
+        lru.set("a", 1)
+        self.assertIsNone(lru.get("a"))
+
+
+class TieredCacheTests(TestCase):
+    def test_falls_back_to_shared_cache(self):
+        first = TieredCache("test_tiered")
+        second = TieredCache("test_tiered")
+        first.set({"exp_id": "stroop"}, 1, "abc123")
+        self.assertEqual(second.get(1, "abc123"), {"exp_id": "stroop"})
+        first.delete(1, "abc123")
+        self.assertIsNone(first.get(1, "abc123"))
+
+
+class JspsychContextTests(TestCase):
+    def test_cached_context_is_not_served_once_deployment_is_gone(self):
+        # views builds forms from the database when imported
+        from experiments import views
+
+        battery = make_battery(1)
+        instance = battery.batteryexperiments_set.get().experiment_instance
+        deployment = models.Deployment.objects.create(
+            experiment_instance=instance, status="ready", path="/tmp/deployed/abc123"
+        )
+        views.jspsych_context_cache.set(
+            {"exp_id": "task_0"}, instance.experiment_repo_id_id, instance.commit, deployment.path
+        )
+        self.assertEqual(views.jspsych_context(instance), {"exp_id": "task_0"})
+        deployment.delete()
+        self.assertIsNone(views.jspsych_context(instance))
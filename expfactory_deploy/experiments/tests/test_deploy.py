@@ -0,0 +1,214 @@
+import json
+import os
+import tempfile
+from datetime import timedelta
+from unittest import mock
+
+import git
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from experiments import models, tasks
+from experiments.tests.factories import make_battery
+from experiments.utils import deploy
+
+
+class DeployFixture:
+    backend = None
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+        settings = override_settings(
+            DEPLOYMENT_BACKEND=self.backend,
+            DEPLOYMENT_DIR=os.path.join(self.tmp, "workdirs"),
+            DEPLOYMENT_BLOB_DIR=os.path.join(self.tmp, "blobs"),
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.repo = git.Repo.init(os.path.join(self.tmp, "experiments"))
+        self.origin = models.RepoOrigin.objects.create(
+            url="https://example.com/local_experiments.git", path=self.repo.working_tree_dir, name="local_experiments"
+        )
+        self.exp_repo = models.ExperimentRepo.objects.create(
+            name="stroop", origin=self.origin, location=os.path.join(self.repo.working_tree_dir, "stroop")
+        )
+
+    def commit(self, files):
+        for rel_path, content in files.items():
+            path = os.path.join(self.repo.working_tree_dir, rel_path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as fp:
+                fp.write(content)
+            self.repo.index.add([rel_path])
+        commit = self.repo.index.commit("update").hexsha
+        return models.ExperimentInstance.objects.create(experiment_repo_id=self.exp_repo, commit=commit)
+
+
+class SparseDeployTests(DeployFixture):
+    def test_shared_run_paths_deployed(self):
+        instance = self.commit({
+            "stroop/config.json": json.dumps([{"run": ["experiment.js", "../shared/utils.js", "static/x.js"]}]),
+            "stroop/experiment.js": "",
+            "shared/utils.js": "",
+            "flanker/config.json": "[]",
+        })
+        root = instance.materialize()
+        self.assertEqual(sorted(os.listdir(root)), ["shared", "stroop"])
+        self.assertTrue(os.path.exists(os.path.join(root, "shared", "utils.js")))
+        self.assertEqual(sorted(os.listdir(os.path.join(root, "stroop"))), ["config.json", "experiment.js"])
+
+    def test_deploy_records_duration_and_size(self):
+        instance = self.commit({"stroop/config.json": "[]", "stroop/experiment.js": "x" * 100})
+        deployment = models.Deployment.objects.create(experiment_instance=instance)
+        self.assertEqual(tasks.deploy(deployment.id), "ready")
+        deployment.refresh_from_db()
+        self.assertEqual(deployment.size, 102)
+        self.assertIsNotNone(deployment.duration)
+        # "[]" has no experiment in it, the context is left for serving to retry
+        self.assertIn("jspsych context", deployment.error)
+
+    def test_deploy_caches_jspsych_context(self):
+        instance = self.commit({
+            "stroop/config.json": json.dumps([{"template": "jspsych", "run": ["experiment.js"]}]),
+            "stroop/experiment.js": "",
+        })
+        deployment = models.Deployment.objects.create(experiment_instance=instance)
+        tasks.deploy(deployment.id)
+        deployment.refresh_from_db()
+        context = deploy.jspsych_context_cache.get(self.exp_repo.id, instance.commit, deployment.path)
+        self.assertEqual(context["exp_id"], "stroop")
+        deploy.jspsych_context_cache.delete(self.exp_repo.id, instance.commit, deployment.path)
+
+
+class ArchiveDeployTests(SparseDeployTests, TestCase):
+    backend = "archive"
+
+
+class BlobStoreDeployTests(SparseDeployTests, TestCase):
+    backend = "blobstore"
+
+    def test_only_experiment_dir_deployed_and_unchanged_files_shared(self):
+        first = self.commit({
+            "stroop/config.json": "[]", "stroop/lib/experiment.js": "v1", "flanker/config.json": "[]"
+        })
+        second = self.commit({"stroop/config.json": "[{}]"})
+        first_root = first.materialize()
+        second_root = second.materialize()
+        self.assertEqual(first_root, deploy.deployment_dir(self.origin, first.commit))
+        self.assertFalse(os.path.exists(os.path.join(first_root, "flanker")))
+        with open(os.path.join(second_root, "stroop", "config.json")) as fp:
+            self.assertEqual(fp.read(), "[{}]")
+        self.assertEqual(
+            os.stat(os.path.join(first_root, "stroop", "lib", "experiment.js")).st_ino,
+            os.stat(os.path.join(second_root, "stroop", "lib", "experiment.js")).st_ino,
+        )
+        self.assertFalse(models.ExperimentInstance(
+            experiment_repo_id=self.exp_repo, commit="0" * 40
+        ).materialize())
+
+    def test_prune_removes_unreferenced_deployments_and_blobs(self):
+        kept = self.commit({"stroop/config.json": "[]", "stroop/experiment.js": "v1"})
+        dropped = self.commit({"stroop/experiment.js": "v2"})
+        battery = make_battery(0)
+        models.BatteryExperiments.objects.create(battery=battery, experiment_instance=kept)
+        for instance in (kept, dropped):
+            models.Deployment.objects.create(
+                experiment_instance=instance, status="ready", path=instance.materialize(),
+                last_used=timezone.now() - timedelta(days=30),
+            )
+
+        dry_run = deploy.prune_deployments(dry_run=True)
+        # through the celery task, which runs prune_deployments
+        report = tasks.prune_deployments()
+        self.assertEqual(dry_run, report)
+        self.assertEqual((report["deployments"], report["directories"], report["blobs"]), (1, 1, 1))
+        self.assertFalse(os.path.exists(deploy.deployment_dir(self.origin, dropped.commit)))
+        self.assertTrue(os.path.exists(deploy.deployment_dir(self.origin, kept.commit)))
+        self.assertEqual(
+            list(models.Deployment.objects.values_list("experiment_instance", flat=True)), [kept.id]
+        )
+
+    def test_size_cap_only_counts_directories_it_frees(self):
+        now = timezone.now()
+        flanker = models.ExperimentRepo.objects.create(
+            name="flanker", origin=self.origin, location=os.path.join(self.repo.working_tree_dir, "flanker")
+        )
+        shared = self.commit({"stroop/config.json": "[]", "flanker/config.json": "[]"})
+        shared_preview = models.ExperimentInstance.objects.create(
+            experiment_repo_id=flanker, commit=shared.commit
+        )
+        models.BatteryExperiments.objects.create(battery=make_battery(0), experiment_instance=shared)
+        other = self.commit({"stroop/experiment.js": "other"})
+        for instance, hours in ((shared, 0), (shared_preview, 2), (other, 1)):
+            models.Deployment.objects.create(
+                experiment_instance=instance, status="ready", path=instance.materialize(),
+                size=100, last_used=now - timedelta(hours=hours),
+            )
+        # evicting the preview that shares a directory with a pinned
+        # deployment frees nothing, so the other preview goes too
+        report = deploy.prune_deployments(max_bytes=250, dry_run=True)
+        self.assertEqual((report["deployments"], report["directories"]), (2, 1))
+
+    def test_gc_skips_blobs_written_during_prune(self):
+        instance = self.commit({"stroop/config.json": "[]"})
+        blob = self.repo.commit(instance.commit).tree / "stroop/config.json"
+        stored = deploy.store_blob(blob)
+        os.utime(stored, (0, 0))
+        self.assertEqual(deploy.gc_blobs(dry_run=True, before=0)[0], 0)
+        self.assertEqual(deploy.gc_blobs(before=1)[0], 1)
+
+        # a deploy that finds the blob gone after storing it stores it again
+        out = os.path.join(self.tmp, "linked")
+        store_blob = deploy.store_blob
+        gone = iter([stored])
+        with mock.patch.object(
+            deploy, "store_blob", side_effect=lambda blob: next(gone, None) or store_blob(blob)
+        ) as store:
+            deploy.link_blob(blob, out)
+        self.assertEqual(store.call_count, 2)
+        with open(out) as fp:
+            self.assertEqual(fp.read(), "[]")
+
+        # staging removed under the deploy fails after a few tries
+        missing = os.path.join(self.tmp, "staging-gone", "linked")
+        with mock.patch.object(deploy, "store_blob", wraps=store_blob) as store:
+            with self.assertRaises(FileNotFoundError):
+                deploy.link_blob(blob, missing)
+        self.assertEqual(store.call_count, deploy.LINK_ATTEMPTS)
+
+    def test_size_cap_evicts_least_recently_used_previews(self):
+        now = timezone.now()
+        previews = []
+        for i in range(3):
+            instance = self.commit({"stroop/config.json": "[]", "stroop/experiment.js": str(i) * 100})
+            previews.append(models.Deployment.objects.create(
+                experiment_instance=instance, status="ready", path=instance.materialize(),
+                size=100, last_used=now - timedelta(hours=i),
+            ))
+
+        report = deploy.prune_deployments(max_bytes=150, dry_run=True)
+        self.assertEqual(report["deployments"], 2)
+        self.assertEqual(models.Deployment.objects.count(), 3)
+
+        deploy.prune_deployments(max_bytes=150)
+        self.assertEqual(list(models.Deployment.objects.all()), [previews[0]])
+
+
+class WorktreeDeployTests(DeployFixture, TestCase):
+    backend = "worktree"
+
+    def test_prune_removes_worktree(self):
+        instance = self.commit({"stroop/config.json": "[]"})
+        path = instance.materialize()
+        self.assertTrue(os.path.isfile(os.path.join(path, ".git")))
+        models.Deployment.objects.create(
+            experiment_instance=instance, status="ready", path=path,
+            last_used=timezone.now() - timedelta(days=30),
+        )
+        report = deploy.prune_deployments()
+        self.assertEqual(report["directories"], 1)
+        self.assertGreater(report["bytes"], 0)
+        self.assertFalse(os.path.exists(path))
+        self.assertNotIn(path, self.repo.git.worktree("list"))
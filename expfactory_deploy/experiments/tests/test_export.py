@@ -0,0 +1,43 @@
+import json
+
+from django.test import TestCase
+
+from experiments import models
+from experiments.tests.factories import make_battery
+from experiments.utils.export import export_battery
+
+
+class ExportTests(TestCase):
+    def setUp(self):
+        self.battery = make_battery(2)
+        self.subject = models.Subject.objects.create(handle="sub-01")
+        for batt_exp in self.battery.batteryexperiments_set.all():
+            models.Result.objects.create(
+                battery_experiment=batt_exp, subject=self.subject, status="completed", data="{}"
+            )
+
+    def test_json_groups_results_by_task(self):
+        exported = json.loads("".join(export_battery(self.battery.id)))
+        self.assertEqual(sorted(exported.keys()), ["task_0", "task_1"])
+        self.assertEqual(exported["task_0"][0]["subject"], "sub-01")
+
+    def test_ndjson_writes_a_line_per_result(self):
+        lines = "".join(export_battery(self.battery.id, "ndjson")).splitlines()
+        self.assertEqual([json.loads(line)["task"] for line in lines], ["task_0", "task_1"])
+
+    def test_empty_battery(self):
+        self.assertEqual(json.loads("".join(export_battery(-1))), {})
+
+    def test_data_is_copied_into_the_export(self):
+        models.Result.objects.update(data='{"trials": [1, 2]}')
+        exported = json.loads("".join(export_battery(self.battery.id)))
+        self.assertEqual(exported["task_0"][0]["data"], {"trials": [1, 2]})
+
+    def test_unconverted_rows_are_written_as_strings(self):
+        models.Result.objects.update(data="{'trials': [nan, True]}")
+        models.Result.objects.filter(id=models.Result.objects.first().id).update(data='[NaN]')
+        exported = json.loads("".join(export_battery(self.battery.id)))
+        self.assertEqual(
+            sorted(rows[0]["data"] for rows in exported.values()),
+            ["[NaN]", "{'trials': [nan, True]}"],
+        )
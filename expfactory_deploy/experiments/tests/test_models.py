@@ -0,0 +1,273 @@
+import tempfile
+from unittest import mock
+
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from experiments import models
+from experiments.tests.factories import make_battery
+
+
+def complete(assignment, batt_exp):
+    models.Result.objects.create(
+        assignment=assignment, battery_experiment=batt_exp, subject=assignment.subject, status="completed"
+    )
+
+
+class GetNextExperimentTests(TestCase):
+    def make_assignment(self, battery):
+        subject = models.Subject.objects.create()
+        return models.Assignment.objects.create(subject=subject, battery=battery, status="started")
+
+    def count_queries(self, assignment):
+        assignment = models.Assignment.objects.get(id=assignment.id)
+        with CaptureQueriesContext(connection) as queries:
+            assignment.get_next_experiment()
+        return len(queries)
+
+    def test_returns_next_unfinished_in_order(self):
+        battery = make_battery(3)
+        assignment = self.make_assignment(battery)
+        batt_exps = list(battery.batteryexperiments_set.order_by("order"))
+        complete(assignment, batt_exps[0])
+
+        experiment, remaining = assignment.get_next_experiment()
+        self.assertEqual(experiment, batt_exps[1].experiment_instance)
+        self.assertEqual(remaining, 2)
+
+    def test_completed_assignment(self):
+        battery = make_battery(2)
+        assignment = self.make_assignment(battery)
+        for batt_exp in battery.batteryexperiments_set.all():
+            complete(assignment, batt_exp)
+
+        self.assertEqual(assignment.get_next_experiment(), (None, 0))
+        self.assertEqual(assignment.status, "completed")
+
+    def test_results_from_other_batteries_are_ignored(self):
+        battery = make_battery(2)
+        other = make_battery(2)
+        assignment = self.make_assignment(battery)
+        other_assignment = models.Assignment.objects.create(subject=assignment.subject, battery=other)
+        for batt_exp in other.batteryexperiments_set.all():
+            complete(other_assignment, batt_exp)
+
+        _, remaining = assignment.get_next_experiment()
+        self.assertEqual(remaining, 2)
+
+    def test_query_count_is_constant(self):
+        small = make_battery(5)
+        large = make_battery(55)
+        small_assignment = self.make_assignment(small)
+        large_assignment = self.make_assignment(large)
+        for batt_exp in large.batteryexperiments_set.all()[:20]:
+            complete(large_assignment, batt_exp)
+
+        self.assertEqual(self.count_queries(small_assignment), self.count_queries(large_assignment))
+        self.assertEqual(self.count_queries(large_assignment), 3)
+
+    def test_query_count_is_constant_with_ordering(self):
+        counts = []
+        for num_experiments in (5, 55):
+            battery = make_battery(num_experiments)
+            ordering = models.ExperimentOrder.objects.create(battery=battery)
+            models.ExperimentOrderItem.objects.bulk_create([
+                models.ExperimentOrderItem(battery_experiment=batt_exp, experiment_order=ordering, order=i)
+                for i, batt_exp in enumerate(battery.batteryexperiments_set.all())
+            ])
+            assignment = self.make_assignment(battery)
+            assignment.ordering = ordering
+            assignment.save()
+            counts.append(self.count_queries(assignment))
+        self.assertEqual(counts[0], counts[1])
+
+
+class AssignmentProgressTests(TestCase):
+    def test_record_and_rebuild(self):
+        battery = make_battery(3)
+        subject = models.Subject.objects.create()
+        assignment = models.Assignment.objects.create(subject=subject, battery=battery, status="started")
+        experiment, remaining = assignment.get_next_experiment()
+        progress = assignment.get_progress()
+        self.assertEqual((progress.remaining, progress.current.experiment_instance), (3, experiment))
+
+        batt_exp = battery.batteryexperiments_set.get(experiment_instance=experiment)
+        result = models.Result.objects.create(
+            assignment=assignment, battery_experiment=batt_exp, subject=subject, status="completed"
+        )
+        models.AssignmentProgress.record_result(result)
+        progress = assignment.get_progress()
+        self.assertEqual((progress.completed, progress.remaining, progress.current), (1, 2, None))
+
+        models.AssignmentProgress.objects.all().delete()
+        progress = assignment.get_progress()
+        self.assertEqual((progress.completed, progress.failed, progress.remaining), (1, 0, 2))
+        self.assertEqual(assignment.result_status["total"], 1)
+
+    def test_repeated_finished_post_counted_once(self):
+        battery = make_battery(3)
+        subject = models.Subject.objects.create()
+        assignment = models.Assignment.objects.create(subject=subject, battery=battery, status="started")
+        assignment.get_next_experiment()
+        batt_exp = battery.batteryexperiments_set.first()
+        for i in range(2):
+            result = models.Result.objects.create(
+                assignment=assignment, battery_experiment=batt_exp, subject=subject, status="completed"
+            )
+            models.AssignmentProgress.record_result(result)
+        progress = assignment.get_progress()
+        self.assertEqual((progress.completed, progress.remaining), (2, 2))
+
+        models.AssignmentProgress.rebuild([assignment.id])
+        models.AssignmentProgress.rebuild([assignment.id])
+        progress = assignment.get_progress()
+        self.assertEqual((progress.completed, progress.remaining), (2, 2))
+
+
+class BatchAssignmentsTests(TestCase):
+    def test_bulk_creates_subjects_assignments_and_orders(self):
+        from experiments.utils.assignments import batch_assignments
+
+        battery = make_battery(4, random_order=True)
+        urls = batch_assignments(battery, 25)
+        self.assertEqual(len(urls), 25)
+        assignments = models.Assignment.objects.filter(battery=battery)
+        self.assertEqual(assignments.count(), 25)
+        self.assertFalse(assignments.filter(ordering=None).exists())
+        self.assertEqual(models.ExperimentOrderItem.objects.filter(experiment_order__battery=battery).count(), 100)
+        subject_ids = sorted(assignments.values_list("subject_id", flat=True))
+        self.assertTrue(urls[0].endswith(f"/{subject_ids[0]}/{battery.pk}/"), urls[0])
+
+    def test_query_count_independent_of_num_subjects(self):
+        from experiments.utils.assignments import batch_assignments
+
+        battery = make_battery(4, random_order=True)
+        with CaptureQueriesContext(connection) as small:
+            batch_assignments(battery, 2)
+        with CaptureQueriesContext(connection) as large:
+            batch_assignments(battery, 40)
+        self.assertEqual(len(small), len(large))
+
+    def test_async_urls_are_downloaded_through_a_login_protected_view(self):
+        from django.contrib.auth import get_user_model
+        from django.core.files.storage import default_storage
+        from django.urls import reverse
+
+        from experiments import tasks
+
+        battery = make_battery(1)
+        url = reverse("experiments:assignment-download", args=["task-id"])
+        with tempfile.TemporaryDirectory() as media_root, self.settings(MEDIA_ROOT=media_root):
+            name = tasks.generate_batch_assignments(battery.id, 3, "batch_assignments/task-id.txt")
+            self.assertEqual(self.client.get(url).status_code, 302)
+
+            self.client.force_login(get_user_model().objects.create_user("staff"))
+            result = mock.Mock(result=name, **{"failed.return_value": False, "successful.return_value": True})
+            with mock.patch.object(tasks.generate_batch_assignments, "AsyncResult", return_value=result):
+                response = self.client.get(url)
+                self.assertEqual(b"".join(response.streaming_content).decode().count("\n"), 3)
+                response.close()
+            default_storage.delete(name)
+
+
+class ExperimentOrderTests(TestCase):
+    def test_assignment_save_generates_order(self):
+        battery = make_battery(3, random_order=True)
+        subject = models.Subject.objects.create()
+        assignment = models.Assignment.objects.create(subject=subject, battery=battery)
+        self.assertEqual(assignment.ordering.experimentorderitem_set.count(), 3)
+
+    def test_latin_square_continues_across_batches(self):
+        battery = make_battery(4, random_order=True)
+        battery.order_scheme = models.Battery.ORDER_SCHEME.latin_square
+        battery.save()
+        from experiments.utils.assignments import batch_assignments
+
+        batch_assignments(battery, 2)
+        # orders that never reached an assignment don't move the cycle on
+        models.ExperimentOrder.bulk_generate(battery, 1)
+        batch_assignments(battery, 2)
+        firsts = models.ExperimentOrderItem.objects.filter(
+            experiment_order__assignment__battery=battery, order=0
+        ).values_list("battery_experiment_id", flat=True)
+        self.assertEqual(len(set(firsts)), 4)
+
+
+class AssignSubjectsTests(TestCase):
+    def test_skips_existing_and_orders_new(self):
+        from experiments.utils.assignments import assign_subjects
+
+        battery = make_battery(3, random_order=True)
+        subjects = models.Subject.objects.bulk_create([models.Subject() for i in range(5)])
+        models.Assignment.objects.create(subject=subjects[0], battery=battery)
+        created = assign_subjects([sub.id for sub in subjects], [battery.id])
+        self.assertEqual(created, 4)
+        assignments = models.Assignment.objects.filter(battery=battery)
+        self.assertEqual(assignments.count(), 5)
+        self.assertFalse(assignments.filter(ordering=None).exists())
+        self.assertEqual(assign_subjects([sub.id for sub in subjects], [battery.id]), 0)
+
+    def test_rows_dropped_by_a_concurrent_assignment_leave_no_orders(self):
+        from experiments.utils.assignments import assign_subjects
+
+        battery = make_battery(3, random_order=True)
+        subjects = models.Subject.objects.bulk_create([models.Subject() for i in range(3)])
+        bulk_generate = models.ExperimentOrder.bulk_generate
+
+        def arrives_meanwhile(battery, count):
+            # the first subject shows up after the existing pairs were read
+            models.Assignment.objects.bulk_create([models.Assignment(subject=subjects[0], battery=battery)])
+            return bulk_generate(battery, count)
+
+        with mock.patch.object(models.ExperimentOrder, "bulk_generate", side_effect=arrives_meanwhile):
+            created = assign_subjects([sub.id for sub in subjects], [battery.id])
+        self.assertEqual(created, 2)
+        self.assertEqual(models.Assignment.objects.filter(battery=battery).count(), 3)
+        self.assertEqual(
+            models.ExperimentOrder.objects.filter(battery=battery).count(),
+            models.Assignment.objects.filter(battery=battery).exclude(ordering=None).count(),
+        )
+
+    def test_query_count_independent_of_num_subjects(self):
+        from experiments.utils.assignments import assign_subjects
+
+        battery = make_battery(3)
+        few = models.Subject.objects.bulk_create([models.Subject() for i in range(2)])
+        many = models.Subject.objects.bulk_create([models.Subject() for i in range(50)])
+        with CaptureQueriesContext(connection) as small:
+            assign_subjects([sub.id for sub in few], [battery.id])
+        with CaptureQueriesContext(connection) as large:
+            assign_subjects([sub.id for sub in many], [battery.id])
+        self.assertEqual(len(small), len(large))
+
+
+class UpdateDependentsTests(TestCase):
+    def test_moves_only_eligible_battery_experiments(self):
+        draft = make_battery(3)
+        published = make_battery(3)
+        published.status = "published"
+        published.save()
+        pinned = draft.batteryexperiments_set.get(order=2)
+        pinned.use_latest = False
+        pinned.save()
+        origin = models.RepoOrigin.objects.get()
+        exp_repo_ids = models.ExperimentRepo.objects.values_list("id", flat=True)
+
+        with mock.patch.object(
+            models.RepoOrigin, "latest_commits", return_value={i: "def456" for i in exp_repo_ids}
+        ):
+            with CaptureQueriesContext(connection) as queries:
+                report = origin.update_dependents()
+        self.assertLessEqual(len(queries), 5)
+        self.assertEqual(len(report["updated"]), 2)
+        self.assertEqual(len(report["created_instances"]), 2)
+        self.assertEqual(
+            sorted(draft.batteryexperiments_set.values_list("experiment_instance__commit", flat=True)),
+            ["abc123", "def456", "def456"],
+        )
+        self.assertEqual(
+            set(published.batteryexperiments_set.values_list("experiment_instance__commit", flat=True)),
+            {"abc123"},
+        )
+
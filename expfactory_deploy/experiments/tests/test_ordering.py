@@ -0,0 +1,69 @@
+import itertools
+import math
+
+from django.test import SimpleTestCase
+
+from experiments.utils.ordering import (
+    counterbalanced_orders,
+    counterbalanced_permutation,
+    latin_square_orders,
+    nth_permutation,
+    uniform_orders,
+)
+
+
+class OrderingTests(SimpleTestCase):
+    def assert_latin(self, rows, items):
+        for position in range(len(items)):
+            self.assertEqual(sorted(row[position] for row in rows), sorted(items))
+
+    def test_uniform_orders_are_permutations(self):
+        items = list(range(6))
+        for order in uniform_orders(items, 20):
+            self.assertEqual(sorted(order), items)
+
+    def test_latin_square_even(self):
+        items = ["a", "b", "c", "d"]
+        rows = latin_square_orders(items, 4)
+        self.assert_latin(rows, items)
+        pairs = {(row[i], row[i + 1]) for row in rows for i in range(len(items) - 1)}
+        self.assertEqual(len(pairs), len(items) * (len(items) - 1))
+
+    def test_latin_square_odd_uses_2n_rows(self):
+        items = list(range(5))
+        rows = latin_square_orders(items, 10)
+        self.assert_latin(rows[:5], items)
+        pairs = {(row[i], row[i + 1]) for row in rows for i in range(len(items) - 1)}
+        self.assertEqual(len(pairs), len(items) * (len(items) - 1))
+
+    def test_latin_square_offset_continues_cycle(self):
+        items = list(range(4))
+        self.assertEqual(
+            latin_square_orders(items, 2) + latin_square_orders(items, 2, offset=2),
+            latin_square_orders(items, 4),
+        )
+
+    def test_nth_permutation_matches_itertools(self):
+        items = [3, 1, 4, 5]
+        expected = [list(p) for p in itertools.permutations(items)]
+        self.assertEqual([nth_permutation(items, i) for i in range(len(expected))], expected)
+
+    def test_counterbalanced_wraps(self):
+        items = list(range(3))
+        orders = counterbalanced_orders(items, math.factorial(3) + 1, offset=0)
+        self.assertEqual(len({tuple(order) for order in orders}), 6)
+        self.assertEqual(orders[0], orders[-1])
+
+    def test_counterbalanced_covers_every_permutation(self):
+        items = ["a", "b", "c", "d"]
+        orders = counterbalanced_orders(items, math.factorial(4))
+        self.assertEqual(
+            sorted(tuple(order) for order in orders),
+            sorted(itertools.permutations(items)),
+        )
+
+    def test_counterbalanced_blocks_are_position_balanced(self):
+        items = list(range(5))
+        for block in range(3):
+            self.assert_latin(counterbalanced_orders(items, 5, offset=block * 5), items)
+        self.assertEqual(counterbalanced_permutation(items, 7), counterbalanced_orders(items, 1, offset=7)[0])
@@ -0,0 +1,231 @@
+import json
+import os
+import tempfile
+from io import StringIO
+from unittest import mock
+
+import git
+from django.core.management import call_command
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext
+
+from experiments import models
+from experiments.utils import repo as repo_utils
+from experiments.utils.repo import find_new_experiments, find_repos, scan_repo
+
+
+class RepoFixture:
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.repo_dir = os.path.join(self.tmp.name, "experiments")
+        self.repo = git.Repo.init(self.repo_dir)
+        self.repo.create_remote("origin", "https://example.com/experiments.git")
+
+    def write(self, rel_path, content):
+        path = os.path.join(self.repo_dir, rel_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as fp:
+            fp.write(content if isinstance(content, str) else json.dumps(content))
+        self.repo.index.add([rel_path])
+
+    def commit(self):
+        return self.repo.index.commit("update").hexsha
+
+
+class ScanRepoTests(RepoFixture, SimpleTestCase):
+    def test_full_scan(self):
+        self.write("stroop/config.json", [{"name": "stroop"}])
+        self.write("flanker/config.json", [{"name": "flanker"}])
+        self.write("broken/config.json", {"name": 1})
+        self.write("old/config.json", [{"name": "old"}])
+        self.write("old/index.html", "")
+        head = self.commit()
+
+        self.assertEqual(list(find_repos(self.tmp.name)), [self.repo_dir])
+        scan = scan_repo(self.repo_dir)
+        self.assertFalse(scan.incremental)
+        self.assertEqual(scan.head, head)
+        self.assertEqual(scan.url, "https://example.com/experiments.git")
+        self.assertEqual(
+            scan.valid,
+            [
+                ("flanker", os.path.join(self.repo_dir, "flanker")),
+                ("stroop", os.path.join(self.repo_dir, "stroop")),
+            ],
+        )
+        self.assertEqual(len(scan.errors), 1)
+
+    def test_incremental_scan_reads_only_changed_dirs(self):
+        self.write("stroop/config.json", [{"name": "stroop"}])
+        self.write("flanker/config.json", [{"name": "flanker"}])
+        first = self.commit()
+        self.write("nback/config.json", [{"name": "nback"}])
+        self.repo.index.remove(["flanker/config.json"], working_tree=True)
+        self.commit()
+
+        scan = scan_repo(self.repo_dir, {scan_repo(self.repo_dir).path: first})
+        self.assertTrue(scan.incremental)
+        self.assertEqual(scan.valid, [("nback", os.path.join(self.repo_dir, "nback"))])
+        self.assertEqual(scan.removed, [os.path.join(self.repo_dir, "flanker")])
+
+        unchanged = scan_repo(self.repo_dir, {scan.path: scan.head})
+        self.assertEqual(unchanged.valid, [])
+
+
+class FindNewExperimentsTests(RepoFixture, TestCase):
+    def test_records_scanned_commit(self):
+        self.write("stroop/config.json", [{"name": "stroop"}])
+        head = self.commit()
+        repos, experiments, deactivated, errors = find_new_experiments(self.tmp.name)
+        self.assertEqual(len(repos), 1)
+        self.assertEqual([exp.name for exp in experiments], ["stroop"])
+        self.assertEqual(models.RepoOrigin.objects.get().last_scanned_commit, head)
+
+        self.assertEqual(find_new_experiments(self.tmp.name), ([], [], [], []))
+
+    def test_fresh_import_query_count(self):
+        for i in range(30):
+            self.write(f"task_{i}/config.json", [{"name": f"task_{i}"}])
+        self.commit()
+        with CaptureQueriesContext(connection) as queries:
+            find_new_experiments(self.tmp.name)
+        self.assertEqual(models.ExperimentRepo.objects.count(), 30)
+        self.assertLessEqual(len(queries), 10)
+
+    def test_removed_experiments_marked_inactive(self):
+        self.write("stroop/config.json", [{"name": "stroop"}])
+        self.write("flanker/config.json", [{"name": "flanker"}])
+        self.commit()
+        find_new_experiments(self.tmp.name)
+
+        self.repo.index.remove(["flanker/config.json"], working_tree=True)
+        self.commit()
+        deactivated = find_new_experiments(self.tmp.name)[2]
+        self.assertEqual([exp.name for exp in deactivated], ["flanker"])
+        self.assertFalse(models.ExperimentRepo.objects.get(name="flanker").active)
+
+        # a full rescan, e.g. after history was rewritten, reaches the same state
+        models.RepoOrigin.objects.update(last_scanned_commit="")
+        models.ExperimentRepo.objects.update(active=True)
+        deactivated = find_new_experiments(self.tmp.name)[2]
+        self.assertEqual([exp.name for exp in deactivated], ["flanker"])
+        self.assertTrue(models.ExperimentRepo.objects.get(name="stroop").active)
+
+    def test_full_rescan_matches_differently_spelled_paths(self):
+        self.write("stroop/config.json", [{"name": "stroop"}])
+        self.write("old/config.json", [{"name": "old"}])
+        self.write("old/index.html", "")
+        self.commit()
+        find_new_experiments(self.tmp.name)
+        # rows written before scans were recorded, through a symlinked REPO_DIR
+        link = os.path.join(self.tmp.name, "link")
+        os.symlink(self.repo_dir, link)
+        models.ExperimentRepo.objects.create(
+            name="old", origin=models.RepoOrigin.objects.get(), location=os.path.join(link, "old")
+        )
+        models.ExperimentRepo.objects.filter(name="stroop").update(
+            location=os.path.join(link, "stroop") + "/"
+        )
+        models.RepoOrigin.objects.update(last_scanned_commit="", path=link)
+
+        repos, experiments, deactivated, errors = find_new_experiments(self.tmp.name)
+        self.assertEqual((repos, experiments, deactivated), ([], [], []))
+        self.assertEqual(models.ExperimentRepo.objects.filter(active=True).count(), 2)
+
+    def test_origin_names_are_made_unique(self):
+        models.RepoOrigin.objects.create(
+            url="https://example.com/other.git", path="/elsewhere/experiments", name="experiments"
+        )
+        self.write("stroop/config.json", [{"name": "stroop"}])
+        self.commit()
+        repos = find_new_experiments(self.tmp.name)[0]
+        self.assertEqual([origin.name for origin in repos], ["experiments-2"])
+
+    def test_add_experiments_command_in_parallel(self):
+        self.write("stroop/config.json", [{"name": "stroop"}])
+        self.commit()
+        second = git.Repo.init(os.path.join(self.tmp.name, "more"))
+        second.create_remote("origin", "https://example.com/more.git")
+        os.makedirs(os.path.join(second.working_tree_dir, "nback"))
+        with open(os.path.join(second.working_tree_dir, "nback", "config.json"), "w") as fp:
+            json.dump([{"name": "nback"}], fp)
+        second.index.add(["nback/config.json"])
+        second.index.commit("add nback")
+
+        out = StringIO()
+        call_command("add_experiments", self.tmp.name, "--jobs", "2", stdout=out)
+        self.assertEqual(
+            sorted(models.ExperimentRepo.objects.values_list("name", flat=True)),
+            ["nback", "stroop"],
+        )
+        self.assertIn("full scan", out.getvalue())
+
+
+class LatestCommitIndexTests(RepoFixture, TestCase):
+    def test_latest_commit_per_experiment(self):
+        self.write("stroop/config.json", [{"name": "stroop"}])
+        self.write("flanker/config.json", [{"name": "flanker"}])
+        first = self.commit()
+        find_new_experiments(self.tmp.name)
+        stroop = models.ExperimentRepo.objects.get(name="stroop")
+        flanker = models.ExperimentRepo.objects.get(name="flanker")
+        self.assertEqual(stroop.get_latest_commit(), first)
+
+        self.write("stroop/experiment.js", "// changed")
+        second = self.commit()
+        self.write("README", "unrelated")
+        self.commit()
+        self.assertEqual(
+            models.RepoOrigin.objects.get().latest_commits(),
+            {stroop.id: second, flanker.id: first},
+        )
+
+        # incremental update only reads commits after the indexed one
+        self.write("flanker/experiment.js", "// changed")
+        third = self.commit()
+        origin = models.RepoOrigin.objects.get()
+        self.assertEqual(origin.latest_commits(), {stroop.id: second, flanker.id: third})
+
+    def test_merged_changes_count_at_the_merge(self):
+        with self.repo.config_writer() as config:
+            config.set_value("user", "name", "test")
+            config.set_value("user", "email", "test@example.com")
+        self.write("stroop/config.json", [{"name": "stroop"}])
+        self.commit()
+        main = self.repo.active_branch
+        self.repo.git.checkout("-b", "feature")
+        self.write("stroop/experiment.js", "// changed on a branch")
+        self.commit()
+        main.checkout()
+        self.write("README", "unrelated, and newer than the branch commit")
+        self.commit()
+        self.repo.git.merge("--no-ff", "-m", "merge feature", "feature")
+        merge = self.repo.head.commit.hexsha
+
+        self.assertEqual(repo_utils.last_commits_by_dir(self.repo_dir, ["stroop"]), {"stroop": merge})
+
+
+class RepoPoolTests(RepoFixture, SimpleTestCase):
+    def test_handles_are_reused_and_closed_on_eviction(self):
+        first = repo_utils.open_repo(self.repo_dir)
+        self.assertIs(repo_utils.open_repo(self.repo_dir), first)
+        with mock.patch.object(first, "close") as close:
+            for i in range(repo_utils.repo_pool.maxsize):
+                other = os.path.join(self.tmp.name, f"other_{i}")
+                git.Repo.init(other)
+                repo_utils.open_repo(other)
+            close.assert_called_once()
+        self.assertIsNot(repo_utils.open_repo(self.repo_dir), first)
+
+    def test_valid_commits_are_remembered(self):
+        self.write("README", "readme")
+        head = self.commit()
+        self.assertFalse(repo_utils.is_valid_commit(self.repo_dir, "0" * 40))
+        with mock.patch.object(repo_utils, "open_repo", wraps=repo_utils.open_repo) as open_repo:
+            self.assertTrue(repo_utils.is_valid_commit(self.repo_dir, head))
+            self.assertTrue(repo_utils.is_valid_commit(self.repo_dir, head))
+            self.assertTrue(repo_utils.is_valid_commit(self.repo_dir, "HEAD"))
+            self.assertTrue(repo_utils.is_valid_commit(self.repo_dir, "HEAD"))
+        self.assertEqual(open_repo.call_count, 3)
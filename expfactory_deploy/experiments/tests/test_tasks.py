@@ -0,0 +1,157 @@
+import json
+import os
+import tempfile
+from datetime import timedelta
+
+import git
+from django.conf import settings
+from django.test import RequestFactory, TestCase
+from django.utils import timezone
+
+from experiments import models, tasks
+from experiments.tests.factories import make_battery
+
+
+class IngestResultSubmissionsTests(TestCase):
+    def setUp(self):
+        self.battery = make_battery(1)
+        self.batt_exp = self.battery.batteryexperiments_set.get()
+        self.assignment = models.Assignment.objects.create(
+            subject=models.Subject.objects.create(), battery=self.battery
+        )
+
+    def submit(self, key, body, experiment_id=None):
+        return models.ResultSubmission.objects.create(
+            idempotency_key=key,
+            assignment_id=self.assignment.id,
+            experiment_id=experiment_id or self.batt_exp.experiment_instance_id,
+            body=body,
+        )
+
+    def test_creates_results_in_batches(self):
+        body = json.dumps({"status": "finished", "trials": []})
+        self.submit("a", body)
+        self.submit("b", "not json")
+        self.submit("c", body, experiment_id=-1)
+
+        self.assertEqual(tasks.ingest_result_submissions(batch_size=2), 3)
+
+        result = models.Result.objects.get()
+        self.assertEqual((result.data, result.battery_experiment), (body, self.batt_exp))
+        statuses = dict(models.ResultSubmission.objects.values_list("idempotency_key", "status"))
+        self.assertEqual(statuses, {"a": "processed", "b": "failed", "c": "failed"})
+        self.assertEqual(self.assignment.get_progress().completed, 1)
+        self.assertEqual(tasks.ingest_result_submissions(), 0)
+
+    def test_staged_experiment_is_not_served_again(self):
+        # views builds forms from the database when imported
+        from experiments import views
+
+        battery = make_battery(2)
+        assignment = models.Assignment.objects.create(
+            subject=models.Subject.objects.create(), battery=battery
+        )
+        experiment, _ = assignment.get_next_experiment()
+        request = RequestFactory().post(
+            "/", json.dumps({"status": "finished"}), content_type="application/json"
+        )
+        with self.settings(RESULT_INGESTION_MODE="async"):
+            response = views.Results.as_view()(
+                request, assignment_id=assignment.id, experiment_id=experiment.id
+            )
+        self.assertEqual(response.status_code, 202)
+        self.assertIsNone(assignment.get_progress().current)
+        next_experiment, remaining = assignment.get_next_experiment()
+        self.assertNotEqual(next_experiment, experiment)
+        self.assertEqual(remaining, 1)
+
+        tasks.ingest_result_submissions()
+        self.assertEqual(assignment.get_next_experiment(), (next_experiment, 1))
+        self.assertEqual(assignment.get_progress().remaining, 1)
+
+
+class RepoOriginSyncTests(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.remote = git.Repo.init(os.path.join(self.tmp.name, "remote"))
+        self.commit_file("README", "first")
+        self.origin = models.RepoOrigin.objects.create(
+            url=f"file://{self.remote.working_tree_dir}",
+            path=os.path.join(self.tmp.name, "clone"),
+            name="clone",
+        )
+
+    def commit_file(self, name, content):
+        with open(os.path.join(self.remote.working_tree_dir, name), "w") as fp:
+            fp.write(content)
+        self.remote.index.add([name])
+        return self.remote.index.commit(content).hexsha
+
+    def test_clone_then_fetch(self):
+        self.assertEqual(tasks.clone_repo_origin(self.origin.id), "ready")
+        self.origin.refresh_from_db()
+        self.assertIsNotNone(self.origin.last_fetched)
+        self.assertEqual(self.origin.get_latest_commit(), self.remote.head.commit.hexsha)
+        # already claimed, a second run does nothing
+        self.assertEqual(tasks.clone_repo_origin(self.origin.id), "ready")
+
+        latest = self.commit_file("README", "second")
+        self.assertTrue(tasks.fetch_repo_origin(self.origin.id))
+        self.origin.refresh_from_db()
+        self.assertEqual(self.origin.get_latest_commit(), latest)
+
+    def test_failed_clone_records_error(self):
+        models.RepoOrigin.objects.filter(id=self.origin.id).update(
+            url=f"file://{self.tmp.name}/missing"
+        )
+        self.assertEqual(tasks.clone_repo_origin(self.origin.id), "failed")
+        self.origin.refresh_from_db()
+        self.assertTrue(self.origin.error)
+        self.assertFalse(tasks.fetch_repo_origin(self.origin.id))
+        self.assertFalse(os.path.exists(self.origin.path))
+
+        # nothing is left behind to make the retry fail
+        models.RepoOrigin.objects.filter(id=self.origin.id).update(
+            url=f"file://{self.remote.working_tree_dir}"
+        )
+        self.assertEqual(tasks.clone_repo_origin(self.origin.id), "ready")
+
+
+class DeploymentQueueTests(TestCase):
+    def setUp(self):
+        battery = make_battery(1)
+        self.instance = battery.batteryexperiments_set.get().experiment_instance
+        self.Deployment = models.Deployment
+
+    def age(self, **fields):
+        self.Deployment.objects.filter(experiment_instance=self.instance).update(
+            modified=timezone.now() - timedelta(days=1), **fields
+        )
+
+    def test_tasks_only_sent_for_new_or_requeued_rows(self):
+        self.assertEqual(self.Deployment.queue([self.instance.id]), [self.instance.id])
+        self.assertEqual(self.Deployment.queue([self.instance.id]), [])
+
+        self.age(status="failed", attempts=1)
+        self.assertEqual(self.Deployment.queue([self.instance.id]), [self.instance.id])
+        self.assertEqual(self.Deployment.queue([self.instance.id]), [])
+
+        # a worker died mid deploy
+        self.age(status="deploying")
+        self.assertEqual(self.Deployment.queue([self.instance.id]), [self.instance.id])
+
+    def test_failed_deployments_give_up_after_max_attempts(self):
+        # views builds forms from the database when imported
+        from experiments import views
+
+        self.Deployment.queue([self.instance.id])
+        self.age(status="failed", attempts=settings.DEPLOYMENT_MAX_ATTEMPTS, error="bad commit")
+        self.assertEqual(self.Deployment.queue([self.instance.id]), [])
+        self.assertTrue(self.instance.deployment.gave_up)
+
+        response = views.preparing(RequestFactory().get("/"), self.instance)
+        self.assertEqual(response.status_code, 500)
+        self.assertIn(b"bad commit", response.content)
+
+        self.assertEqual(self.Deployment.queue([self.instance.id], retry=True), [self.instance.id])
@@ -0,0 +1,25 @@
+from django.test import RequestFactory, TestCase
+
+from experiments import models
+from experiments.tests.factories import make_battery
+
+
+class ServeSubjectTests(TestCase):
+    def test_mturk_worker_id_becomes_the_subject_handle(self):
+        # views builds forms from the database when imported
+        from experiments import views
+
+        battery = make_battery(1)
+
+        def serve(query):
+            view = views.Serve()
+            view.setup(RequestFactory().get("/", query), battery_id=battery.id)
+            view.set_subject()
+            return view.subject
+
+        self.assertIsNone(serve({}))
+        subject = serve({"workerId": "A1WORKER", "assignmentId": "a1", "hitId": "h1"})
+        self.assertEqual(subject.handle, "A1WORKER")
+        # coming back to the HIT finds the same subject
+        self.assertEqual(serve({"workerId": "A1WORKER"}), subject)
+        self.assertEqual(models.Subject.objects.count(), 1)
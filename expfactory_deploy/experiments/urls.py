@@ -47,6 +47,8 @@ urlpatterns = [
         views.RepoOriginDetail.as_view(),
         name="repo-origin-detail",
     ),
+    path("repo/<int:pk>/status", views.repo_origin_status, name="repo-origin-status"),
+    path("repo/<int:pk>/fetch", views.repo_origin_fetch, name="repo-origin-fetch"),
     path("repo/<int:pk>/deactivate", views.deactivate_repo, name="repo-deactivate"),
     path(
         "repo/<int:pk>/deactivate/confirm",
@@ -158,6 +160,7 @@ urlpatterns = [
         name="subject-toggle",
     ),
     path("subjects/assign", views.AssignSubject.as_view(), name="subject-assign"),
+    path("subjects/assign/<str:task_id>", views.assign_subjects_status, name="subject-assign-status"),
     path("subjects/create", views.CreateSubjects.as_view(), name="subjects-create"),
     path("subject/<int:pk>/", views.SubjectDetail.as_view(), name="subject-detail"),
     path(
@@ -167,6 +170,7 @@ urlpatterns = [
     ),
     path("results/<int:result_id>/", views.single_result, name="result-detail"),
     path("assignments/generate/<int:battery_id>/<int:num_subjects>", views.batch_assignment_create, name="assignment-generate"),
+    path("assignments/download/<str:task_id>", views.batch_assignment_download, name="assignment-download"),
     path("serve/complete", views.Complete.as_view(), name="complete"),
     path("serve/<int:assignment_id>/consent", views.ServeConsent.as_view(), name="consent"),
     path("serve/preview/<int:battery_id>/consent", views.ServeConsent.as_view(preview=True), name="preview-consent"),
@@ -1,13 +1,81 @@
 from django.conf import settings
+from django.db import transaction
 from django.urls import reverse
 
 from experiments import models as models
 
+# reverse() is called once per batch with this in place of the subject id.
+SUBJECT_PLACEHOLDER = 987654321
+
+def serve_url_template(battery):
+    path = reverse("experiments:serve-battery", args=[SUBJECT_PLACEHOLDER, battery.pk])
+    return f'{settings.BASE_URL}{path.replace(str(SUBJECT_PLACEHOLDER), "{}", 1)}'
+
+"""
+Create num_subjects new subjects assigned to battery and return the urls they
+should be sent to. Subjects, assignments and their experiment orders are all
+inserted with bulk_create so the number of queries doesn't grow with
+num_subjects.
+"""
 def batch_assignments(battery, num_subjects=1):
-    urls = []
-    for i in range(num_subjects):
-        subject = models.Subject()
-        subject.save()
-        assignment = models.Assignment(subject=subject, battery=battery)
-        urls.append(f'{settings.BASE_URL}{reverse("experiments:serve-battery", args=[subject.pk, battery.pk])}')
-    return urls
+    with transaction.atomic():
+        subjects = models.Subject.objects.bulk_create(
+            [models.Subject() for i in range(num_subjects)]
+        )
+        orderings = [None] * num_subjects
+        if battery.random_order:
+            orderings = models.ExperimentOrder.bulk_generate(battery, num_subjects)
+        models.Assignment.objects.bulk_create([
+            models.Assignment(subject=subject, battery=battery, ordering=ordering)
+            for subject, ordering in zip(subjects, orderings)
+        ])
+    url = serve_url_template(battery)
+    return [url.format(subject.pk) for subject in subjects]
+
+"""
+Assign every subject in subject_ids to every battery in battery_ids, skipping
+pairs that are already assigned. Each battery is handled in its own
+transaction with the battery row locked, so concurrent calls read each
+other's assignments before generating orders. New assignments are inserted
+with bulk_create, the unique_assignment constraint drops any made
+concurrently elsewhere, e.g. by a participant arriving, and the orders
+generated for dropped rows are removed again. on_progress, if given, is
+called with (batteries_done, batteries_total, created) after each battery.
+Returns the number of assignments created.
+"""
+def assign_subjects(subject_ids, battery_ids, on_progress=None):
+    subject_ids = list(
+        models.Subject.objects.filter(id__in=subject_ids).values_list("id", flat=True)
+    )
+    batteries = list(models.Battery.objects.filter(id__in=battery_ids))
+    created = 0
+    for done, battery in enumerate(batteries, 1):
+        with transaction.atomic():
+            models.Battery.objects.select_for_update().filter(id=battery.id).first()
+            assignments = models.Assignment.objects.filter(battery=battery)
+            existing = set(
+                assignments.filter(subject__in=subject_ids).values_list("subject_id", flat=True)
+            )
+            new_subjects = [sub for sub in subject_ids if sub not in existing]
+            if new_subjects:
+                orderings = [None] * len(new_subjects)
+                if battery.random_order:
+                    orderings = models.ExperimentOrder.bulk_generate(battery, len(new_subjects))
+                models.Assignment.objects.bulk_create(
+                    [
+                        models.Assignment(subject_id=sub, battery=battery, ordering=ordering)
+                        for sub, ordering in zip(new_subjects, orderings)
+                    ],
+                    ignore_conflicts=True,
+                )
+                if battery.random_order:
+                    order_ids = [ordering.id for ordering in orderings]
+                    created += assignments.filter(ordering__in=order_ids).count()
+                    models.ExperimentOrder.objects.filter(
+                        id__in=order_ids, assignment=None
+                    ).delete()
+                else:
+                    created += assignments.filter(subject__in=new_subjects).count()
+        if on_progress:
+            on_progress(done, len(batteries), created)
+    return created
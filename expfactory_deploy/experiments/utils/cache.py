@@ -0,0 +1,101 @@
+"""
+Caching for values that never change once computed, e.g. anything derived from
+a repository at a pinned commit. Lookups go to a small in-process LRU first and
+then to the django cache (redis in production) so that other workers can reuse
+what one worker already computed.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import cache as shared_cache
+
+
+class LRUCache:
+    """ Bounded thread-safe mapping that evicts the least recently used key.
+    Entries optionally expire after ttl seconds. on_evict is called with
+    (key, value) for entries pushed out by size.
+    """
+
+    def __init__(self, maxsize=128, ttl=None, on_evict=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._data[key]
+            except KeyError:
+                return default
+            if expires is not None and expires < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        evicted = []
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                evicted.append(self._data.popitem(last=False))
+        if self.on_evict:
+            for old_key, (old_value, _) in evicted:
+                self.on_evict(old_key, old_value)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            value, _ = self._data.pop(key, (default, None))
+            return value
+
+    def clear(self):
+        with self._lock:
+            items = list(self._data.items())
+            self._data.clear()
+        if self.on_evict:
+            for key, (value, _) in items:
+                self.on_evict(key, value)
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __len__(self):
+        return len(self._data)
+
+
+class TieredCache:
+    """ In-process LRU in front of the django cache. Keys are built from the
+    parts passed to get/set, e.g. (experiment_repo_id, commit).
+    """
+
+    def __init__(self, prefix, maxsize=128, local_ttl=None, timeout=None):
+        self.prefix = prefix
+        self.timeout = timeout
+        self.local = LRUCache(maxsize=maxsize, ttl=local_ttl)
+
+    def key(self, *parts):
+        return ":".join([self.prefix, *[str(part) for part in parts]])
+
+    def get(self, *parts):
+        key = self.key(*parts)
+        value = self.local.get(key)
+        if value is None:
+            value = shared_cache.get(key)
+            if value is not None:
+                self.local.set(key, value)
+        return value
+
+    def set(self, value, *parts):
+        key = self.key(*parts)
+        self.local.set(key, value)
+        shared_cache.set(key, value, timeout=self.timeout)
+
+    def delete(self, *parts):
+        key = self.key(*parts)
+        self.local.pop(key)
+        shared_cache.delete(key)
@@ -0,0 +1,436 @@
+import json
+import os
+import posixpath
+import shutil
+import sys
+import tarfile
+import time
+from collections import Counter, defaultdict
+from datetime import timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.utils import timezone
+
+from .cache import TieredCache
+from . import repo as repo
+
+sys.path.append(str(Path(settings.ROOT_DIR, "expfactory_deploy_local/src/")))
+
+from expfactory_deploy_local.utils import generate_experiment_context
+
+"""
+Deployment backends put the files of an experiment at a commit under
+DEPLOYMENT_DIR/<repo stem>/<commit>/<experiment dir> for nginx to serve from
+STATIC_DEPLOYMENT_URL. Which one is used is set by DEPLOYMENT_BACKEND:
+    worktree: a full git worktree of the repository per commit
+    archive: a git archive of only the experiment's directory, plus any paths
+        outside it that its config.json run entries point at
+    blobstore: the same paths as archive, every file a hardlink into a
+        store of blobs keyed by sha in DEPLOYMENT_BLOB_DIR, so files that
+        don't change between commits are stored once
+Each backend returns the commit directory, or False if the commit isn't valid.
+"""
+
+# An ExperimentInstance is pinned to a commit, so the jspsych context built
+# from its deployed files never changes. tasks.deploy caches it by
+# (experiment_repo_id, commit, deployment path) once the files are ready, so
+# serving a participant does not parse config.json or survey.tsv.
+jspsych_context_cache = TieredCache(
+    "jspsych_context",
+    maxsize=settings.EXPERIMENT_CONTEXT_CACHE_SIZE,
+    local_ttl=settings.EXPERIMENT_CONTEXT_LOCAL_TTL,
+)
+
+
+def generate_jspsych_context(exp_instance, deploy_static_fs):
+    deploy_static_url = deploy_static_fs.replace(
+        settings.DEPLOYMENT_DIR, settings.STATIC_DEPLOYMENT_URL
+    )
+    location = exp_instance.experiment_repo_id.location
+    exp_fs_path = Path(deploy_static_fs, Path(location).stem)
+    exp_url_path = Path(deploy_static_url, Path(location).stem)
+
+    # default js/css location for poldracklab style experiments
+    static_url_path = Path(settings.STATIC_NON_REPO_URL, "default")
+
+    return generate_experiment_context(
+        exp_fs_path, static_url_path, exp_url_path
+    )
+
+
+def cache_jspsych_context(exp_instance, deploy_static_fs):
+    context = generate_jspsych_context(exp_instance, deploy_static_fs)
+    jspsych_context_cache.set(
+        context, exp_instance.experiment_repo_id_id, exp_instance.commit, deploy_static_fs
+    )
+    return context
+
+
+def deployment_dir(origin, commit):
+    return str(Path(settings.DEPLOYMENT_DIR, Path(origin.path).stem, commit))
+
+
+def experiment_subdir(origin, location):
+    """ location relative to the top of the repository, as used in git trees. """
+    rel = os.path.relpath(location, origin.path)
+    return "" if rel == "." else rel.replace(os.sep, "/")
+
+
+def materialize(instance):
+    experiment_repo = instance.experiment_repo_id
+    backend = BACKENDS[settings.DEPLOYMENT_BACKEND]
+    return backend(experiment_repo.origin, instance.commit, experiment_repo.location)
+
+
+def deploy_worktree(origin, commit, location):
+    return origin.checkout_commit(commit)
+
+
+def shared_paths(tree, rel):
+    """ Repository paths outside the experiment directory that its config.json
+    run entries refer to, e.g. ../shared/utils.js. Entries served from static,
+    absolute and remote urls are not part of the repository. """
+    try:
+        config = json.loads((tree / posixpath.join(rel, "config.json")).data_stream.read())
+    except (KeyError, ValueError):
+        return []
+    if isinstance(config, list):
+        config = config[0] if config else {}
+    if not isinstance(config, dict):
+        return []
+    paths = []
+    for entry in config.get("run", []):
+        if not isinstance(entry, str) or entry.startswith(("static", "http", "/")):
+            continue
+        path = posixpath.normpath(posixpath.join(rel, entry))
+        if path.startswith("..") or path == rel or path.startswith(f"{rel}/"):
+            continue
+        try:
+            tree / path
+        except KeyError:
+            continue
+        paths.append(path)
+    return sorted(set(paths))
+
+
+def staging_dir(root, rel):
+    # built next to the target and renamed so a half written directory is never served
+    root = Path(root)
+    staging = Path(root.parent, f".{root.name}.{Path(rel).name}.{os.getpid()}.tmp")
+    shutil.rmtree(staging, ignore_errors=True)
+    return staging
+
+
+def move_into_place(staging, root, paths):
+    """ Move paths from staging into root, leaving ones another deployment of
+    the same commit already put there. """
+    for path in paths:
+        target = Path(root, path)
+        if target.exists():
+            continue
+        target.parent.mkdir(parents=True, exist_ok=True)
+        os.rename(Path(staging, path), target)
+
+
+def finish_staging(staging, root, rel, shared):
+    # the experiment directory goes last, its presence marks the deploy done
+    move_into_place(staging, root, [*shared, rel] if rel else os.listdir(staging))
+    shutil.rmtree(staging, ignore_errors=True)
+
+
+def deploy_archive(origin, commit, location):
+    if not repo.is_valid_commit(origin.path, commit):
+        return False
+    root = deployment_dir(origin, commit)
+    rel = experiment_subdir(origin, location)
+    if Path(root, rel).exists():
+        return root
+    git_repo = repo.open_repo(origin.path)
+    tree = git_repo.commit(commit).tree
+    if rel and not repo.tree_has(tree, rel):
+        return False
+    shared = shared_paths(tree, rel)
+    staging = staging_dir(root, rel)
+    staging.mkdir(parents=True)
+    proc = git_repo.git.archive("--format=tar", commit, "--", rel or ".", *shared, as_process=True)
+    with tarfile.open(fileobj=proc.stdout, mode="r|") as archive:
+        if hasattr(tarfile, "data_filter"):
+            archive.extractall(staging, filter="data")
+        else:
+            archive.extractall(staging)
+    proc.wait()
+    finish_staging(staging, root, rel, shared)
+    return root
+
+
+def blob_path(sha):
+    return Path(settings.DEPLOYMENT_BLOB_DIR, sha[:2], sha[2:])
+
+
+def store_blob(blob):
+    path = blob_path(blob.hexsha)
+    if not path.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        with open(tmp, "wb") as fp:
+            blob.stream_data(fp)
+        os.replace(tmp, path)
+    return path
+
+
+def link_tree(tree, dest):
+    """ Recreate tree under dest with every file hardlinked from the blob store.
+    Submodules are skipped. """
+    prefix = f"{tree.path}/" if tree.path else ""
+    dest.mkdir(parents=True)
+    for item in tree.traverse():
+        out = Path(dest, item.path[len(prefix):])
+        if item.type == "tree":
+            out.mkdir(parents=True, exist_ok=True)
+        elif item.type == "blob":
+            out.parent.mkdir(parents=True, exist_ok=True)
+            if item.mode == item.link_mode:
+                os.symlink(item.data_stream.read().decode(), out)
+                continue
+            link_blob(item, out)
+
+
+LINK_ATTEMPTS = 3
+
+
+def link_blob(blob, out):
+    for attempt in range(LINK_ATTEMPTS):
+        stored = store_blob(blob)
+        try:
+            os.link(stored, out)
+            return
+        except FileNotFoundError:
+            # gc_blobs removed it after store_blob found it, the copy stored
+            # now is younger than the running prune so it is left alone. If
+            # out's directory is the one missing every attempt fails the same.
+            if attempt == LINK_ATTEMPTS - 1:
+                raise
+        except OSError:
+            # blob store on another filesystem
+            shutil.copyfile(stored, out)
+            return
+
+
+def deploy_blobstore(origin, commit, location):
+    if not repo.is_valid_commit(origin.path, commit):
+        return False
+    root = deployment_dir(origin, commit)
+    rel = experiment_subdir(origin, location)
+    target = Path(root, rel)
+    if target.exists():
+        return root
+    tree = repo.open_repo(origin.path).commit(commit).tree
+    try:
+        subtree = tree / rel if rel else tree
+    except KeyError:
+        return False
+    staging = staging_dir(root, rel)
+    shared = [path for path in shared_paths(tree, rel) if not Path(root, path).exists()]
+    for path in shared:
+        item = tree / path
+        if item.type == "tree":
+            link_tree(item, Path(staging, path))
+        else:
+            Path(staging, path).parent.mkdir(parents=True, exist_ok=True)
+            link_blob(item, Path(staging, path))
+    link_tree(subtree, Path(staging, rel))
+    finish_staging(staging, root, rel, shared)
+    return root
+
+
+BACKENDS = {
+    "worktree": deploy_worktree,
+    "archive": deploy_archive,
+    "blobstore": deploy_blobstore,
+}
+
+
+def directory_size(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            total += os.lstat(os.path.join(root, name)).st_size
+    return total
+
+
+def deployed_size(instance, root):
+    """ Bytes on disk for an instance's deployment: the whole worktree, or
+    just the experiment's directory for the other backends. """
+    if Path(root, ".git").is_file():
+        return directory_size(root)
+    experiment_repo = instance.experiment_repo_id
+    return directory_size(Path(root, experiment_subdir(experiment_repo.origin, experiment_repo.location)))
+
+
+def remove_deployment_dir(origin, path):
+    if Path(path, ".git").is_file():
+        repo.open_repo(origin.path).git.worktree("remove", "--force", path)
+    else:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def disk_usage(path):
+    """ Bytes that deleting path would free: files linked from elsewhere, like
+    blob store hardlinks, aren't counted. """
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            stat = os.lstat(os.path.join(root, name))
+            if stat.st_nlink == 1:
+                total += stat.st_blocks * 512
+    return total
+
+
+def shared_links(paths):
+    """ Counter of (device, inode) for files under paths that have links
+    elsewhere too, e.g. blob store hardlinks. """
+    links = Counter()
+    for path in paths:
+        for root, dirs, files in os.walk(path):
+            for name in files:
+                stat = os.lstat(os.path.join(root, name))
+                if stat.st_nlink > 1:
+                    links[(stat.st_dev, stat.st_ino)] += 1
+    return links
+
+
+def gc_blobs(dry_run=False, before=None, removing=None):
+    """ Delete blobs no deployment links to anymore. Returns (blobs, bytes)
+    removed. Blobs written at or after before (a timestamp) are skipped, a
+    deploy running alongside may have stored them and not linked them yet.
+    removing is a shared_links Counter of links about to be deleted, dry runs
+    use it to count the blobs that deleting them would free. """
+    removed, freed = 0, 0
+    removing = removing or Counter()
+    if not os.path.isdir(settings.DEPLOYMENT_BLOB_DIR):
+        return removed, freed
+    for root, dirs, files in os.walk(settings.DEPLOYMENT_BLOB_DIR):
+        for name in files:
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+            if before is not None and stat.st_mtime >= before:
+                continue
+            if stat.st_nlink - removing[(stat.st_dev, stat.st_ino)] == 1:
+                if not dry_run:
+                    os.unlink(path)
+                removed += 1
+                freed += stat.st_blocks * 512
+    return removed, freed
+
+
+def pinned_instances():
+    """ Instances whose deployments must stay: used by a battery that isn't
+    inactive, or that received results within DEPLOYMENT_RESULT_GRACE_DAYS. """
+    from experiments.models import BatteryExperiments, Battery, Result
+
+    in_batteries = BatteryExperiments.objects.exclude(
+        battery__status=Battery.STATUS.inactive
+    ).values_list("experiment_instance", flat=True)
+    recent = Result.objects.filter(
+        created__gte=timezone.now() - timedelta(days=settings.DEPLOYMENT_RESULT_GRACE_DAYS)
+    ).values_list("battery_experiment__experiment_instance", flat=True)
+    return (set(in_batteries) | set(recent)) - {None}
+
+
+"""
+Remove deployments nothing needs anymore. Deployments of pinned_instances are
+kept. Everything else is a preview, kept while it was used within
+DEPLOYMENT_PREVIEW_TTL_DAYS. If the deployments on disk are still larger than
+max_bytes, previews are evicted least recently used first. Directories still
+used by a kept deployment, e.g. a worktree shared by several experiments at
+the same commit, stay on disk. Returns a report of what was (or with dry_run
+would be) removed.
+"""
+
+
+def prune_deployments(max_bytes=None, dry_run=False):
+    from experiments.models import Deployment
+
+    if max_bytes is None:
+        max_bytes = settings.DEPLOYMENT_MAX_BYTES
+    started = time.time()
+    pinned = pinned_instances()
+    deployments = list(
+        Deployment.objects.exclude(status__in=[Deployment.STATUS.queued, Deployment.STATUS.deploying])
+        .select_related("experiment_instance__experiment_repo_id__origin")
+    )
+    expires = timezone.now() - timedelta(days=settings.DEPLOYMENT_PREVIEW_TTL_DAYS)
+    keep, previews, stale = [], [], []
+    for deployment in deployments:
+        last_used = deployment.last_used or deployment.modified
+        if deployment.experiment_instance_id in pinned:
+            keep.append(deployment)
+        elif deployment.status == Deployment.STATUS.ready and last_used >= expires:
+            previews.append(deployment)
+        else:
+            stale.append(deployment)
+
+    if max_bytes:
+        previews.sort(key=lambda deployment: deployment.last_used or deployment.modified)
+        # deployments at the same commit share a directory, which is only
+        # freed once every deployment in it is evicted. A worktree's size is
+        # the whole worktree so it is counted once, the other backends record
+        # just their experiment's files.
+        sizes = defaultdict(int)
+        users = defaultdict(set)
+        for deployment in keep + previews:
+            key = deployment.path or deployment.id
+            if Path(deployment.path, ".git").is_file():
+                sizes[key] = max(sizes[key], deployment.size or 0)
+            else:
+                sizes[key] += deployment.size or 0
+            users[key].add(deployment.id)
+        total = sum(sizes.values())
+        while previews and total > max_bytes:
+            evicted = previews.pop(0)
+            key = evicted.path or evicted.id
+            users[key].discard(evicted.id)
+            if not users[key]:
+                total -= sizes[key]
+            stale.append(evicted)
+    keep += previews
+
+    report = {"deployments": len(stale), "directories": 0, "bytes": 0, "blobs": 0}
+    keep_paths = {deployment.path for deployment in keep}
+    removed_paths = set()
+    origins = {}
+    for deployment in stale:
+        instance = deployment.experiment_instance
+        origin = instance.experiment_repo_id.origin
+        path = deployment.path
+        if not dry_run:
+            jspsych_context_cache.delete(
+                instance.experiment_repo_id_id, instance.commit, deployment.path
+            )
+        if origin is None or not path or path in keep_paths or path in removed_paths:
+            continue
+        removed_paths.add(path)
+        origins[origin.id] = origin
+        if not os.path.exists(path):
+            continue
+        report["bytes"] += disk_usage(path)
+        if dry_run:
+            continue
+        # same lock deploys take for worktree changes
+        with repo.repo_lock(origin.path):
+            remove_deployment_dir(origin, path)
+    report["directories"] = len(removed_paths)
+    if dry_run:
+        removing = shared_links(path for path in removed_paths if os.path.exists(path))
+        report["blobs"], freed = gc_blobs(dry_run=True, before=started, removing=removing)
+        report["bytes"] += freed
+        return report
+
+    Deployment.objects.filter(id__in=[deployment.id for deployment in stale]).delete()
+    for origin in origins.values():
+        if os.path.isdir(origin.path):
+            repo.open_repo(origin.path).git.worktree("prune")
+    report["blobs"], freed = gc_blobs(before=started)
+    report["bytes"] += freed
+    return report
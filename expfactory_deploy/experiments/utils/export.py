@@ -1,6 +1,5 @@
-import ast
+import json
 import math
-from collections import defaultdict
 from pathlib import Path
 
 from django.conf import settings
@@ -8,25 +7,64 @@ from django.conf import settings
 from experiments import models as models
 
 
-def export_battery(battery_id):
+def export_battery(battery_id, fmt="json"):
     results = models.Result.objects.filter(battery_experiment__battery=battery_id)
-    return export_results(results)
+    return export_results(results, fmt)
 
-def export_subject(subject_id):
+def export_subject(subject_id, fmt="json"):
     results = models.Result.objects.filter(subject=subject_id)
-    return export_results(results)
+    return export_results(results, fmt)
 
-def export_single_result(result_id):
+def export_single_result(result_id, fmt="json"):
     results = models.Result.objects.filter(id=result_id)
-    return export_results(results)
+    return export_results(results, fmt)
 
-def export_results(results):
-    res_by_task = defaultdict(list)
+"""
+Results are streamed out of a single select_related queryset read in chunks,
+so memory use does not depend on how many results a battery has. The json
+format is {task_name: [{'subject': ..., 'data': ...}, ...]}, ndjson writes one
+{'task': ..., 'subject': ..., 'data': ...} object per line.
+"""
+def export_results(results, fmt="json"):
+    results = (
+        results.select_related(
+            "battery_experiment__experiment_instance__experiment_repo_id", "subject"
+        )
+        .order_by("battery_experiment__experiment_instance__experiment_repo_id__name", "id")
+        .iterator(chunk_size=settings.RESULT_EXPORT_CHUNK_SIZE)
+    )
+    if fmt == "ndjson":
+        return stream_ndjson(results)
+    return stream_json(results)
+
+def task_name(result):
+    try:
+        return result.battery_experiment.experiment_instance.experiment_repo_id.name
+    except AttributeError:
+        return ""
+
+def stream_json(results):
+    current_task = None
+    yield "{"
     for result in results:
-        name = result.battery_experiment.experiment_instance.experiment_repo_id.name
-        data = task_data(result.data)
-        res_by_task[name].append({'subject': result.subject.__str__(), 'data': data})
-    return res_by_task
+        name = task_name(result)
+        if name != current_task:
+            if current_task is not None:
+                yield "],"
+            yield f"{json.dumps(name)}:["
+            current_task = name
+        else:
+            yield ","
+        yield f'{{"subject":{json.dumps(str(result.subject))},"data":{task_data(result.data)}}}'
+    if current_task is not None:
+        yield "]"
+    yield "}"
+
+def stream_ndjson(results):
+    for result in results:
+        task = json.dumps(task_name(result))
+        subject = json.dumps(str(result.subject))
+        yield f'{{"task":{task},"subject":{subject},"data":{task_data(result.data)}}}\n'
 
 '''
 playing around with a bidsish export
@@ -63,9 +101,19 @@ def task_serializer(task):
         # note?
     }
 
+"""
+Result.data holds the json body posted by the experiment, so it is copied
+into the export as is once it parses. Rows that aren't json (python reprs
+migration 0037 couldn't convert, NaN) are written as a json string.
+"""
+def reject_constant(name):
+    raise ValueError(f"{name} is not valid json")
+
 def task_data(data):
+    if not data:
+        return "null"
     try:
-        data_ast = ast.literal_eval(data)
-        return json.dumps(data_ast)
-    except:
-        return data
+        json.loads(data, parse_constant=reject_constant)
+    except ValueError:
+        return json.dumps(data)
+    return data
@@ -0,0 +1,93 @@
+import math
+import random
+
+"""
+Order schemes for batteries with random_order set. Each generator takes the
+list of battery experiment ids, how many orders are wanted and an offset (the
+number of orders already handed out for the battery) and returns that many
+permutations of the ids. The offset lets latin square and counterbalanced
+batteries continue their cycle across separate batches of assignments instead
+of restarting at the first row every time.
+"""
+
+
+def uniform_orders(items, count, offset=0):
+    """ Independent uniform shuffles, offset is ignored. """
+    return [random.sample(items, len(items)) for i in range(count)]
+
+
+def latin_square_row(n, row):
+    """ Row of a balanced latin square (Williams design) over range(n). Every
+    item appears in every position once and every item directly follows every
+    other item once across n rows. For odd n the square needs 2n rows, the
+    second n are the first n reversed.
+    """
+    if n % 2 and row % (2 * n) >= n:
+        return latin_square_row(n, row - n)[::-1]
+    first = []
+    low, high = 0, 0
+    for i in range(n):
+        if i < 2 or i % 2:
+            first.append(low)
+            low += 1
+        else:
+            first.append(n - high - 1)
+            high += 1
+    return [(value + row) % n for value in first]
+
+
+def latin_square_orders(items, count, offset=0):
+    n = len(items)
+    if n == 0:
+        return [[] for i in range(count)]
+    return [
+        [items[index] for index in latin_square_row(n, offset + i)]
+        for i in range(count)
+    ]
+
+
+def nth_permutation(items, index):
+    """ The index-th permutation of items in lexicographic order, without
+    enumerating the ones before it. """
+    pool = list(items)
+    permutation = []
+    for position in range(len(pool), 0, -1):
+        step = math.factorial(position - 1)
+        choice, index = divmod(index, step)
+        permutation.append(pool.pop(choice))
+    return permutation
+
+
+def counterbalanced_permutation(items, index):
+    """ The index-th of all len(items)! permutations, ordered so every run of
+    len(items) consecutive indices starting at a multiple of len(items) puts
+    each item in each position once. The run is the rotations of one base
+    permutation that keeps items[0] first; there are (n - 1)! of those, one
+    per rotation class, so indices 0 to n! - 1 cover every permutation once.
+    """
+    n = len(items)
+    if n == 0:
+        return []
+    base, rotation = divmod(index, n)
+    permutation = [items[0]] + nth_permutation(items[1:], base)
+    return permutation[rotation:] + permutation[:rotation]
+
+
+def counterbalanced_orders(items, count, offset=0):
+    """ Step through every permutation of items in turn, wrapping around once
+    all of them have been handed out. Each block of len(items) orders is
+    position balanced, so the first participants don't all start with the
+    same experiment. """
+    total = math.factorial(len(items))
+    return [counterbalanced_permutation(items, (offset + i) % total) for i in range(count)]
+
+
+ORDER_SCHEMES = {
+    "uniform": uniform_orders,
+    "latin_square": latin_square_orders,
+    "counterbalanced": counterbalanced_orders,
+}
+
+
+def generate_orders(scheme, items, count, offset=0):
+    return ORDER_SCHEMES[scheme](list(items), count, offset)
@@ -1,103 +1,449 @@
+import contextlib
+import fcntl
+import functools
 import json
 import os
 import pathlib
+import posixpath
+import shutil
+import threading
 import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import git
 import jsonschema
 from django.conf import settings
+from django.db import transaction
 from git.exc import GitError
 
+from .cache import LRUCache
+
 """
-Given a repo, crawl its subdirectories and return paths to directories with valid config.json
+git.Repo handles are reused instead of opened per call, each one keeps
+`git cat-file` helper processes alive between calls. Handles aren't safe to
+share between threads or across a fork, so the pool is keyed by process and
+thread as well as path. Evicted handles have their helper processes closed.
 """
+repo_pool = LRUCache(
+    maxsize=settings.GIT_REPO_POOL_SIZE, on_evict=lambda key, handle: handle.close()
+)
+
+
+def open_repo(repo_location):
+    key = (os.getpid(), threading.get_ident(), str(repo_location))
+    handle = repo_pool.get(key)
+    if handle is None:
+        handle = git.Repo(repo_location)
+        repo_pool.set(key, handle)
+    return handle
+
+
+def close_repos():
+    repo_pool.clear()
 
 
-def find_valid_dirs(repo):
+@contextlib.contextmanager
+def repo_lock(repo_location):
+    """ Exclusive lock for changing a repository's worktrees or deployed
+    files. It is an flock on a file in the git dir rather than a row lock so
+    no database transaction is held open while git runs. """
+    git_dir = os.path.join(repo_location, ".git")
+    if not os.path.isdir(git_dir):
+        git_dir = repo_location
+    with open(os.path.join(git_dir, "expfactory-deploy.lock"), "a") as fp:
+        fcntl.flock(fp, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fp, fcntl.LOCK_UN)
+
+
+@functools.lru_cache(maxsize=None)
+def experiment_validator():
+    """ Compiled validator for experiment_schema.json, built once per process. """
     with open(pathlib.Path(__file__).parent.joinpath("experiment_schema.json")) as fp:
         schema = json.load(fp)
-    valid_dirs = []
-    errors = []
-    # switch to scandir if too slow
-    for root, dir, files in os.walk(repo):
-        if "config.json" not in files:
-            continue
+    validator_class = jsonschema.validators.validator_for(schema)
+    validator_class.check_schema(schema)
+    return validator_class(schema)
+
+
+"""
+Yield the top level of every git repository under search_dir without
+descending into them.
+"""
+
+
+def find_repos(search_dir):
+    for root, dirs, files in os.walk(search_dir):
+        if ".git" in dirs or ".git" in files:
+            dirs[:] = []
+            yield root
+
+
+"""
+Result of scanning one repository. Only plain values so it can be handed
+between processes.
+    path: top level of the repository as reported by git
+    url: url of the first remote
+    head: commit that was scanned
+    valid: (name, location) for each directory with a valid config.json
+    removed: locations whose config.json no longer exists at head, only
+        known for incremental scans
+    invalid: locations whose config.json failed to parse or validate
+    skipped: locations left alone on purpose (expfactory2 dirs with an
+        index.html), only known for the directories that were read
+    errors: messages for the invalid configs
+    incremental: True if only paths changed since the last scan were read
+"""
+RepoScan = namedtuple(
+    "RepoScan",
+    ["path", "url", "head", "valid", "removed", "invalid", "skipped", "errors", "incremental"],
+)
+
+
+def normalize_path(path):
+    """ Stored paths may be relative, go through symlinks or come from a
+    differently spelled REPO_DIR, compare them in this form. """
+    return os.path.realpath(path)
 
-        if "config.json" in files and "index.html" in files:
+
+def tree_has(tree, path):
+    try:
+        tree / path
+        return True
+    except KeyError:
+        return False
+
+
+"""
+Find experiment directories in the repository at repo_dir by reading the
+tree of its HEAD commit, no checkout required. last_scanned maps repository
+paths to the commit they were last scanned at; when HEAD descends from that
+commit only the directories of files changed since then are looked at.
+"""
+
+
+def scan_repo(repo_dir, last_scanned=None):
+    repo = open_repo(repo_dir)
+    path = repo.git.rev_parse("--show-toplevel")
+    if not repo.remotes:
+        return RepoScan(path, None, None, [], [], [], [], [f"{repo_dir} has no remote"], False)
+    url = repo.remotes[0].url
+    head = repo.head.commit
+    tree = head.tree
+    since = (last_scanned or {}).get(normalize_path(path))
+
+    incremental = False
+    if since == head.hexsha:
+        return RepoScan(path, url, head.hexsha, [], [], [], [], [], True)
+    if since and is_ancestor(repo, since, head.hexsha):
+        incremental = True
+        changed = repo.git.diff("--name-only", since, head.hexsha).splitlines()
+        candidates = {
+            posixpath.dirname(changed_path)
+            for changed_path in changed
+            if posixpath.basename(changed_path) in ("config.json", "index.html")
+        }
+    else:
+        files = repo.git.ls_tree("-r", "--name-only", head.hexsha).splitlines()
+        candidates = {
+            posixpath.dirname(file_path)
+            for file_path in files
+            if posixpath.basename(file_path) == "config.json"
+        }
+
+    validator = experiment_validator()
+    valid, removed, invalid, skipped, errors = [], [], [], [], []
+    for rel_dir in sorted(candidates):
+        location = os.path.join(repo_dir, rel_dir) if rel_dir else str(repo_dir)
+        config_path = posixpath.join(rel_dir, "config.json")
+        if not tree_has(tree, config_path):
+            removed.append(location)
+            continue
+        if tree_has(tree, posixpath.join(rel_dir, "index.html")):
             # expfactory2 - todo
+            skipped.append(location)
+            continue
+        try:
+            config = json.loads((tree / config_path).data_stream.read())
+        except ValueError as e:
+            invalid.append(location)
+            errors.append(f"{location}/config.json: {e}")
             continue
-        with open(os.path.join(root, "config.json")) as config_fp:
-            config = json.load(config_fp)
-            try:
-                validate = jsonschema.validate(config, schema)
-                valid_dirs.append(root)
-            except jsonschema.exceptions.ValidationError as e:
-                errors.append(e)
-                print("invalid")
-    return valid_dirs, errors
+        error = jsonschema.exceptions.best_match(validator.iter_errors(config))
+        if error is not None:
+            invalid.append(location)
+            errors.append(f"{location}/config.json: {error.message}")
+            continue
+        valid.append((os.path.split(location)[-1], location))
+    return RepoScan(path, url, head.hexsha, valid, removed, invalid, skipped, errors, incremental)
+
+
+def is_ancestor(repo, ancestor, commit):
+    try:
+        repo.git.merge_base("--is-ancestor", ancestor, commit)
+        return True
+    except GitError:
+        return False
+
+
+def timed_scan(repo_dir, last_scanned=None):
+    start = time.perf_counter()
+    scan = scan_repo(repo_dir, last_scanned)
+    return scan, time.perf_counter() - start
 
 
 """
-Process experiments found by find_valid_dirs, make new ExperimentRepoObjects if need be.
+Scan repo_dirs, yielding (scan, seconds) as each repository finishes. With
+jobs > 1 repositories are scanned in a process pool so config validation for
+large repositories runs in parallel.
 """
 
 
-def find_new_experiments(search_dir=settings.REPO_DIR):
-    from experiments.models import ExperimentRepo, RepoOrigin
+def scan_repos(repo_dirs, last_scanned=None, jobs=1):
+    if jobs <= 1:
+        for repo_dir in repo_dirs:
+            yield timed_scan(repo_dir, last_scanned)
+        return
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [
+            executor.submit(timed_scan, repo_dir, last_scanned)
+            for repo_dir in repo_dirs
+        ]
+        for future in as_completed(futures):
+            yield future.result()
 
-    print(f"searching {search_dir}")
-    valid_dirs, errors = find_valid_dirs(search_dir)
-    created_repos = []
-    created_experiments = []
-    for dir in valid_dirs:
-        print(f"found valid_dir {dir}")
-        repo = git.Repo(dir, search_parent_directories=True)
-        repo_path = repo.git.rev_parse("--show-toplevel")
-        repo_origin, repo_created = RepoOrigin.objects.get_or_create(
-            url=repo.remotes[0].url, path=repo_path
-        )
-        experiment, experiment_created = ExperimentRepo.objects.get_or_create(
-            name=os.path.split(dir)[-1], origin=repo_origin, location=dir
+
+def last_scanned_commits():
+    from experiments.models import RepoOrigin
+
+    return {
+        normalize_path(path): commit
+        for path, commit in RepoOrigin.objects.exclude(last_scanned_commit="").values_list(
+            "path", "last_scanned_commit"
         )
+    }
+
+
+def unique_name(name, taken):
+    """ name, or name-2, name-3... if it is already in taken. """
+    candidate, suffix = name, 1
+    while candidate in taken:
+        suffix += 1
+        candidate = f"{name}-{suffix}"
+    taken.add(candidate)
+    return candidate
+
+
+"""
+Reconcile a list of RepoScans against the database in a single transaction.
+Existing RepoOrigin and ExperimentRepo rows are each read with one query and
+new ones are written with bulk_create, so the number of queries doesn't depend
+on how many experiments were found. Origins are matched by normalized path,
+then by url, and experiments by normalized location. Experiments whose
+directory is gone are marked inactive, ones that reappear are made active
+again; directories the scan skipped on purpose are left as they are.
+Returns (created_repos, created_experiments, deactivated_experiments, errors).
+"""
+
+
+def record_scans(scans):
+    from experiments.models import ExperimentRepo, RepoOrigin
+
+    errors = [error for scan in scans for error in scan.errors]
+    scans = [scan for scan in scans if scan.url is not None]
+    if not scans:
+        return ([], [], [], errors)
+
+    with transaction.atomic():
+        existing = list(RepoOrigin.objects.all())
+        by_path = {normalize_path(origin.path): origin for origin in existing}
+        by_url = {origin.url: origin for origin in existing}
+        names = {origin.name for origin in existing}
+        origins = {}
+        new_origins = []
+        for scan in scans:
+            origin = by_path.get(normalize_path(scan.path)) or by_url.get(scan.url)
+            if origin is None:
+                origin = RepoOrigin(
+                    url=scan.url,
+                    path=scan.path,
+                    name=unique_name(os.path.basename(scan.path), names),
+                )
+                new_origins.append(origin)
+                by_path[normalize_path(scan.path)] = by_url[scan.url] = origin
+            origins[scan.path] = origin
+        created_repos = []
+        if new_origins:
+            RepoOrigin.objects.bulk_create(new_origins)
+            # not every backend returns primary keys from bulk_create
+            created_repos = list(
+                RepoOrigin.objects.filter(path__in=[origin.path for origin in new_origins])
+            )
+            created = {origin.path: origin for origin in created_repos}
+            origins = {path: created.get(origin.path, origin) for path, origin in origins.items()}
 
-        if repo_created:
-            created_repos.append(repo_origin)
-        if experiment_created:
-            print(f"created new experiment entry")
-            created_experiments.append(experiment)
-    return (created_repos, created_experiments, errors)
+        experiments = {}
+        for experiment in ExperimentRepo.objects.filter(
+            origin__in=[origin.id for origin in origins.values()]
+        ).order_by("id"):
+            experiments.setdefault(
+                (experiment.origin_id, normalize_path(experiment.location)), experiment
+            )
 
+        created_experiments = []
+        reactivate = []
+        deactivate = []
+        for scan in scans:
+            origin = origins[scan.path]
+            found = set()
+            for name, location in scan.valid:
+                key = (origin.id, normalize_path(location))
+                found.add(key[1])
+                experiment = experiments.get(key)
+                if experiment is None:
+                    experiment = ExperimentRepo(name=name, origin=origin, location=location)
+                    experiments[key] = experiment
+                    created_experiments.append(experiment)
+                elif not experiment.active:
+                    reactivate.append(experiment)
+            if scan.incremental:
+                gone = {normalize_path(location) for location in scan.removed}
+            else:
+                gone = {
+                    location for origin_id, location in experiments
+                    if origin_id == origin.id
+                } - found - {
+                    normalize_path(location) for location in scan.invalid + scan.skipped
+                }
+            deactivate.extend(
+                experiments[(origin.id, location)] for location in gone
+                if (origin.id, location) in experiments
+                and experiments[(origin.id, location)].active
+                and experiments[(origin.id, location)].pk is not None
+            )
+            origin.last_scanned_commit = scan.head
 
-# find_valid_dirs('../expfactory-experiments')
+        ExperimentRepo.objects.bulk_create(created_experiments)
+        if reactivate:
+            ExperimentRepo.objects.filter(id__in=[exp.id for exp in reactivate]).update(active=True)
+        if deactivate:
+            ExperimentRepo.objects.filter(id__in=[exp.id for exp in deactivate]).update(active=False)
+        RepoOrigin.objects.bulk_update(
+            list({origin.id: origin for origin in origins.values()}.values()),
+            ["last_scanned_commit"],
+        )
+    return (created_repos, created_experiments, deactivate, errors)
+
+
+def find_new_experiments(search_dir=settings.REPO_DIR, jobs=1):
+    scans = [
+        scan for scan, elapsed in
+        scan_repos(list(find_repos(search_dir)), last_scanned_commits(), jobs)
+    ]
+    return record_scans(scans)
 
 
-def get_latest_commit(repo_location, sub_dir=None):
-    repo = git.Repo(repo_location)
+def get_latest_commit(repo_location):
+    repo = open_repo(repo_location)
     return repo.head.commit
-    '''
-    if sub_dir is None:
-        return repo.head.commit.hexsha
-    else:
-        commits = repo.git.log(path, pretty="format:%H").split('\n')
-        return commits.split('\n')[0]
-    '''
+
+"""
+Find the last commit that touched each of dirs (paths relative to the top of
+the repository) with a single git log walk from HEAD, newest first. With since
+only commits after it are read, dirs untouched since then are left out of the
+result. The walk stops as soon as every dir has been seen. Only first parents
+are followed and merges list what they changed against their first parent, so
+a merged branch counts as changed at its merge commit rather than at whichever
+branch commit has the newest date.
+"""
+def last_commits_by_dir(repo_location, dirs, since=None):
+    dirs = set(dirs)
+    found = {}
+    if not dirs:
+        return found
+    repo = open_repo(repo_location)
+    revision = f"{since}..HEAD" if since else "HEAD"
+    proc = repo.git.log(
+        revision, "--first-parent", "-m", "--format=%x00%H", "--name-only", as_process=True
+    )
+    commit = None
+    try:
+        for line in proc.stdout:
+            line = line.decode().rstrip("\n")
+            if line.startswith("\x00"):
+                commit = line[1:]
+                continue
+            path = line
+            while path:
+                path = posixpath.dirname(path)
+                if path in dirs and path not in found:
+                    found[path] = commit
+            if len(found) == len(dirs):
+                break
+    finally:
+        proc.proc.kill()
+        proc.proc.wait()
+    return found
 
 def commit_date(repo_location, commit=None):
-    repo = git.Repo(repo_location)
+    repo = open_repo(repo_location)
     if commit is None:
         commit = repo.head.commit
     else:
         commit = repo.commit(commit)
     return time.asctime(time.gmtime(commit.committed_date))
 
+# A sha that resolves once always will, so only positive answers are kept.
+valid_commits = LRUCache(maxsize=settings.GIT_VALID_COMMIT_CACHE_SIZE)
+
 def is_valid_commit(repo_location, commit):
-    try:
-        repo = git.Repo(repo_location)
-        repo.commit(commit)
+    key = (str(repo_location), commit)
+    if key in valid_commits:
         return True
-    except GitError as e:
+    try:
+        resolved = open_repo(repo_location).commit(commit)
+        # full shas aren't looked up by commit(), reading the size forces it
+        resolved.size
+    except (GitError, ValueError) as e:
         return False
+    if commit and resolved.hexsha.startswith(commit):
+        # branch names and other refs can move, don't remember those
+        valid_commits.set(key, True)
+    return True
 
 def pull_origin(repo_location):
-    repo = git.Repo(repo_location)
+    repo = open_repo(repo_location)
     repo.remotes.origin.pull()
+
+"""
+Clones and fetches are partial: blobs over GIT_BLOB_SIZE_LIMIT (stimuli,
+videos) are only downloaded once something needs them, e.g. checking out a
+commit for deployment. Smaller blobs such as the config.json files scan_repo
+reads come with the clone instead of one network round trip each.
+"""
+
+def blob_filter():
+    return f"--filter=blob:limit={settings.GIT_BLOB_SIZE_LIMIT}"
+
+def clone(url, repo_location):
+    fresh = not os.path.isdir(repo_location) or not os.listdir(repo_location)
+    os.makedirs(repo_location, exist_ok=True)
+    try:
+        return git.Repo.clone_from(url, repo_location, multi_options=[blob_filter()])
+    except GitError:
+        # a half written clone would make every retry fail
+        if fresh:
+            shutil.rmtree(repo_location, ignore_errors=True)
+        raise
+
+def fetch_origin(repo_location):
+    repo = open_repo(repo_location)
+    repo.git.fetch(blob_filter(), "origin")
+    return repo
+
+def fast_forward(repo_location):
+    repo = open_repo(repo_location)
+    repo.git.merge("--ff-only", "@{u}")
@@ -1,7 +1,8 @@
+import copy
+import hashlib
 import json
-import sys
+import uuid
 from datetime import datetime
-from pathlib import Path
 
 from crispy_forms.helper import FormHelper
 from crispy_forms.layout import Field, Layout, Submit
@@ -9,13 +10,15 @@ from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.core.exceptions import ObjectDoesNotExist
+from django.core.files.storage import default_storage
 from django.core.serializers import serialize
+from django.db import transaction
 from django.db.models import F, Q
 from django.forms import formset_factory, TextInput
-from django.http import HttpResponse, HttpResponseRedirect, JsonResponse, FileResponse
+from django.http import HttpResponse, HttpResponseRedirect, JsonResponse, FileResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404, render, redirect
 from django.urls import reverse, reverse_lazy
+from django.utils import timezone
 from django.views import View
 from django.views.generic import DetailView, ListView, TemplateView, View
 from django.views.generic.edit import CreateView, DeleteView, UpdateView, FormView
@@ -23,14 +26,12 @@ from taggit.models import Tag
 
 from experiments import forms as forms
 from experiments import models as models
-from experiments.utils.repo import find_new_experiments, get_latest_commit
-from experiments.utils.assignments import batch_assignments
+from experiments import tasks as tasks
+from experiments.utils.deploy import cache_jspsych_context, jspsych_context_cache
+from experiments.utils.repo import find_new_experiments
+from experiments.utils.assignments import assign_subjects, batch_assignments
 from experiments.utils.export import export_battery, export_subject, export_single_result
 
-sys.path.append(str(Path(settings.ROOT_DIR, "expfactory_deploy_local/src/")))
-
-from expfactory_deploy_local.utils import generate_experiment_context
-
 # Repo Views
 
 class RepoOriginList(LoginRequiredMixin, ListView):
@@ -48,15 +49,29 @@ class RepoOriginCreate(LoginRequiredMixin, CreateView):
 
     def form_valid(self, form):
         response = super().form_valid(form)
-        self.object.clone()
+        origin_id = self.object.id
+        transaction.on_commit(lambda: tasks.clone_repo_origin.delay(origin_id))
+        messages.info(self.request, f"Cloning {self.object.url} in the background")
         return response
 
+@login_required
+def repo_origin_status(request, pk):
+    origin = get_object_or_404(models.RepoOrigin, pk=pk)
+    return render(request, "experiments/repoorigin_status.html", {"repo": origin})
+
+@login_required
+def repo_origin_fetch(request, pk):
+    origin = get_object_or_404(models.RepoOrigin, pk=pk)
+    if request.method == "POST":
+        transaction.on_commit(lambda: tasks.fetch_repo_origin.delay(origin.id))
+        messages.info(request, f"Fetching {origin.url} in the background")
+    return redirect("experiments:repo-origin-detail", pk=origin.id)
+
 # Experiment Views
 def experiment_instances_from_latest(experiment_repos):
     for experiment_repo in experiment_repos:
-        latest = get_latest_commit(experiment_repo.location)
-        models.ExperimentInstance.get_or_create(
-            experiment_repo_id=experiment_repo.id, commit=latest
+        models.ExperimentInstance.objects.get_or_create(
+            experiment_repo_id=experiment_repo, commit=experiment_repo.get_latest_commit()
         )
 
 
@@ -90,11 +105,13 @@ class ExperimentRepoDetail(LoginRequiredMixin, DetailView):
 
 
 def add_new_experiments(request):
-    created_repos, created_experiments, errors = find_new_experiments()
+    created_repos, created_experiments, deactivated, errors = find_new_experiments()
     for repo in created_repos:
         messages.info(request, f"Tracking previously unseen repository {repo.url}")
     for experiment in created_experiments:
         messages.info(request, f"Added new experiment {experiment.name}")
+    for experiment in deactivated:
+        messages.warning(request, f"Experiment {experiment.name} is no longer in its repository, marked inactive")
     for error in errors:
         messages.error(request, error)
     return redirect('/experiments')
@@ -181,7 +198,12 @@ class BatteryList(LoginRequiredMixin, ListView):
 
 class BatteryDetail(LoginRequiredMixin, DetailView):
     model = models.Battery
-    queryset = models.Battery.objects.prefetch_related("assignment_set", "experiment_instances")
+    queryset = models.Battery.objects.prefetch_related(
+        "assignment_set__subject",
+        "assignment_set__progress",
+        "assignment_set__result_set__battery_experiment__experiment_instance__experiment_repo_id",
+        "experiment_instances",
+    )
     context_object_name = "battery"
 
 
@@ -261,6 +283,8 @@ class BatteryComplex(LoginRequiredMixin, TemplateView):
         if valid:
             ei = exp_instance_formset.save()
             battery.batteryexperiments_set.exclude(experiment_instance__in=ei).delete()
+            # experiments changed, have serve recompute what is left for each assignment
+            models.AssignmentProgress.objects.filter(assignment__battery=battery).update(remaining=None, current=None)
         elif not valid:
             print(exp_instance_formset.errors)
             return self.render_to_response(self.get_context_data(form=form, exp_instance_formset=exp_instance_formset))
@@ -276,6 +300,10 @@ def publish_battery(request, pk):
     battery = get_object_or_404(models.Battery, pk=pk)
     battery.status = "published"
     battery.save()
+    queue_deployments(
+        battery.batteryexperiments_set.values_list("experiment_instance", flat=True),
+        retry=True,
+    )
     return HttpResponseRedirect(reverse_lazy("experiments:battery-detail", kwargs={'pk':pk}))
 
 @login_required
@@ -316,12 +344,39 @@ def deactivate_repo_confirmation(request, pk):
 @login_required
 def batch_assignment_create(request, battery_id, num_subjects):
     battery = get_object_or_404(models.Battery, pk=battery_id)
+    if num_subjects > settings.BATCH_ASSIGNMENT_ASYNC_THRESHOLD:
+        # the serve urls are only handed out through batch_assignment_download
+        task_id = str(uuid.uuid4())
+        fname = f'batch_assignments/{task_id}.txt'
+        transaction.on_commit(
+            lambda: tasks.generate_batch_assignments.apply_async(
+                (battery.id, num_subjects, fname), task_id=task_id
+            )
+        )
+        download = reverse("experiments:assignment-download", args=[task_id])
+        messages.info(
+            request,
+            f"Generating {num_subjects} assignments, the urls will be available at {download}"
+        )
+        return redirect("experiments:battery-detail", pk=battery.id)
     urls = batch_assignments(battery, num_subjects)
     response = render(request, 'experiments/assignment_urls.txt', {'urls': urls}, content_type='text/plain')
     fname = f'batch_assignments_{datetime.now().strftime("%Y.%m.%d.%H%M%S")}.txt'
     response['Content-Disposition'] = f'attachment; filename="{fname}"'
     return response
 
+@login_required
+def batch_assignment_download(request, task_id):
+    result = tasks.generate_batch_assignments.AsyncResult(task_id)
+    if result.failed():
+        return HttpResponse(f"Generating assignments failed: {result.info}", status=500)
+    if not result.successful():
+        return HttpResponse("The assignment urls are still being generated.", status=202)
+    # the task returns the name default_storage actually saved the file under
+    response = FileResponse(default_storage.open(result.result), content_type="text/plain")
+    response['Content-Disposition'] = f'attachment; filename="batch_assignments_{task_id}.txt"'
+    return response
+
 class BatteryClone(LoginRequiredMixin, View):
     def get(self, request, *args, **kwargs):
         pk = self.kwargs.get("pk")
@@ -340,26 +395,50 @@ class BatteryDeploymentDelete(DeleteView):
 """
 
 def jspsych_context(exp_instance):
+    # Checked on every request rather than trusting the cache alone, the
+    # local tier in other processes outlives prune_deployments removing the
+    # files, and the path in the key keeps contexts from another deployment
+    # backend apart.
     deploy_static_fs = exp_instance.deploy_static()
-    deploy_static_url = deploy_static_fs.replace(
-        settings.DEPLOYMENT_DIR, settings.STATIC_DEPLOYMENT_URL
+    if deploy_static_fs is None:
+        return None
+    context = jspsych_context_cache.get(
+        exp_instance.experiment_repo_id_id, exp_instance.commit, deploy_static_fs
     )
-    location = exp_instance.experiment_repo_id.location
-    exp_fs_path = Path(deploy_static_fs, Path(location).stem)
-    exp_url_path = Path(deploy_static_url, Path(location).stem)
+    if context is None:
+        # tasks.deploy fills the cache, this covers evictions and expiries
+        context = cache_jspsych_context(exp_instance, deploy_static_fs)
+    # callers add per request values like post_url, don't let them leak into the cache
+    return copy.deepcopy(context)
 
-    # default js/css location for poldracklab style experiments
-    static_url_path = Path(settings.STATIC_NON_REPO_URL, "default")
+def queue_deployments(instance_ids, retry=False):
+    pending = models.Deployment.queue(instance_ids, retry=retry)
+    if pending:
+        transaction.on_commit(lambda: tasks.deploy_experiment_instances.delay(pending))
 
-    return generate_experiment_context(
-        exp_fs_path, static_url_path, exp_url_path
-    )
+"""
+    Shown in place of an experiment whose files are still being checked out.
+    The page reloads itself until the deployment is ready.
+"""
+PREPARING_RETRY_AFTER = 5
+
+def preparing(request, exp_instance):
+    queue_deployments([exp_instance.id])
+    deployment = models.Deployment.objects.filter(experiment_instance=exp_instance).first()
+    if deployment is not None and deployment.gave_up:
+        # stop reloading, retrying is left to publishing or previewing again
+        context = {"error": deployment.error}
+        return render(request, "experiments/preparing.html", context, status=500)
+    context = {"retry_after": PREPARING_RETRY_AFTER}
+    response = render(request, "experiments/preparing.html", context, status=503)
+    response["Retry-After"] = PREPARING_RETRY_AFTER
+    return response
 
 class Preview(View):
     def get(self, request, *args, **kwargs):
         exp_id = self.kwargs.get("exp_id")
         experiment = get_object_or_404(models.ExperimentRepo, id=exp_id)
-        commit = self.kwargs.get("commit", experiment.get_latest_commit())
+        commit = self.kwargs.get("commit") or experiment.get_latest_commit()
 
         exp_instance, created = models.ExperimentInstance.objects.get_or_create(
             experiment_repo_id=experiment, commit=commit
@@ -367,6 +446,9 @@ class Preview(View):
 
         template = "experiments/jspsych_deploy.html"
         context = jspsych_context(exp_instance)
+        if context is None:
+            return preparing(request, exp_instance)
+        models.Deployment.objects.filter(experiment_instance=exp_instance).update(last_used=timezone.now())
         return render(request, template, context)
 
 class PreviewBattery(View):
@@ -398,6 +480,13 @@ class Serve(View):
             self.subject = get_object_or_404(
                 models.Subject, id=subject_id
             )
+        elif self.request.GET.get("workerId"):
+            # mturk appends workerId to the ExternalQuestion url, the worker id
+            # is kept as the handle so review and bonuses can find the subject
+            worker_id = self.request.GET["workerId"]
+            self.subject = models.Subject.objects.filter(handle=worker_id).order_by("id").first()
+            if self.subject is None:
+                self.subject = models.Subject.objects.create(handle=worker_id)
         else:
             self.subject = None
 
@@ -409,7 +498,7 @@ class Serve(View):
 
     def set_assignment(self):
         # When might we want to error out instead of just create assignment?
-        self.assignment = models.Assignment.objects.get_or_create(subject=self.subject, battery=self.battery)
+        self.assignment, _ = models.Assignment.objects.get_or_create(subject=self.subject, battery=self.battery)
 
     def complete(self):
         return redirect('experiments:complete')
@@ -435,12 +524,20 @@ class Serve(View):
             }
             return render(request, "experiments/instructions.html", context)
 
-        self.experiment, num_left = self.assignment.get_next_experiment()
+        progress = self.assignment.get_progress()
+        if self.assignment.status == "completed" and progress.remaining == 0:
+            return self.complete()
+        if progress.current is not None:
+            self.experiment = progress.current.experiment_instance
+        else:
+            self.experiment, num_left = self.assignment.get_next_experiment()
 
         if self.experiment is None:
             return self.complete()
 
         exp_context = jspsych_context(self.experiment)
+        if exp_context is None:
+            return preparing(request, self.experiment)
         exp_context["post_url"] = reverse_lazy("experiments:push-results", args=[self.assignment.id, self.experiment.id])
         # No longer in use. We just location.reload for experiments.
         # exp_context["next_page"] = reverse_lazy("experiments:serve-battery", args=[self.subject.id, self.battery.id])
@@ -516,6 +613,8 @@ class Results(View):
         return data, finished
 
     def post(self, request, *args, **kwargs):
+        if settings.RESULT_INGESTION_MODE == "async":
+            return self.stage(request)
         assignment_id = self.kwargs.get("assignment_id")
         experiment_id = self.kwargs.get("experiment_id")
         exp_instance = get_object_or_404(models.ExperimentInstance, id=experiment_id)
@@ -523,18 +622,52 @@ class Results(View):
         batt_exp = get_object_or_404(models.BatteryExperiments, battery=assignment.battery, experiment_instance=exp_instance)
         data, finished = self.process_exp_data(request.body, assignment)
         if finished:
-            models.Result(assignment=assignment, battery_experiment=batt_exp, subject=assignment.subject, data=data, status="completed").save()
+            with transaction.atomic():
+                # store the json body as sent, export copies it out without parsing
+                result = models.Result(assignment=assignment, battery_experiment=batt_exp, subject=assignment.subject, data=request.body.decode(), status="completed")
+                result.save()
+                models.AssignmentProgress.record_result(result)
         elif assignment.status == "not-started":
             assignment.status = "started"
         assignment.save()
         return HttpResponse('recieved')
 
+    """
+        Async ingestion: keep the raw body and return right away, a celery task
+        validates it and creates the Result. Clients may send an Idempotency-Key
+        header, otherwise retries are recognized by a hash of the body. The
+        staged experiment is unpinned from the assignment's progress so the
+        next serve moves on instead of showing it again.
+    """
+    def stage(self, request):
+        assignment_id = self.kwargs.get("assignment_id")
+        experiment_id = self.kwargs.get("experiment_id")
+        client_key = request.headers.get("Idempotency-Key")
+        if not client_key:
+            client_key = hashlib.sha256(request.body).hexdigest()
+        _, created = models.ResultSubmission.objects.get_or_create(
+            idempotency_key=f"{assignment_id}:{experiment_id}:{client_key}",
+            defaults={
+                "assignment_id": assignment_id,
+                "experiment_id": experiment_id,
+                "body": request.body.decode(),
+            },
+        )
+        if created:
+            models.AssignmentProgress.objects.filter(
+                assignment=assignment_id, current__experiment_instance=experiment_id
+            ).update(current=None)
+            transaction.on_commit(lambda: tasks.ingest_result_submissions.delay())
+        return HttpResponse('accepted', status=202)
+
 class SubjectDetail(LoginRequiredMixin, DetailView):
     model = models.Subject
 
 class SubjectList(LoginRequiredMixin, ListView):
     model = models.Subject
-    queryset = models.Subject.objects.filter(active=True).prefetch_related("assignment_set")
+    queryset = models.Subject.objects.filter(active=True).prefetch_related(
+        "assignment_set__battery", "assignment_set__progress"
+    )
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -562,20 +695,32 @@ class ToggleSubjectActivation(SubjectListAction):
 
 class AssignSubject(SubjectListAction):
     def form_valid(self, form):
-        subs = models.Subject.objects.filter(id__in=form.cleaned_data['subjects'])
-        batts = models.Battery.objects.filter(id__in=form.cleaned_data['batteries'])
-        assignments = []
-        for batt in batts:
-            for sub in subs:
-                try:
-                    models.Assignment.objects.get(subject=sub, battery=batt)
-                except ObjectDoesNotExist:
-                    assignments.append(models.Assignment(subject=sub, battery=batt))
-
-        models.Assignment.objects.bulk_create(assignments)
-
+        subject_ids = list(form.cleaned_data['subjects'] or [])
+        battery_ids = [batt.id for batt in form.cleaned_data['batteries']]
+        if len(subject_ids) * len(battery_ids) > settings.ASSIGN_SUBJECTS_ASYNC_THRESHOLD:
+            task_id = str(uuid.uuid4())
+            transaction.on_commit(
+                lambda: tasks.bulk_assign_subjects.apply_async(
+                    (subject_ids, battery_ids), task_id=task_id
+                )
+            )
+            status_url = reverse('experiments:subject-assign-status', args=[task_id])
+            messages.info(
+                self.request,
+                f"Assigning {len(subject_ids)} subjects in the background, progress is available at {status_url}"
+            )
+        else:
+            assign_subjects(subject_ids, battery_ids)
         return super().form_valid(form)
 
+@login_required
+def assign_subjects_status(request, task_id):
+    result = tasks.bulk_assign_subjects.AsyncResult(task_id)
+    info = result.info if isinstance(result.info, dict) else {}
+    if result.failed():
+        info = {"error": str(result.info)}
+    return JsonResponse({"state": result.state, **info})
+
 class ExperimentRepoBulkTag(LoginRequiredMixin, FormView):
     form_class = forms.ExperimentRepoBulkTagForm
     template_name = 'experiments/experimentrepo_list.html'
@@ -602,32 +747,30 @@ class ResultDetail(LoginRequiredMixin, DetailView):
         response['Content-Disposition'] = f'attachment; filename="result_{self.object.pk}.txt"'
         return response
 
+def export_response(request, stream_results, fname):
+    fmt = "ndjson" if request.GET.get("format") == "ndjson" else "json"
+    content_type = "application/x-ndjson" if fmt == "ndjson" else "application/json"
+    response = StreamingHttpResponse(stream_results(fmt), content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="{fname}.{fmt}"'
+    return response
+
 @login_required
 def single_result(request, result_id):
     result = get_object_or_404(models.Result, pk=result_id)
-    results = export_single_result(result_id)
-    response = JsonResponse(results)
-    fname = f'result_{result.id}_{datetime.now().strftime("%Y.%m.%d.%H%M%S")}.json'
-    response['Content-Disposition'] = f'attachment; filename="{fname}"'
-    return response
+    fname = f'result_{result.id}_{datetime.now().strftime("%Y.%m.%d.%H%M%S")}'
+    return export_response(request, lambda fmt: export_single_result(result_id, fmt), fname)
 
 @login_required
 def battery_results(request, battery_id):
     battery = get_object_or_404(models.Battery, pk=battery_id)
-    results = export_battery(battery_id)
-    response = JsonResponse(results)
-    fname = f'battery_{battery.id}_{datetime.now().strftime("%Y.%m.%d.%H%M%S")}.json'
-    response['Content-Disposition'] = f'attachment; filename="{fname}"'
-    return response
+    fname = f'battery_{battery.id}_{datetime.now().strftime("%Y.%m.%d.%H%M%S")}'
+    return export_response(request, lambda fmt: export_battery(battery_id, fmt), fname)
 
 @login_required
 def subject_results(request, subject_id):
     subject = get_object_or_404(models.Subject, pk=subject_id)
-    results = export_subject(subject_id)
-    response = JsonResponse(results)
-    fname = f'subject_{subject.__str__()}_{datetime.now().strftime("%Y.%m.%d.%H%M%S")}.json'
-    response['Content-Disposition'] = f'attachment; filename="{fname}"'
-    return response
+    fname = f'subject_{subject.__str__()}_{datetime.now().strftime("%Y.%m.%d.%H%M%S")}'
+    return export_response(request, lambda fmt: export_subject(subject_id, fmt), fname)
 
 class Complete(TemplateView):
     template_name = 'experiments/complete.html'
@@ -1,20 +1,119 @@
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
 import botocore
 import boto3
+import os
+import random
 import re
+import threading
+import time
 from datetime import datetime, timedelta
 from dateutil.tz import tzlocal
+from django.conf import settings
 
 # botocore exceptions
+# Error codes worth retrying after a pause. The per-account request rate limit
+# comes back as ThrottlingException, ServiceFault is mturk's transient 5xx.
+retry_codes = {
+    "Throttling",
+    "ThrottlingException",
+    "TooManyRequestsException",
+    "RequestLimitExceeded",
+    "ServiceFault",
+}
+
+# ServiceFault may come back after mturk carried the request out, so calls
+# that would be duplicated by a retry are only retried on throttling.
+throttle_codes = retry_codes - {"ServiceFault"}
+
+# Errors for a request repeated with a UniqueRequestToken mturk has already
+# seen. The first request went through: a HIT's error message carries its id.
+token_used_codes = {
+    "AWS.MechanicalTurk.HitAlreadyExists",
+    "AWS.MechanicalTurk.DuplicateRequest",
+}
+hit_id_pattern = re.compile(r"\b[A-Z0-9]{30}\b")
+
+
+def token_already_used(error):
+    response = error.response
+    if response.get("TurkErrorCode") in token_used_codes:
+        return True
+    message = response.get("Error", {}).get("Message", "")
+    return "UniqueRequestToken" in message and "already" in message
+
 
 endpoint_url = {
     "sandbox": "https://mturk-requester-sandbox.us-east-1.amazonaws.com",
     "production": "https://mturk-requester.us-east-1.amazonaws.com",
 }
 
+# Shared mturk clients keyed by (pid, credentials id, credentials version,
+# sandbox). Building a client loads and resolves the service model, so each
+# process does it once per account and endpoint. boto3 clients are safe to
+# share between threads, the pid keeps forked workers from reusing their
+# parent's connections. The version changes when the credentials row or its
+# file is edited, so every process picks up the new keys without being told.
+clients = {}
+clients_lock = threading.Lock()
+
+
+def get_client(credentials=None, sandbox=True):
+    """Shared client for an MturkCredentials row, or for boto3's default
+    credential chain when credentials is None."""
+    credentials_id = getattr(credentials, "id", None)
+    version = credentials.version() if credentials is not None else None
+    key = (os.getpid(), credentials_id, version, bool(sandbox))
+    client = clients.get(key)
+    if client is None:
+        with clients_lock:
+            client = clients.get(key)
+            if client is None:
+                client = make_client(credentials, sandbox)
+                for stale in [k for k in clients if k[1] == credentials_id and k[2] != version]:
+                    del clients[stale]
+                clients[key] = client
+    return client
+
+
+def make_client(credentials=None, sandbox=True):
+    # get_credentials raises rather than fall back to the server's own account
+    keys = credentials.get_credentials() if credentials is not None else {}
+    session = boto3.session.Session(**keys)
+    return session.client(
+        "mturk",
+        region_name="us-east-1",
+        endpoint_url=endpoint_url["sandbox" if sandbox else "production"],
+        config=Config(max_pool_connections=settings.MTURK_MAX_POOL_CONNECTIONS),
+    )
+
+
+def forget_clients(credentials_id=None):
+    """Drop shared clients, only those for credentials_id if given."""
+    with clients_lock:
+        for key in list(clients):
+            if credentials_id is None or key[1] == credentials_id:
+                del clients[key]
+
+
 url_pattern = r"(?:<ExternalURL>)(?P<url>.*)(?:<\/ExternalURL>)"
 
 
+def external_url(question):
+    match = re.search(url_pattern, question or "")
+    if match is None:
+        return None
+    return match.group("url")
+
+
+def battery_id_from_url(url):
+    match = re.search(r"/serve/(\d+)/", url)
+    if match is None:
+        return None
+    return int(match.group(1))
+
+
 # template from boto2
 # https://github.com/boto/boto/blob/70c65b4f67af41ccfd40d21e49880be568997ba6/boto/mturk/question.py
 def generate_question_xml(url, frame_height=0):
@@ -33,6 +132,15 @@ default_qualification = [
 ]
 
 
+def batch_sizes(num_assignments, batch_size=9):
+    """Split num_assignments into HITs of at most batch_size assignments. More
+    than 9 assignments on one HIT raises mturk's fee, so batches stay at 9."""
+    sizes = [batch_size] * (num_assignments // batch_size)
+    if num_assignments % batch_size:
+        sizes.append(num_assignments % batch_size)
+    return sizes
+
+
 def generate_hit(*args, **kwargs):
     hit = {
         "Title": "Default String",
@@ -50,30 +158,71 @@ def generate_hit(*args, **kwargs):
     return hit
 
 
+class RateLimiter:
+    """Spaces calls at least 1/rate seconds apart across threads, a rate of
+    0 turns it off."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next_call = 0.0
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
 class BotoWrapper:
-    def __init__(self, *args, **kwargs):
-        self.client = self.get_client()
+    """Cheap to construct, the underlying client comes from get_client."""
+
+    def __init__(self, credentials=None, sandbox=True, client=None, max_workers=None, max_retries=None, backoff=1.0, rate_limit=None, **kwargs):
+        self.client = client or self.get_client(credentials, sandbox)
+        self.max_workers = max_workers or settings.MTURK_MAX_WORKERS
+        self.max_retries = settings.MTURK_MAX_RETRIES if max_retries is None else max_retries
+        self.backoff = backoff
+        if rate_limit is None:
+            rate_limit = settings.MTURK_REQUESTS_PER_SECOND
+        self.limiter = RateLimiter(rate_limit)
 
     def get_client(self, credentials=None, sandbox=True):
-        session = boto3.Session()
-        return session.client("mturk", endpoint_url=endpoint_url["sandbox"])
+        return get_client(credentials, sandbox)
 
     def get_hits(self, url=None, annotation=None):
         hits = self._consume_paginator("HITs", self.client.list_hits)
         hits_by_url = defaultdict(list)
         for hit in hits:
-            re_url = re.search(url_pattern, hit.get("Question", ""))
-            if re_url is None:
+            hit_url = external_url(hit.get("Question"))
+            if hit_url is None:
                 continue
-            if url is not None and url != re_url.group("url"):
+            if url is not None and url != hit_url:
                 continue
             if (annotation is not None) and (
                 hit.get("RequesterAnnotation") != annotation
             ):
                 continue
-            hits_by_url[re_url.group("url")].append(hit)
+            hits_by_url[hit_url].append(hit)
         return hits_by_url
 
+    def list_all_hits(self):
+        # 100 is the largest page list_hits accepts.
+        return self._consume_paginator("HITs", self.client.list_hits, max_results=100)
+
+    def list_assignments_for_hit(self, hit_id, statuses=None):
+        kwargs = {"AssignmentStatuses": statuses} if statuses else {}
+        return self._consume_paginator(
+            "Assignments",
+            lambda **kw: self._call(self.client.list_assignments_for_hit, **kw),
+            max_results=100,
+            HITId=hit_id,
+            **kwargs,
+        )
+
     def get_active_hits(self, **kwargs):
         hits = self.get_hits(**kwargs)
         for url in hits:
@@ -87,83 +236,137 @@ class BotoWrapper:
     def create_hits_by_url(self, url, num_assignments=9, sandbox=True, *args, **kwargs):
         qxml = generate_question_xml(url)
         hit = generate_hit(Question=qxml, **kwargs)
-        try:
-            return self.create_hit_batches(hit, num_assignments, sandbox)
-        except self.client.exceptions.RequestError as e:
-            return e
-
-    def create_hit_batches(self, hit, num_assignments=9, sandbox=True):
-        created_hits = []
-        total_hits = num_assignments // 9
-        if num_assignments % 9:
-            total_hits += 1
-
-        for i in range(num_assignments // 9):
-            hit["MaxAssignments"] = 9
-            created_hits.append(self.client.create_hit(**hit))
-        if num_assignments % 9:
-            hit["MaxAssignments"] = num_assignments % 9
-            created_hits.append(self.client.create_hit(**hit))
-        return created_hits
+        return self.create_hit_batches(hit, num_assignments, sandbox)
+
+    def create_hit_batches(self, hit, num_assignments=9, sandbox=True, token_prefix=None, skip_tokens=()):
+        """Create the HITs for num_assignments concurrently. With token_prefix
+        each batch is sent with the UniqueRequestToken f"{token_prefix}-{index}"
+        and batches whose token is in skip_tokens are left out, so replaying a
+        partially failed launch only creates what is missing. Returns the
+        create_hit responses, with the token added, and a list of
+        (request, error) for batches that failed.
+        """
+        requests = []
+        for index, size in enumerate(batch_sizes(num_assignments)):
+            request = {**hit, "MaxAssignments": size}
+            if token_prefix is not None:
+                token = f"{token_prefix}-{index}"
+                if token in skip_tokens:
+                    continue
+                request["UniqueRequestToken"] = token
+            requests.append(request)
+
+        def create(request):
+            token = request.get("UniqueRequestToken")
+            if token is None:
+                # without a token a retry after ServiceFault could create a second HIT
+                response = self._call(self.client.create_hit, retry=throttle_codes, **request)
+            else:
+                try:
+                    response = self._call(self.client.create_hit, **request)
+                except botocore.exceptions.ClientError as e:
+                    # replayed after the first attempt went through
+                    match = hit_id_pattern.search(e.response.get("Error", {}).get("Message", ""))
+                    if not token_already_used(e) or match is None:
+                        raise
+                    response = {"HIT": {"HITId": match.group(0)}}
+            response["UniqueRequestToken"] = token or ""
+            return response
+
+        return self._map(create, requests)
 
     def expire_hits_by_id(self, ids):
+        """Expire HITs concurrently, returns the ids that could not be expired."""
         date = datetime(2015, 1, 1)
-        for id in ids:
-            self.client.update_expiration_for_hit(HITId=id, ExpireAt=date)
-        return
+        expired, failed = self._map(
+            lambda id: self._call(
+                self.client.update_expiration_for_hit, HITId=id, ExpireAt=date
+            ),
+            list(ids),
+        )
+        return [id for id, error in failed]
 
     def expire_hits_by_url(self, url, annotation=None):
-        date = datetime(2015, 1, 1)
         hits = self.get_hits()
         if url not in hits:
-            return
-        for hit in hits.get(url, []):
-            if annotation is None:
-                self.client.update_expiration_for_hit(HITId=hit["HITId"], ExpireAt=date)
-            elif hit["RequesterAnnotation"] == annotation:
-                self.client.update_expiration_for_hit(HITId=hit["HITId"], ExpireAt=date)
-        return
+            return []
+        return self.expire_hits_by_id(
+            hit["HITId"]
+            for hit in hits[url]
+            if annotation is None or hit["RequesterAnnotation"] == annotation
+        )
 
     def delete_hits(self, urls, **kwargs):
         hits = self.get_hits(**kwargs)
-        failed = []
         if urls == "all":
             urls = hits.keys()
         elif type(urls) is str:
             urls = [urls]
-        for url in urls:
-            for hit in hits[url]:
-                try:
-                    self.client.delete_hit(HITId=hit["HITId"])
-                except self.client.exceptions.RequestError:
-                    failed.append(hit)
-        return failed
+        to_delete = [hit for url in urls for hit in hits[url]]
+        deleted, failed = self._map(
+            lambda hit: self._call(self.client.delete_hit, HITId=hit["HITId"]),
+            to_delete,
+        )
+        return [hit for hit, error in failed]
 
     def delete_hits_by_id(self, ids):
-        failed = []
         if type(ids) is str:
             ids = [ids]
-        for id in ids:
+        deleted, failed = self._map(
+            lambda id: self._call(self.client.delete_hit, HITId=id), list(ids)
+        )
+        return [id for id, error in failed]
+
+    def _call(self, client_func, retry=retry_codes, **kwargs):
+        """Call client_func under the rate limit, retrying failures whose
+        code is in retry with exponential backoff and jitter."""
+        attempt = 0
+        while True:
+            self.limiter.wait()
             try:
-                self.client.delete_hit(HITId=id)
-            except self.client.exceptions.RequestError:
-                failed.append(id)
-        return failed
+                return client_func(**kwargs)
+            except botocore.exceptions.ClientError as e:
+                code = e.response.get("Error", {}).get("Code")
+                if code not in retry or attempt >= self.max_retries:
+                    raise
+            time.sleep(self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5))
+            attempt += 1
 
-    # list submitted assignments by url
-    def list_assignments(self, url=None, **kwargs):
-        hits = self.get_hits(**kwargs)
-        hits_for_url = hits[url]
-        assignments = []
-        for hit in hits_for_url:
-            assignments.extend(
-                self._consume_paginator(
-                    "Assignments",
-                    self.client.list_assignments_for_hit,
-                    HITId=hit["HITId"],
-                )
-            )
-        return assignments
+    def _map(self, func, items):
+        """Run func over items on at most max_workers threads. Returns the
+        results in item order and a list of (item, exception) for the calls
+        that raised a ClientError."""
+        if not items:
+            return [], []
+
+        def run(item):
+            try:
+                return func(item), None
+            except botocore.exceptions.ClientError as e:
+                return None, e
+
+        workers = min(self.max_workers, len(items))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            outcomes = list(executor.map(run, items))
+        results = [result for result, error in outcomes if error is None]
+        failed = [
+            (item, error) for item, (result, error) in zip(items, outcomes) if error
+        ]
+        return results, failed
+
+    def list_assignments(self, url=None, hit_ids=None, statuses=None, **kwargs):
+        """Assignments for the HITs pointing at url, or for hit_ids when they
+        are known already, optionally only those in statuses. HITs are
+        paged through concurrently."""
+        if hit_ids is None:
+            hit_ids = [hit["HITId"] for hit in self.get_hits(url, **kwargs).get(url, [])]
+        pages, failed = self._map(
+            lambda hit_id: self.list_assignments_for_hit(hit_id, statuses),
+            list(hit_ids),
+        )
+        if failed:
+            raise failed[0][1]
+        return [assignment for page in pages for assignment in page]
 
     def _consume_paginator(self, key, client_func, max_results=30, **kwargs):
         acc = []
@@ -178,14 +381,103 @@ class BotoWrapper:
             next_token = results.get("NextToken", None)
         return acc
 
-    def reject_assignments(self, assignment_ids):
-        return
+    def approve_assignments(self, assignment_ids, feedback=None):
+        """Approve assignments concurrently. Returns the approved ids and
+        (id, error) for the ones that failed."""
+        kwargs = {"RequesterFeedback": feedback} if feedback else {}
+        return self._for_each_id(
+            lambda id: self._call(
+                self.client.approve_assignment, AssignmentId=id, **kwargs
+            ),
+            assignment_ids,
+        )
+
+    def reject_assignments(self, assignment_ids, feedback):
+        """Reject assignments concurrently, mturk requires feedback for
+        rejections. Returns the rejected ids and (id, error) for failures."""
+        return self._for_each_id(
+            lambda id: self._call(
+                self.client.reject_assignment,
+                AssignmentId=id,
+                RequesterFeedback=feedback,
+            ),
+            assignment_ids,
+        )
 
     def approve_assignment_by_url(self, url, worker_id):
-        return
+        assignments = self.list_assignments(url, statuses=["Submitted"])
+        return self.approve_assignments(
+            [a["AssignmentId"] for a in assignments if a["WorkerId"] == worker_id]
+        )
 
     def notify_workers(self, subject, message, worker_ids):
-        return
+        """Message workers, 100 at a time as notify_workers allows. Returns
+        a NotifyWorkersFailureStatuses style entry for every worker that
+        wasn't notified."""
+        worker_ids = list(worker_ids)
+        batches = [worker_ids[i : i + 100] for i in range(0, len(worker_ids), 100)]
+        responses, failed = self._map(
+            lambda batch: self._call(
+                self.client.notify_workers,
+                Subject=subject,
+                MessageText=message,
+                WorkerIds=batch,
+            ),
+            batches,
+        )
+        failures = [
+            status
+            for response in responses
+            for status in response.get("NotifyWorkersFailureStatuses", [])
+        ]
+        for batch, error in failed:
+            failures.extend(
+                {
+                    "WorkerId": worker_id,
+                    "NotifyWorkersFailureCode": "HardFailure",
+                    "NotifyWorkersFailureMessage": str(error),
+                }
+                for worker_id in batch
+            )
+        return failures
+
+    def send_bonuses(self, bonuses):
+        """Send bonuses concurrently, each one a dict of send_bonus keyword
+        arguments which should include a UniqueRequestToken. A token mturk
+        has already seen means the bonus went out on an earlier try. Returns
+        the bonuses that were sent and (bonus, error) for the ones that
+        failed."""
+
+        def send(bonus):
+            try:
+                self._call(self.client.send_bonus, **bonus)
+            except botocore.exceptions.ClientError as e:
+                if not token_already_used(e):
+                    raise
+            return bonus
+
+        return self._map(send, list(bonuses))
+
+    def list_bonus_payments(self, hit_ids):
+        """Every bonus paid on hit_ids, HITs are paged through concurrently."""
+        pages, failed = self._map(
+            lambda hit_id: self._consume_paginator(
+                "BonusPayments",
+                lambda **kw: self._call(self.client.list_bonus_payments, **kw),
+                max_results=100,
+                HITId=hit_id,
+            ),
+            list(hit_ids),
+        )
+        if failed:
+            raise failed[0][1]
+        return [payment for page in pages for payment in page]
+
+    def _for_each_id(self, func, ids):
+        ids = list(ids)
+        results, failed = self._map(func, ids)
+        failed_ids = {id for id, error in failed}
+        return [id for id in ids if id not in failed_ids], failed
 
 
 """
@@ -62,3 +62,31 @@ class HitGroupDetailsForm(forms.ModelForm):
             "description": forms.Textarea(attrs={"cols": 80, "rows": 2}),
             "keywords": forms.TextInput(),
         }
+
+
+class BonusForm(forms.Form):
+    bonus_per_experiment = forms.DecimalField(
+        decimal_places=2, max_digits=10, min_value=0, initial=0
+    )
+    completion_bonus = forms.DecimalField(
+        decimal_places=2, max_digits=10, min_value=0, initial=0,
+        help_text="Paid once every experiment in the battery is completed.",
+    )
+    reason = forms.CharField(
+        required=False,
+        widget=forms.Textarea(attrs={"cols": 80, "rows": 2}),
+        help_text="Shown to workers with the bonus.",
+    )
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.helper = FormHelper()
+        self.helper.form_tag = None
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if not cleaned_data.get("bonus_per_experiment") and not cleaned_data.get(
+            "completion_bonus"
+        ):
+            raise forms.ValidationError("Set a bonus per experiment or a completion bonus.")
+        return cleaned_data
@@ -0,0 +1,79 @@
+# Generated by Django 4.1.3 on 2026-10-18 18:09
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mturk", "0006_alter_hitgroupdetails_qualification_requirements"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MturkHit",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("hit_id", models.TextField(unique=True)),
+                ("hit_type_id", models.TextField(blank=True)),
+                ("sandbox", models.BooleanField(default=True)),
+                ("url", models.TextField(blank=True, db_index=True)),
+                (
+                    "battery_id",
+                    models.IntegerField(blank=True, db_index=True, null=True),
+                ),
+                ("annotation", models.TextField(blank=True, db_index=True)),
+                ("title", models.TextField(blank=True)),
+                ("status", models.TextField(blank=True)),
+                ("review_status", models.TextField(blank=True)),
+                ("max_assignments", models.IntegerField(default=0)),
+                ("assignments_pending", models.IntegerField(default=0)),
+                ("assignments_available", models.IntegerField(default=0)),
+                ("assignments_completed", models.IntegerField(default=0)),
+                ("created", models.DateTimeField(blank=True, null=True)),
+                ("expiration", models.DateTimeField(blank=True, null=True)),
+                ("synced", models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name="MturkAssignment",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("assignment_id", models.TextField(unique=True)),
+                ("worker_id", models.TextField(db_index=True)),
+                ("status", models.TextField(blank=True)),
+                ("accepted", models.DateTimeField(blank=True, null=True)),
+                ("submitted", models.DateTimeField(blank=True, null=True)),
+                ("auto_approval", models.DateTimeField(blank=True, null=True)),
+                ("approved", models.DateTimeField(blank=True, null=True)),
+                ("rejected", models.DateTimeField(blank=True, null=True)),
+                ("deadline", models.DateTimeField(blank=True, null=True)),
+                ("answer", models.TextField(blank=True)),
+                (
+                    "hit",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="assignments",
+                        to="mturk.mturkhit",
+                    ),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,96 @@
+# Generated by Django 4.1.3 on 2026-10-18 18:13
+
+from django.db import migrations, models
+import django.db.models.deletion
+import model_utils.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("experiments", "0033_alter_battery_group"),
+        ("mturk", "0007_mturkhit_mturkassignment"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="mturkapioperation",
+            name="battery",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                to="experiments.battery",
+            ),
+        ),
+        migrations.AddField(
+            model_name="mturkapioperation",
+            name="credentials",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                to="mturk.mturkcredentials",
+            ),
+        ),
+        migrations.AddField(
+            model_name="mturkapioperation",
+            name="errors",
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name="mturkapioperation",
+            name="failed",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="mturkapioperation",
+            name="operation",
+            field=models.TextField(choices=[("review", "review")], default="review"),
+        ),
+        migrations.AddField(
+            model_name="mturkapioperation",
+            name="options",
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AddField(
+            model_name="mturkapioperation",
+            name="sandbox",
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AddField(
+            model_name="mturkapioperation",
+            name="status",
+            field=model_utils.fields.StatusField(
+                choices=[
+                    ("queued", "queued"),
+                    ("running", "running"),
+                    ("completed", "completed"),
+                    ("failed", "failed"),
+                ],
+                default="queued",
+                max_length=100,
+                no_check_for_status=True,
+            ),
+        ),
+        migrations.AddField(
+            model_name="mturkapioperation",
+            name="succeeded",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="mturkapioperation",
+            name="total",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="mturkapioperation",
+            name="updated",
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AlterField(
+            model_name="mturkapioperation",
+            name="response",
+            field=models.TextField(blank=True),
+        ),
+    ]
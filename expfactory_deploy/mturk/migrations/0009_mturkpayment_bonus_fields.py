@@ -0,0 +1,51 @@
+# Generated by Django 4.1.3 on 2026-10-18 18:15
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mturk", "0008_mturkapioperation_progress"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="mturkpayment",
+            name="assignment_id",
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name="mturkpayment",
+            name="operation",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                to="mturk.mturkapioperation",
+            ),
+        ),
+        migrations.AddField(
+            model_name="mturkpayment",
+            name="unique_request_token",
+            field=models.TextField(blank=True, null=True, unique=True),
+        ),
+        migrations.AddField(
+            model_name="mturkpayment",
+            name="worker_id",
+            field=models.TextField(blank=True, db_index=True),
+        ),
+        migrations.AlterField(
+            model_name="mturkapioperation",
+            name="operation",
+            field=models.TextField(
+                choices=[
+                    ("review", "review"),
+                    ("bonus", "bonus"),
+                    ("reconcile", "reconcile"),
+                ],
+                default="review",
+            ),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 4.1.3 on 2026-10-18 18:38
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mturk", "0009_mturkpayment_bonus_fields"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="mturkhit",
+            name="credentials",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                to="mturk.mturkcredentials",
+            ),
+        ),
+    ]
@@ -1,8 +1,14 @@
+import configparser
+import json
+import os
 import uuid
 
 from django.conf import settings
 from django.db import models
 from django.urls import reverse
+from django.utils import timezone
+from model_utils import Choices
+from model_utils.fields import StatusField
 
 from experiments.models import Battery, Subject
 from users.models import Group
@@ -19,6 +25,17 @@ class MturkPayment(models.Model):
     issued = models.DateField(blank=True, null=True)
     amount = models.DecimalField(decimal_places=2, max_digits=10)
     note = models.TextField(blank=True)
+    worker_id = models.TextField(blank=True, db_index=True)
+    assignment_id = models.TextField(blank=True)
+    # sent with send_bonus, a retried bonus reuses its token so mturk won't pay twice
+    unique_request_token = models.TextField(blank=True, null=True, unique=True)
+    operation = models.ForeignKey(
+        "MturkApiOperation", on_delete=models.SET_NULL, blank=True, null=True
+    )
+
+
+class MissingCredentials(Exception):
+    pass
 
 
 class MturkCredentials(models.Model):
@@ -28,17 +45,76 @@ class MturkCredentials(models.Model):
     file_name = models.TextField()
 
     def get_credentials(self):
-        return None
+        """Keys for boto3.Session from file_name, an aws shared credentials
+        file. Uses the section called name if there is one, else default.
+        Raises MissingCredentials when there are no keys to use."""
+        config = configparser.ConfigParser()
+        if not config.read(self.file_name):
+            raise MissingCredentials(f"Can't read credentials file {self.file_name}")
+        section = self.name if config.has_section(self.name) else "default"
+        keys = {
+            key: config.get(section, key)
+            for key in ["aws_access_key_id", "aws_secret_access_key", "aws_session_token"]
+            if config.has_option(section, key)
+        }
+        if not {"aws_access_key_id", "aws_secret_access_key"} <= set(keys):
+            raise MissingCredentials(f"No keys for {self.name} in {self.file_name}")
+        return keys
 
-    def get_client(self):
-        return boto_utils.BotoWrapper(self.get_credentials())
+    def version(self):
+        """Changes whenever the row or the credentials file is edited."""
+        try:
+            mtime = os.stat(self.file_name).st_mtime_ns
+        except OSError:
+            mtime = None
+        return (self.name, self.file_name, mtime)
+
+    def get_client(self, sandbox=True):
+        return boto_utils.BotoWrapper(self, sandbox)
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        boto_utils.forget_clients(self.id)
 
 
 class MturkApiOperation(models.Model):
-    response = models.TextField()
+    """A bulk mturk job run by a celery task. Counts are updated as each
+    chunk of calls finishes so the status page can show progress, and
+    response holds a json summary once it is done.
+    """
+
+    STATUS = Choices("queued", "running", "completed", "failed")
+    OPERATION = Choices("review", "bonus", "reconcile")
+    status = StatusField(default="queued")
+    operation = models.TextField(choices=OPERATION, default=OPERATION.review)
+    response = models.TextField(blank=True)
     created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     group = models.ForeignKey(Group, on_delete=models.CASCADE, null=True)
+    battery = models.ForeignKey(
+        Battery, on_delete=models.SET_NULL, blank=True, null=True
+    )
+    credentials = models.ForeignKey(
+        MturkCredentials, on_delete=models.SET_NULL, blank=True, null=True
+    )
+    sandbox = models.BooleanField(default=True)
+    options = models.JSONField(default=dict, blank=True)
+    total = models.IntegerField(default=0)
+    succeeded = models.IntegerField(default=0)
+    failed = models.IntegerField(default=0)
+    errors = models.JSONField(default=list, blank=True)
+
+    @property
+    def report(self):
+        return json.loads(self.response) if self.response else None
+
+    @property
+    def finished(self):
+        return self.status in [self.STATUS.completed, self.STATUS.failed]
+
+    def get_client(self):
+        return boto_utils.BotoWrapper(self.credentials, self.sandbox)
 
 
 # Group here is not an AWS term, using it to distiguish from HITTypes or HITLayouts
@@ -59,10 +135,11 @@ class HitGroup(models.Model):
     number_of_assignments = models.IntegerField()
 
     def clone(self, battery=None):
+        parent_id = self.pk
         new_hit_group = self
         new_hit_group.pk = None
         new_hit_group.published = None
-        new_hit_group.parent = self
+        new_hit_group.parent_id = parent_id
         if battery:
             new_hit_group.battery = battery
         new_details = self.details
@@ -72,16 +149,41 @@ class HitGroup(models.Model):
         new_hit_group.save()
         return new_hit_group
 
-    def publish(self):
+    def publish(self, client=None):
+        """Create the HITs for this group. Every created HIT is stored as a
+        HitGroupHits row with the UniqueRequestToken it was sent with, so
+        calling publish again after a partial failure only creates the
+        batches that are missing. Returns the (request, error) pairs for
+        batches that failed; published is only set once none do.
+        """
         if self.published:
             raise Exception("This hit group has already been published")
-        if self.credentials:
-            client = self.credentials.get_client()
-        else:
-            client = boto_utils.BotoWrapper()
+        if client is None:
+            client = boto_utils.BotoWrapper(self.credentials, self.sandbox)
         hit = self.details.to_hit_dict()
         url = f'https://0.0.0.0:8000{reverse("experiments:serve-battery", args=[self.battery.pk])}'
-        client.create_hits_by_url(url, self.number_of_assignments, **hit)
+        qxml = boto_utils.generate_question_xml(url)
+        created, failed = client.create_hit_batches(
+            boto_utils.generate_hit(Question=qxml, **hit),
+            self.number_of_assignments,
+            # clones share their details' annotation, the pk keeps tokens apart
+            token_prefix=f"{self.pk}-{self.details.request_annotation}",
+            skip_tokens=set(
+                self.hitgrouphits_set.values_list("unique_request_token", flat=True)
+            ),
+        )
+        HitGroupHits.objects.bulk_create(
+            HitGroupHits(
+                hit_group=self,
+                hit_id=response["HIT"]["HITId"],
+                unique_request_token=response["UniqueRequestToken"],
+            )
+            for response in created
+        )
+        if not failed:
+            self.published = timezone.now()
+            self.save(update_fields=["published"])
+        return failed
 def default_quals():
     return boto_utils.default_qualification
 
@@ -120,6 +222,95 @@ class HitGroupHits(models.Model):
     unique_request_token = models.TextField(blank=True)
 
 
+def values_from_api(model, response):
+    """Field values for model from an mturk api response, using the
+    model's api_fields mapping. Missing keys get the field default."""
+    values = {}
+    for field, key in model.api_fields.items():
+        value = response.get(key)
+        if value is None:
+            value = model._meta.get_field(field).get_default()
+        values[field] = value
+    return values
+
+
+# Local copies of what list_hits and list_assignments_for_hit return, kept up
+# to date by mturk.tasks.sync_mturk_hits so the list views don't page through
+# every HIT the account has created on each request.
+class MturkHit(models.Model):
+    hit_id = models.TextField(unique=True)
+    hit_type_id = models.TextField(blank=True)
+    sandbox = models.BooleanField(default=True)
+    # account the HIT was listed from, None for boto3's default credentials
+    credentials = models.ForeignKey(
+        MturkCredentials, on_delete=models.CASCADE, blank=True, null=True
+    )
+    url = models.TextField(blank=True, db_index=True)
+    battery_id = models.IntegerField(blank=True, null=True, db_index=True)
+    annotation = models.TextField(blank=True, db_index=True)
+    title = models.TextField(blank=True)
+    status = models.TextField(blank=True)
+    review_status = models.TextField(blank=True)
+    max_assignments = models.IntegerField(default=0)
+    assignments_pending = models.IntegerField(default=0)
+    assignments_available = models.IntegerField(default=0)
+    assignments_completed = models.IntegerField(default=0)
+    created = models.DateTimeField(blank=True, null=True)
+    expiration = models.DateTimeField(blank=True, null=True)
+    synced = models.DateTimeField(blank=True, null=True)
+
+    # MturkHit field -> key in the list_hits response
+    api_fields = {
+        "hit_type_id": "HITTypeId",
+        "annotation": "RequesterAnnotation",
+        "title": "Title",
+        "status": "HITStatus",
+        "review_status": "HITReviewStatus",
+        "max_assignments": "MaxAssignments",
+        "assignments_pending": "NumberOfAssignmentsPending",
+        "assignments_available": "NumberOfAssignmentsAvailable",
+        "assignments_completed": "NumberOfAssignmentsCompleted",
+        "created": "CreationTime",
+        "expiration": "Expiration",
+    }
+
+    @classmethod
+    def values_from_api(cls, hit):
+        return values_from_api(cls, hit)
+
+
+class MturkAssignment(models.Model):
+    assignment_id = models.TextField(unique=True)
+    hit = models.ForeignKey(
+        MturkHit, on_delete=models.CASCADE, related_name="assignments"
+    )
+    worker_id = models.TextField(db_index=True)
+    status = models.TextField(blank=True)
+    accepted = models.DateTimeField(blank=True, null=True)
+    submitted = models.DateTimeField(blank=True, null=True)
+    auto_approval = models.DateTimeField(blank=True, null=True)
+    approved = models.DateTimeField(blank=True, null=True)
+    rejected = models.DateTimeField(blank=True, null=True)
+    deadline = models.DateTimeField(blank=True, null=True)
+    answer = models.TextField(blank=True)
+
+    api_fields = {
+        "worker_id": "WorkerId",
+        "status": "AssignmentStatus",
+        "accepted": "AcceptTime",
+        "submitted": "SubmitTime",
+        "auto_approval": "AutoApprovalTime",
+        "approved": "ApprovalTime",
+        "rejected": "RejectionTime",
+        "deadline": "Deadline",
+        "answer": "Answer",
+    }
+
+    @classmethod
+    def values_from_api(cls, assignment):
+        return values_from_api(cls, assignment)
+
+
 """
   "Title": String,
   "Description": String,
@@ -0,0 +1,261 @@
+import json
+from collections import Counter
+from decimal import Decimal
+
+from django.db.models import Count, Sum
+from django.utils import timezone
+
+from experiments import models as exp_models
+from mturk import boto_utils
+from mturk import models as models
+from mturk.review import battery_hit_ids, chunks
+
+"""
+Bonus payments for mturk batteries. A subject earns bonus_per_experiment for
+each experiment they have a completed Result for, plus completion_bonus once
+every experiment in the battery is done. What MturkPayment already records
+for the battery is subtracted, so running payments again only sends what is
+still owed. Workers are matched to subjects by Subject.handle as in
+mturk.review, subjects with no assignment on the battery's HITs are skipped.
+
+mturk only honours a UniqueRequestToken for 24 hours, so a payment row is
+written with its token before the bonus is sent and only marked issued once
+mturk confirms it. Rows left pending by a failed or interrupted run are
+checked against mturk's bonus list on the next run and sent again with the
+same token if mturk has no record of them.
+"""
+
+cent = Decimal("0.01")
+default_reason = "Bonus for the experiments you completed."
+
+
+def owed_bonuses(battery_id, bonus_per_experiment, completion_bonus=0):
+    """{subject id: (handle, owed, already paid)} for every subject on the
+    battery that is still owed something. Pending payments count as paid."""
+    experiments = exp_models.BatteryExperiments.objects.filter(
+        battery=battery_id
+    ).count()
+    completed = (
+        exp_models.Result.objects.filter(
+            battery_experiment__battery=battery_id,
+            status=exp_models.Result.STATUS.completed,
+        )
+        .exclude(subject=None)
+        .values_list("subject", "subject__handle")
+        .annotate(count=Count("battery_experiment", distinct=True))
+    )
+    paid = dict(
+        models.MturkPayment.objects.filter(battery=battery_id)
+        .values_list("subject")
+        .annotate(Sum("amount"))
+    )
+    owed = {}
+    for subject_id, handle, count in completed:
+        earned = Decimal(bonus_per_experiment) * count
+        if experiments and count >= experiments:
+            earned += Decimal(completion_bonus)
+        already_paid = paid.get(subject_id) or Decimal(0)
+        amount = (earned - already_paid).quantize(cent)
+        if amount > 0:
+            owed[subject_id] = (handle, amount, already_paid)
+    return owed
+
+
+def bonus_token(battery_id, subject_id, already_paid, operation_id):
+    """UniqueRequestToken for a new bonus, stored on its payment row so a
+    retry sends the same one. The operation id keeps a bonus that mturk
+    refused from reusing its token when it is owed again later."""
+    return (
+        f"expfactory-bonus-{battery_id}-{subject_id}-"
+        f"{Decimal(already_paid).quantize(cent)}-{operation_id}"
+    )
+
+
+def payment_key(worker_id, assignment_id, amount):
+    return (worker_id, assignment_id, Decimal(amount).quantize(cent))
+
+
+def confirm_pending(client, battery_id, sandbox=True):
+    """Mark pending payments that mturk lists as paid issued. Returns the
+    pending payments mturk has no record of, these still need sending."""
+    payments = models.MturkPayment.objects.filter(battery=battery_id)
+    pending = list(
+        payments.filter(issued=None).exclude(unique_request_token=None).order_by("id")
+    )
+    if not pending:
+        return []
+    remote = Counter(
+        payment_key(bonus["WorkerId"], bonus["AssignmentId"], bonus["BonusAmount"])
+        for bonus in client.list_bonus_payments(battery_hit_ids(battery_id, sandbox))
+    )
+    for payment in payments.exclude(issued=None):
+        remote[payment_key(payment.worker_id, payment.assignment_id, payment.amount)] -= 1
+    confirmed = []
+    unsent = []
+    for payment in pending:
+        key = payment_key(payment.worker_id, payment.assignment_id, payment.amount)
+        if remote[key] > 0:
+            remote[key] -= 1
+            confirmed.append(payment.id)
+        else:
+            unsent.append(payment)
+    models.MturkPayment.objects.filter(id__in=confirmed).update(
+        issued=timezone.now().date()
+    )
+    return unsent
+
+
+def worker_assignments(client, hit_ids):
+    """{worker id: assignment} for the battery's HITs, bonuses have to name
+    an assignment. Approved assignments are preferred over submitted ones."""
+    assignments = {}
+    for assignment in client.list_assignments(
+        hit_ids=hit_ids, statuses=["Approved", "Submitted"]
+    ):
+        current = assignments.get(assignment["WorkerId"])
+        if current is None or current["AssignmentStatus"] != "Approved":
+            assignments[assignment["WorkerId"]] = assignment
+    return assignments
+
+
+def bonus_request(payment):
+    return {
+        "WorkerId": payment.worker_id,
+        "BonusAmount": str(payment.amount),
+        "AssignmentId": payment.assignment_id,
+        "Reason": payment.note,
+        "UniqueRequestToken": payment.unique_request_token,
+    }
+
+
+def run_payments(operation, client=None, chunk_size=100):
+    """Send every bonus owed on the operation's battery, chunk_size at a
+    time, after resending any left pending by an earlier run. Payments
+    mturk refuses are deleted so they are owed again, ones that failed in a
+    way that may still have paid, e.g. a ServiceFault, stay pending."""
+    client = client or operation.get_client()
+    options = operation.options
+    reason = options.get("reason") or default_reason
+    hit_ids = battery_hit_ids(operation.battery_id, operation.sandbox)
+    payments = confirm_pending(client, operation.battery_id, operation.sandbox)
+    owed = owed_bonuses(
+        operation.battery_id,
+        options.get("bonus_per_experiment", 0),
+        options.get("completion_bonus", 0),
+    )
+    assignments = worker_assignments(client, hit_ids) if owed else {}
+
+    unmatched = []
+    new_payments = []
+    for subject_id, (handle, amount, already_paid) in owed.items():
+        assignment = assignments.get(handle)
+        if assignment is None:
+            unmatched.append(handle)
+            continue
+        new_payments.append(
+            models.MturkPayment(
+                battery_id=operation.battery_id,
+                subject_id=subject_id,
+                hit=assignment["HITId"],
+                amount=amount,
+                note=reason,
+                worker_id=handle,
+                assignment_id=assignment["AssignmentId"],
+                unique_request_token=bonus_token(
+                    operation.battery_id, subject_id, already_paid, operation.id
+                ),
+                operation=operation,
+            )
+        )
+    # recorded before anything is sent, a crash mid chunk leaves them pending
+    models.MturkPayment.objects.bulk_create(new_payments)
+    payments += new_payments
+    by_token = {payment.unique_request_token: payment for payment in payments}
+    operation.total = len(payments)
+    operation.save(update_fields=["total", "updated"])
+
+    total_paid = Decimal(0)
+    pending = 0
+    for chunk in chunks(payments, chunk_size):
+        sent, failed = client.send_bonuses([bonus_request(p) for p in chunk])
+        issued = [by_token[bonus["UniqueRequestToken"]] for bonus in sent]
+        models.MturkPayment.objects.filter(id__in=[p.id for p in issued]).update(
+            issued=timezone.now().date()
+        )
+        refused = [
+            by_token[bonus["UniqueRequestToken"]].id
+            for bonus, error in failed
+            if error.response.get("Error", {}).get("Code") not in boto_utils.retry_codes
+        ]
+        models.MturkPayment.objects.filter(id__in=refused).delete()
+        pending += len(failed) - len(refused)
+        total_paid += sum((payment.amount for payment in issued), Decimal(0))
+        operation.succeeded += len(sent)
+        operation.failed += len(failed)
+        operation.errors.extend(
+            {"subject_id": by_token[bonus["UniqueRequestToken"]].subject_id, "error": str(error)}
+            for bonus, error in failed
+        )
+        operation.save(update_fields=["succeeded", "failed", "errors", "updated"])
+
+    operation.response = json.dumps(
+        {
+            "bonuses": operation.succeeded,
+            "paid": str(total_paid),
+            "pending": pending,
+            "unmatched": unmatched,
+        }
+    )
+    operation.status = models.MturkApiOperation.STATUS.completed
+    operation.save(update_fields=["response", "status", "updated"])
+    return operation
+
+
+def reconcile_payments(client, battery_id, sandbox=True):
+    """Compare the MturkPayment rows for a battery with the bonuses mturk
+    reports for its HITs, matching on worker, assignment and amount.
+    Payments entered by hand without a worker id can't be matched and are
+    left out.
+    """
+    remote = client.list_bonus_payments(battery_hit_ids(battery_id, sandbox))
+    unmatched = Counter(
+        (bonus["WorkerId"], bonus["AssignmentId"], Decimal(bonus["BonusAmount"]).quantize(cent))
+        for bonus in remote
+    )
+    matched = 0
+    missing = []
+    recorded = Decimal(0)
+    for payment in models.MturkPayment.objects.filter(battery=battery_id).exclude(
+        worker_id=""
+    ):
+        recorded += payment.amount
+        key = (payment.worker_id, payment.assignment_id, payment.amount.quantize(cent))
+        if unmatched[key] > 0:
+            unmatched[key] -= 1
+            matched += 1
+        else:
+            missing.append(payment.id)
+    unrecorded = [
+        {"worker_id": worker_id, "assignment_id": assignment_id, "amount": str(amount)}
+        for (worker_id, assignment_id, amount), count in unmatched.items()
+        for i in range(count)
+    ]
+    return {
+        "matched": matched,
+        "missing_on_mturk": missing,
+        "unrecorded": unrecorded,
+        "recorded_total": str(recorded),
+        "mturk_total": str(sum((Decimal(b["BonusAmount"]) for b in remote), Decimal(0))),
+    }
+
+
+def run_reconcile(operation, client=None):
+    client = client or operation.get_client()
+    report = reconcile_payments(client, operation.battery_id, operation.sandbox)
+    operation.total = report["matched"] + len(report["missing_on_mturk"]) + len(report["unrecorded"])
+    operation.succeeded = report["matched"]
+    operation.failed = operation.total - operation.succeeded
+    operation.response = json.dumps(report)
+    operation.status = models.MturkApiOperation.STATUS.completed
+    operation.save()
+    return operation
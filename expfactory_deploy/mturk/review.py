@@ -0,0 +1,129 @@
+import json
+
+from django.db.models import Count, Q
+
+from experiments import models as exp_models
+from mturk import models as models
+
+"""
+Bulk review of submitted mturk assignments. Workers are matched to local
+subjects by Subject.handle, which Serve sets to the workerId mturk passes to
+serve/<battery_id>/. Workers with no local Assignment are never rejected,
+they are skipped and reported as unmatched.
+"""
+
+default_rejection_feedback = "The experiment battery was not completed."
+
+
+def battery_hit_ids(battery_id, sandbox=True):
+    """HITs created for battery_id, from the HitGroupHits written when
+    publishing and from the mirror for HITs made some other way."""
+    published = models.HitGroupHits.objects.filter(
+        hit_group__battery=battery_id, hit_group__sandbox=sandbox
+    ).values_list("hit_id", flat=True)
+    mirrored = models.MturkHit.objects.filter(
+        battery_id=battery_id, sandbox=sandbox
+    ).values_list("hit_id", flat=True)
+    return set(published) | set(mirrored)
+
+
+def local_completion(battery_id, worker_ids):
+    """{worker id: completed} for workers with an Assignment to the battery,
+    in one query. An assignment counts as complete when its status says so
+    or when it has a completed Result for every experiment in the battery.
+    """
+    rows = (
+        exp_models.Assignment.objects.filter(
+            battery=battery_id, subject__handle__in=worker_ids
+        )
+        .annotate(
+            experiments=Count("battery__batteryexperiments", distinct=True),
+            results_completed=Count(
+                "result",
+                filter=Q(result__status=exp_models.Result.STATUS.completed),
+                distinct=True,
+            ),
+        )
+        .values_list("subject__handle", "status", "experiments", "results_completed")
+    )
+    completion = {}
+    for handle, status, experiments, results_completed in rows:
+        completed = status == exp_models.Assignment.STATUS.completed or (
+            experiments > 0 and results_completed >= experiments
+        )
+        completion[handle] = completion.get(handle, False) or completed
+    return completion
+
+
+def review_decisions(battery_id, assignments, reject_incomplete=False):
+    """Split submitted mturk assignments into (approve, reject, skip) lists
+    of assignment ids, and the worker ids with no local Assignment. Only an
+    incomplete local Assignment is rejected, and only when asked to,
+    otherwise it is left for mturk's auto approval or a manual decision.
+    Unmatched workers are skipped.
+    """
+    completion = local_completion(battery_id, {a["WorkerId"] for a in assignments})
+    approve, reject, skip, unmatched = [], [], [], []
+    for assignment in assignments:
+        completed = completion.get(assignment["WorkerId"])
+        if completed is None:
+            skip.append(assignment["AssignmentId"])
+            unmatched.append(assignment["WorkerId"])
+        elif completed:
+            approve.append(assignment["AssignmentId"])
+        elif reject_incomplete:
+            reject.append(assignment["AssignmentId"])
+        else:
+            skip.append(assignment["AssignmentId"])
+    return approve, reject, skip, unmatched
+
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
+
+def run_review(operation, client=None, chunk_size=100):
+    """Approve or reject every submitted assignment on the operation's
+    battery. Progress is saved on the operation after each chunk."""
+    client = client or operation.get_client()
+    options = operation.options
+    submitted = client.list_assignments(
+        hit_ids=battery_hit_ids(operation.battery_id, operation.sandbox),
+        statuses=["Submitted"],
+    )
+    approve, reject, skip, unmatched = review_decisions(
+        operation.battery_id, submitted, options.get("reject_incomplete", False)
+    )
+    operation.total = len(approve) + len(reject)
+    operation.save(update_fields=["total", "updated"])
+
+    feedback = options.get("feedback") or default_rejection_feedback
+    actions = [
+        (approve, "Approved", lambda ids: client.approve_assignments(ids)),
+        (reject, "Rejected", lambda ids: client.reject_assignments(ids, feedback)),
+    ]
+    for ids, status, action in actions:
+        for chunk in chunks(ids, chunk_size):
+            done, failed = action(chunk)
+            models.MturkAssignment.objects.filter(assignment_id__in=done).update(
+                status=status
+            )
+            operation.succeeded += len(done)
+            operation.failed += len(failed)
+            operation.errors.extend(
+                {"assignment_id": id, "error": str(error)} for id, error in failed
+            )
+            operation.save(update_fields=["succeeded", "failed", "errors", "updated"])
+
+    operation.response = json.dumps(
+        {
+            "approved": len(approve),
+            "rejected": len(reject),
+            "skipped": len(skip),
+            "unmatched": unmatched,
+        }
+    )
+    operation.status = models.MturkApiOperation.STATUS.completed
+    operation.save(update_fields=["response", "status", "updated"])
+    return operation
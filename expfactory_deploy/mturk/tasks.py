@@ -0,0 +1,165 @@
+import botocore
+from django.utils import timezone
+
+from config import celery_app
+from mturk import boto_utils, payments, review
+from mturk import models as models
+
+
+def sync_hits(client, sandbox=True, credentials=None):
+    """Bring the MturkHit mirror for one account and endpoint in line with
+    list_hits. Only rows whose fields changed are written, and assignments
+    are only listed again for HITs whose assignment counts moved since the
+    last sync. HITs mturk no longer returns (deleted) are removed along with
+    their assignments. hit_id is unique across accounts, so HITs already
+    mirrored under another account, e.g. the same AWS keys configured twice,
+    are left with that account and counted as conflicts.
+    """
+    MturkHit = models.MturkHit
+    now = timezone.now()
+    existing = {
+        hit.hit_id: hit
+        for hit in MturkHit.objects.filter(sandbox=sandbox, credentials=credentials)
+    }
+    created = []
+    changed = []
+    refresh = set()
+    for response in client.list_all_hits():
+        values = MturkHit.values_from_api(response)
+        hit = existing.pop(response["HITId"], None)
+        if hit is None:
+            url = boto_utils.external_url(response.get("Question")) or ""
+            hit = MturkHit(
+                hit_id=response["HITId"],
+                sandbox=sandbox,
+                credentials=credentials,
+                url=url,
+                battery_id=boto_utils.battery_id_from_url(url),
+                synced=now,
+                **values,
+            )
+            created.append(hit)
+            if hit.assignments_available < hit.max_assignments:
+                refresh.add(hit.hit_id)
+            continue
+        counts = assignment_counts(hit)
+        if any(getattr(hit, field) != value for field, value in values.items()):
+            for field, value in values.items():
+                setattr(hit, field, value)
+            hit.synced = now
+            changed.append(hit)
+            if assignment_counts(hit) != counts:
+                refresh.add(hit.hit_id)
+
+    conflicts = set(
+        MturkHit.objects.filter(hit_id__in=[hit.hit_id for hit in created]).values_list(
+            "hit_id", flat=True
+        )
+    )
+    created = [hit for hit in created if hit.hit_id not in conflicts]
+    refresh -= conflicts
+    MturkHit.objects.bulk_create(created, ignore_conflicts=True)
+    MturkHit.objects.bulk_update(changed, [*MturkHit.api_fields, "synced"])
+    MturkHit.objects.filter(id__in=[hit.id for hit in existing.values()]).delete()
+
+    assignments = 0
+    for hit in MturkHit.objects.filter(
+        hit_id__in=refresh, sandbox=sandbox, credentials=credentials
+    ):
+        assignments += sync_assignments(client, hit)
+    return {
+        "created": len(created),
+        "updated": len(changed),
+        "removed": len(existing),
+        "conflicts": len(conflicts),
+        "assignments": assignments,
+    }
+
+
+def assignment_counts(hit):
+    return (
+        hit.assignments_pending,
+        hit.assignments_available,
+        hit.assignments_completed,
+    )
+
+
+def sync_assignments(client, hit):
+    """Mirror every assignment for a single HIT, returns how many were
+    created or updated."""
+    MturkAssignment = models.MturkAssignment
+    existing = {
+        assignment.assignment_id: assignment for assignment in hit.assignments.all()
+    }
+    created = []
+    changed = []
+    for response in client.list_assignments_for_hit(hit.hit_id):
+        values = MturkAssignment.values_from_api(response)
+        assignment = existing.get(response["AssignmentId"])
+        if assignment is None:
+            created.append(
+                MturkAssignment(
+                    assignment_id=response["AssignmentId"], hit=hit, **values
+                )
+            )
+        elif any(getattr(assignment, field) != value for field, value in values.items()):
+            for field, value in values.items():
+                setattr(assignment, field, value)
+            changed.append(assignment)
+    MturkAssignment.objects.bulk_create(created, ignore_conflicts=True)
+    MturkAssignment.objects.bulk_update(changed, list(MturkAssignment.api_fields))
+    return len(created) + len(changed)
+
+
+def mturk_accounts():
+    """(credentials, sandbox) for every account and endpoint HITs were
+    published with, and the default credentials on the sandbox."""
+    accounts = {(None, True)}
+    for hit_group in models.HitGroup.objects.exclude(published=None).select_related(
+        "credentials"
+    ):
+        accounts.add((hit_group.credentials, hit_group.sandbox))
+    return accounts
+
+
+@celery_app.task()
+def sync_mturk_hits():
+    """Periodic entry point for refreshing the MturkHit mirror of every
+    account. One account failing, e.g. with missing credentials, doesn't
+    stop the others."""
+    reports = {}
+    for credentials, sandbox in mturk_accounts():
+        label = f"{credentials.name if credentials else 'default'} {'sandbox' if sandbox else 'production'}"
+        try:
+            client = boto_utils.BotoWrapper(credentials, sandbox)
+            reports[label] = sync_hits(client, sandbox, credentials)
+        except (models.MissingCredentials, botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError) as e:
+            reports[label] = {"error": str(e)}
+    return reports
+
+
+OPERATION_RUNNERS = {
+    "review": review.run_review,
+    "bonus": payments.run_payments,
+    "reconcile": payments.run_reconcile,
+}
+
+
+@celery_app.task(soft_time_limit=30 * 60, time_limit=31 * 60)
+def run_api_operation(operation_id):
+    """Run a queued MturkApiOperation, claimed by moving it from queued to
+    running so it only runs once."""
+    Operation = models.MturkApiOperation
+    claimed = Operation.objects.filter(
+        id=operation_id, status=Operation.STATUS.queued
+    ).update(status=Operation.STATUS.running)
+    operation = Operation.objects.get(id=operation_id)
+    if not claimed:
+        return operation.status
+    try:
+        OPERATION_RUNNERS[operation.operation](operation)
+    except Exception as e:
+        operation.status = Operation.STATUS.failed
+        operation.errors.append({"error": str(e)})
+        operation.save(update_fields=["status", "errors", "updated"])
+    return operation.status
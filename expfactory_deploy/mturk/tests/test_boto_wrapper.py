@@ -0,0 +1,421 @@
+import tempfile
+import time
+from datetime import datetime
+from decimal import Decimal
+
+import boto3
+from botocore.stub import Stubber
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+
+from experiments.models import Assignment, Result, Subject
+from experiments.tests.factories import make_battery
+from mturk import boto_utils, models, payments, review
+
+
+def created_hit(hit_id):
+    return {"HIT": {"HITId": hit_id, "CreationTime": datetime(2024, 1, 1)}}
+
+
+class StubbedClientTestCase(TestCase):
+    def setUp(self):
+        client = boto3.client(
+            "mturk",
+            region_name="us-east-1",
+            aws_access_key_id="test",
+            aws_secret_access_key="test",
+        )
+        self.stubber = Stubber(client)
+        self.stubber.activate()
+        self.wrapper = boto_utils.BotoWrapper(
+            client=client, max_workers=1, max_retries=2, backoff=0, rate_limit=0
+        )
+
+    def tearDown(self):
+        self.stubber.deactivate()
+
+    def hit(self):
+        return boto_utils.generate_hit(
+            Question=boto_utils.generate_question_xml("https://example.com/serve/1/")
+        )
+
+
+class BotoWrapperTests(StubbedClientTestCase):
+    def test_batch_sizes(self):
+        self.assertEqual(boto_utils.batch_sizes(20), [9, 9, 2])
+        self.assertEqual(boto_utils.batch_sizes(18), [9, 9])
+        self.assertEqual(boto_utils.batch_sizes(0), [])
+
+    def test_rate_limiter_spaces_calls(self):
+        limiter = boto_utils.RateLimiter(100)
+        start = time.monotonic()
+        for i in range(5):
+            limiter.wait()
+        self.assertGreaterEqual(time.monotonic() - start, 0.04)
+
+    def test_throttled_calls_are_retried(self):
+        self.stubber.add_client_error("create_hit", "ThrottlingException")
+        self.stubber.add_response("create_hit", created_hit("a"))
+        created, failed = self.wrapper.create_hit_batches(self.hit(), 9, token_prefix="t")
+        self.stubber.assert_no_pending_responses()
+        self.assertEqual(failed, [])
+        self.assertEqual(created[0]["HIT"]["HITId"], "a")
+        self.assertEqual(created[0]["UniqueRequestToken"], "t-0")
+
+    def test_gives_up_after_max_retries(self):
+        for i in range(3):
+            self.stubber.add_client_error("create_hit", "ThrottlingException")
+        created, failed = self.wrapper.create_hit_batches(self.hit(), 9)
+        self.stubber.assert_no_pending_responses()
+        self.assertEqual(created, [])
+        self.assertEqual(len(failed), 1)
+
+    def test_request_errors_are_not_retried(self):
+        self.stubber.add_client_error("delete_hit", "RequestError")
+        self.stubber.add_response("delete_hit", {}, {"HITId": "b"})
+        self.assertEqual(self.wrapper.delete_hits_by_id(["a", "b"]), ["a"])
+        self.stubber.assert_no_pending_responses()
+
+    def test_expire_runs_concurrently(self):
+        self.wrapper.max_workers = 4
+        for i in range(4):
+            self.stubber.add_response("update_expiration_for_hit", {})
+        self.assertEqual(self.wrapper.expire_hits_by_id(["a", "b", "c", "d"]), [])
+        self.stubber.assert_no_pending_responses()
+
+    def test_publish_replays_only_missing_batches(self):
+        battery = make_battery(1)
+        details = models.HitGroupDetails.objects.create(
+            title="test", description="test", reward="1.00"
+        )
+        hit_group = models.HitGroup.objects.create(
+            battery=battery, details=details, number_of_assignments=20
+        )
+        self.stubber.add_response("create_hit", created_hit("a"))
+        self.stubber.add_response("create_hit", created_hit("b"))
+        self.stubber.add_client_error("create_hit", "RequestError")
+        failed = hit_group.publish(client=self.wrapper)
+        self.assertEqual(len(failed), 1)
+        self.assertIsNone(hit_group.published)
+
+        self.stubber.add_response("create_hit", created_hit("c"))
+        self.assertEqual(hit_group.publish(client=self.wrapper), [])
+        self.stubber.assert_no_pending_responses()
+        self.assertIsNotNone(hit_group.published)
+        tokens = dict(hit_group.hitgrouphits_set.values_list("unique_request_token", "hit_id"))
+        self.assertEqual(
+            tokens,
+            {f"{hit_group.pk}-{details.request_annotation}-{i}": hit_id for i, hit_id in enumerate("abc")},
+        )
+
+        clone = hit_group.clone()
+        self.stubber.add_response("create_hit", created_hit("d"))
+        self.stubber.add_response("create_hit", created_hit("e"))
+        self.stubber.add_response("create_hit", created_hit("f"))
+        self.assertEqual(clone.publish(client=self.wrapper), [])
+        self.assertEqual(
+            sorted(clone.hitgrouphits_set.values_list("unique_request_token", flat=True))[0],
+            f"{clone.pk}-{details.request_annotation}-0",
+        )
+
+    def test_replayed_token_counts_as_created(self):
+        hit_id = "3" * 30
+        self.stubber.add_client_error(
+            "create_hit",
+            "RequestError",
+            f"The HIT with ID {hit_id} already exists.",
+            modeled_fields={"TurkErrorCode": "AWS.MechanicalTurk.HitAlreadyExists"},
+        )
+        created, failed = self.wrapper.create_hit_batches(self.hit(), 9, token_prefix="t")
+        self.assertEqual(failed, [])
+        self.assertEqual(created, [{"HIT": {"HITId": hit_id}, "UniqueRequestToken": "t-0"}])
+
+    def test_create_without_token_is_not_retried_after_service_fault(self):
+        self.stubber.add_client_error("create_hit", "ServiceFault", http_status_code=500)
+        created, failed = self.wrapper.create_hit_batches(self.hit(), 9)
+        self.stubber.assert_no_pending_responses()
+        self.assertEqual(len(failed), 1)
+
+
+class ClientRegistryTests(TestCase):
+    def setUp(self):
+        self.addCleanup(boto_utils.forget_clients)
+        self.credentials_file = tempfile.NamedTemporaryFile("w", suffix=".ini")
+        self.credentials_file.write(
+            "[default]\naws_access_key_id = default_id\naws_secret_access_key = default_secret\n"
+            "[lab]\naws_access_key_id = lab_id\naws_secret_access_key = lab_secret\n"
+        )
+        self.credentials_file.flush()
+        self.addCleanup(self.credentials_file.close)
+        user = get_user_model().objects.create(username="requester")
+        self.credentials = models.MturkCredentials.objects.create(
+            user=user, name="lab", file_name=self.credentials_file.name
+        )
+
+    def test_reads_named_section(self):
+        self.assertEqual(
+            self.credentials.get_credentials(),
+            {"aws_access_key_id": "lab_id", "aws_secret_access_key": "lab_secret"},
+        )
+        self.credentials.name = "other"
+        self.assertEqual(
+            self.credentials.get_credentials()["aws_access_key_id"], "default_id"
+        )
+
+    def test_clients_are_shared_per_credentials_and_endpoint(self):
+        client = self.credentials.get_client().client
+        self.assertIs(self.credentials.get_client().client, client)
+        self.assertIs(boto_utils.BotoWrapper(self.credentials).client, client)
+        self.assertEqual(client.meta.endpoint_url, boto_utils.endpoint_url["sandbox"])
+        self.assertEqual(client._request_signer._credentials.access_key, "lab_id")
+
+        production = self.credentials.get_client(sandbox=False).client
+        self.assertIsNot(production, client)
+        self.assertEqual(production.meta.endpoint_url, boto_utils.endpoint_url["production"])
+
+    def test_saving_credentials_drops_their_clients(self):
+        client = self.credentials.get_client().client
+        self.credentials.save()
+        self.assertIsNot(self.credentials.get_client().client, client)
+
+    def test_edits_from_other_processes_are_picked_up(self):
+        client = self.credentials.get_client().client
+        # saved elsewhere, forget_clients never ran here
+        models.MturkCredentials.objects.filter(id=self.credentials.id).update(name="default")
+        edited = models.MturkCredentials.objects.get(id=self.credentials.id).get_client().client
+        self.assertIsNot(edited, client)
+        self.assertEqual(edited._request_signer._credentials.access_key, "default_id")
+
+    def test_missing_credentials_raise(self):
+        self.credentials.file_name = "/nonexistent/credentials"
+        with self.assertRaises(models.MissingCredentials):
+            self.credentials.get_client()
+        with tempfile.NamedTemporaryFile("w", suffix=".ini") as empty:
+            empty.write("[other]\naws_access_key_id = other_id\n")
+            empty.flush()
+            self.credentials.file_name = empty.name
+            with self.assertRaises(models.MissingCredentials):
+                self.credentials.get_credentials()
+
+
+class ReviewTests(StubbedClientTestCase):
+    def test_notify_workers_batches_by_100(self):
+        worker_ids = [f"w{i}" for i in range(250)]
+        for batch in [worker_ids[:100], worker_ids[100:200], worker_ids[200:]]:
+            self.stubber.add_response(
+                "notify_workers",
+                {"NotifyWorkersFailureStatuses": []},
+                {"Subject": "s", "MessageText": "m", "WorkerIds": batch},
+            )
+        self.assertEqual(self.wrapper.notify_workers("s", "m", worker_ids), [])
+        self.stubber.assert_no_pending_responses()
+
+    def test_run_review(self):
+        battery = make_battery(1)
+        batt_exp = battery.batteryexperiments_set.get()
+        # w5 has no local assignment, e.g. they never reached the battery
+        for handle, status in [
+            ("w1", "completed"), ("w2", "started"), ("w3", "started"), ("w4", "started")
+        ]:
+            assignment = Assignment.objects.create(
+                subject=Subject.objects.create(handle=handle), battery=battery, status=status
+            )
+        # w4's assignment is marked started but every experiment has a result
+        Result.objects.create(
+            assignment=assignment,
+            battery_experiment=batt_exp,
+            subject=assignment.subject,
+            status="completed",
+        )
+        details = models.HitGroupDetails.objects.create(
+            title="test", description="test", reward="1.00"
+        )
+        hit_group = models.HitGroup.objects.create(
+            battery=battery, details=details, number_of_assignments=9
+        )
+        models.HitGroupHits.objects.create(hit_group=hit_group, hit_id="h1")
+        user = get_user_model().objects.create(username="reviewer")
+        operation = models.MturkApiOperation.objects.create(
+            user=user, battery=battery, options={"reject_incomplete": True}
+        )
+
+        self.stubber.add_response(
+            "list_assignments_for_hit",
+            {
+                "Assignments": [
+                    {"AssignmentId": f"a{i}", "WorkerId": f"w{i}", "HITId": "h1"}
+                    for i in range(1, 6)
+                ]
+            },
+            {"HITId": "h1", "MaxResults": 100, "AssignmentStatuses": ["Submitted"]},
+        )
+        self.stubber.add_response("approve_assignment", {}, {"AssignmentId": "a1"})
+        self.stubber.add_response("approve_assignment", {}, {"AssignmentId": "a4"})
+        self.stubber.add_response(
+            "reject_assignment",
+            {},
+            {"AssignmentId": "a2", "RequesterFeedback": review.default_rejection_feedback},
+        )
+        self.stubber.add_client_error("reject_assignment", "RequestError")
+        review.run_review(operation, client=self.wrapper)
+        self.stubber.assert_no_pending_responses()
+
+        operation.refresh_from_db()
+        self.assertEqual(operation.status, "completed")
+        self.assertEqual((operation.total, operation.succeeded, operation.failed), (4, 3, 1))
+        self.assertEqual(operation.errors[0]["assignment_id"], "a3")
+        self.assertEqual(operation.report["unmatched"], ["w5"])
+
+
+class PaymentTests(StubbedClientTestCase):
+    def setUp(self):
+        super().setUp()
+        self.battery = make_battery(2)
+        batt_exps = list(self.battery.batteryexperiments_set.order_by("order"))
+        self.subjects = {}
+        # w1 finished both experiments, w2 one of them, w3 has no mturk assignment
+        for handle, finished in [("w1", batt_exps), ("w2", batt_exps[:1]), ("w3", batt_exps)]:
+            subject = Subject.objects.create(handle=handle)
+            self.subjects[handle] = subject
+            for batt_exp in finished:
+                Result.objects.create(
+                    battery_experiment=batt_exp, subject=subject, status="completed"
+                )
+        details = models.HitGroupDetails.objects.create(
+            title="test", description="test", reward="1.00"
+        )
+        hit_group = models.HitGroup.objects.create(
+            battery=self.battery, details=details, number_of_assignments=9
+        )
+        models.HitGroupHits.objects.create(hit_group=hit_group, hit_id="h1")
+        self.user = get_user_model().objects.create(username="payer")
+
+    def stub_assignments(self):
+        self.stubber.add_response(
+            "list_assignments_for_hit",
+            {
+                "Assignments": [
+                    {"AssignmentId": "a1", "WorkerId": "w1", "HITId": "h1", "AssignmentStatus": "Approved"},
+                    {"AssignmentId": "a2", "WorkerId": "w2", "HITId": "h1", "AssignmentStatus": "Submitted"},
+                ]
+            },
+            {"HITId": "h1", "MaxResults": 100, "AssignmentStatuses": ["Approved", "Submitted"]},
+        )
+
+    def test_owed_bonuses(self):
+        owed = payments.owed_bonuses(self.battery.id, "0.50", "1.00")
+        self.assertEqual(owed[self.subjects["w1"].id][1], Decimal("2.00"))
+        self.assertEqual(owed[self.subjects["w2"].id][1], Decimal("0.50"))
+
+        models.MturkPayment.objects.create(
+            battery=self.battery, subject=self.subjects["w1"], amount="2.00"
+        )
+        owed = payments.owed_bonuses(self.battery.id, "0.50", "1.00")
+        self.assertNotIn(self.subjects["w1"].id, owed)
+
+    def test_run_payments_then_reconcile(self):
+        operation = models.MturkApiOperation.objects.create(
+            user=self.user,
+            battery=self.battery,
+            operation="bonus",
+            options={"bonus_per_experiment": "0.50", "completion_bonus": "1.00"},
+        )
+        self.stub_assignments()
+        w1_token = payments.bonus_token(self.battery.id, self.subjects["w1"].id, 0, operation.id)
+        self.stubber.add_response(
+            "send_bonus",
+            {},
+            {
+                "WorkerId": "w1",
+                "BonusAmount": "2.00",
+                "AssignmentId": "a1",
+                "Reason": payments.default_reason,
+                "UniqueRequestToken": w1_token,
+            },
+        )
+        self.stubber.add_client_error("send_bonus", "RequestError")
+        payments.run_payments(operation, client=self.wrapper)
+        self.stubber.assert_no_pending_responses()
+
+        operation.refresh_from_db()
+        self.assertEqual((operation.total, operation.succeeded, operation.failed), (2, 1, 1))
+        self.assertEqual(operation.report["unmatched"], ["w3"])
+        # w2's refused bonus isn't recorded, it is still owed
+        payment = models.MturkPayment.objects.get()
+        self.assertEqual(payment.unique_request_token, w1_token)
+        self.assertEqual((payment.worker_id, payment.assignment_id), ("w1", "a1"))
+        self.assertIsNotNone(payment.issued)
+        self.assertIn(self.subjects["w2"].id, payments.owed_bonuses(self.battery.id, "0.50", "1.00"))
+
+        self.stubber.add_response(
+            "list_bonus_payments",
+            {
+                "BonusPayments": [
+                    {"WorkerId": "w1", "AssignmentId": "a1", "BonusAmount": "2.00"},
+                    {"WorkerId": "w2", "AssignmentId": "a2", "BonusAmount": "0.50"},
+                ]
+            },
+            {"HITId": "h1", "MaxResults": 100},
+        )
+        report = payments.reconcile_payments(self.wrapper, self.battery.id)
+        self.assertEqual(report["matched"], 1)
+        self.assertEqual(report["missing_on_mturk"], [])
+        self.assertEqual(
+            report["unrecorded"],
+            [{"worker_id": "w2", "assignment_id": "a2", "amount": "0.50"}],
+        )
+
+    def test_pending_payments_are_confirmed_or_resent(self):
+        def pending(handle, amount, assignment_id, token):
+            return models.MturkPayment.objects.create(
+                battery=self.battery, subject=self.subjects[handle], amount=amount,
+                note="n", worker_id=handle, assignment_id=assignment_id, unique_request_token=token,
+            )
+
+        # an earlier run wrote both rows but didn't hear back from mturk
+        w1 = pending("w1", "2.00", "a1", "t1")
+        w2 = pending("w2", "0.50", "a2", "t2")
+        operation = models.MturkApiOperation.objects.create(
+            user=self.user,
+            battery=self.battery,
+            operation="bonus",
+            options={"bonus_per_experiment": "0.50", "completion_bonus": "1.00"},
+        )
+        send_w2 = {
+            "WorkerId": "w2", "BonusAmount": "0.50", "AssignmentId": "a2",
+            "Reason": "n", "UniqueRequestToken": "t2",
+        }
+
+        def stub_run(send_error):
+            self.stubber.add_response(
+                "list_bonus_payments",
+                {"BonusPayments": [{"WorkerId": "w1", "AssignmentId": "a1", "BonusAmount": "2.00"}]},
+                {"HITId": "h1", "MaxResults": 100},
+            )
+            self.stub_assignments()
+            self.stubber.add_client_error("send_bonus", **send_error, expected_params=send_w2)
+
+        # mturk paid w1, w2's retry faults on every attempt and stays pending
+        stub_run({"service_error_code": "ServiceFault"})
+        self.stubber.add_client_error("send_bonus", "ServiceFault", expected_params=send_w2)
+        self.stubber.add_client_error("send_bonus", "ServiceFault", expected_params=send_w2)
+        payments.run_payments(operation, client=self.wrapper)
+        self.stubber.assert_no_pending_responses()
+        w1.refresh_from_db()
+        w2.refresh_from_db()
+        self.assertIsNotNone(w1.issued)
+        self.assertIsNone(w2.issued)
+        self.assertEqual(operation.report["pending"], 1)
+
+        # the next run finds the token used, so the first send went through
+        stub_run(
+            {
+                "service_error_code": "RequestError",
+                "modeled_fields": {"TurkErrorCode": "AWS.MechanicalTurk.DuplicateRequest"},
+            }
+        )
+        payments.run_payments(operation, client=self.wrapper)
+        self.stubber.assert_no_pending_responses()
+        w2.refresh_from_db()
+        self.assertIsNotNone(w2.issued)
+        self.assertEqual(models.MturkPayment.objects.count(), 2)
@@ -0,0 +1,153 @@
+from datetime import datetime, timedelta
+from unittest import mock
+
+import boto3
+from botocore.stub import Stubber
+from dateutil.tz import tzutc
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+
+from experiments.tests.factories import make_battery
+from mturk import boto_utils, models, tasks
+
+now = datetime(2024, 1, 1, tzinfo=tzutc())
+
+
+def hit_response(hit_id, url, pending=0, available=9, completed=0):
+    return {
+        "HITId": hit_id,
+        "HITTypeId": "type",
+        "Title": "test hit",
+        "Question": boto_utils.generate_question_xml(url),
+        "RequesterAnnotation": "annotation",
+        "HITStatus": "Assignable",
+        "MaxAssignments": 9,
+        "NumberOfAssignmentsPending": pending,
+        "NumberOfAssignmentsAvailable": available,
+        "NumberOfAssignmentsCompleted": completed,
+        "CreationTime": now,
+        "Expiration": now + timedelta(days=1),
+    }
+
+
+def assignment_response(assignment_id, hit_id, status="Submitted"):
+    return {
+        "AssignmentId": assignment_id,
+        "WorkerId": f"worker-{assignment_id}",
+        "HITId": hit_id,
+        "AssignmentStatus": status,
+        "AcceptTime": now,
+        "SubmitTime": now,
+    }
+
+
+class SyncHitsTests(TestCase):
+    url = "https://example.com/serve/12/"
+
+    def setUp(self):
+        client = boto3.client(
+            "mturk",
+            region_name="us-east-1",
+            aws_access_key_id="test",
+            aws_secret_access_key="test",
+        )
+        self.stubber = Stubber(client)
+        self.stubber.activate()
+        self.wrapper = boto_utils.BotoWrapper(client=client, rate_limit=0)
+
+    def tearDown(self):
+        self.stubber.deactivate()
+
+    def stub_hits(self, *hits):
+        self.stubber.add_response("list_hits", {"HITs": list(hits)}, {"MaxResults": 100})
+
+    def stub_assignments(self, hit_id, *assignments):
+        self.stubber.add_response(
+            "list_assignments_for_hit",
+            {"Assignments": list(assignments)},
+            {"HITId": hit_id, "MaxResults": 100},
+        )
+
+    def test_creates_mirror_rows(self):
+        self.stub_hits(
+            hit_response("a", self.url, available=8, completed=1),
+            hit_response("b", self.url),
+        )
+        self.stub_assignments("a", assignment_response("a1", "a"))
+        report = tasks.sync_hits(self.wrapper)
+        self.stubber.assert_no_pending_responses()
+
+        self.assertEqual(report["created"], 2)
+        self.assertEqual(report["assignments"], 1)
+        hit = models.MturkHit.objects.get(hit_id="a")
+        self.assertEqual(hit.url, self.url)
+        self.assertEqual(hit.battery_id, 12)
+        self.assertEqual(boto_utils.battery_id_from_url(self.url), 12)
+        self.assertEqual(hit.annotation, "annotation")
+        self.assertEqual(hit.assignments.get().worker_id, "worker-a1")
+
+    def test_only_changed_hits_are_refreshed(self):
+        self.stub_hits(hit_response("a", self.url), hit_response("b", self.url))
+        tasks.sync_hits(self.wrapper)
+
+        self.stub_hits(hit_response("a", self.url), hit_response("b", self.url, available=8))
+        self.stub_assignments("b", assignment_response("b1", "b"))
+        report = tasks.sync_hits(self.wrapper)
+        self.stubber.assert_no_pending_responses()
+        self.assertEqual(
+            report, {"created": 0, "updated": 1, "removed": 0, "conflicts": 0, "assignments": 1}
+        )
+
+        self.stub_hits(
+            hit_response("b", self.url, available=8, completed=1),
+        )
+        self.stub_assignments("b", assignment_response("b1", "b", status="Approved"))
+        report = tasks.sync_hits(self.wrapper)
+        self.assertEqual(report["removed"], 1)
+        self.assertFalse(models.MturkHit.objects.filter(hit_id="a").exists())
+        self.assertEqual(
+            models.MturkAssignment.objects.get(assignment_id="b1").status, "Approved"
+        )
+
+    def test_mirrors_are_kept_per_account(self):
+        credentials = models.MturkCredentials.objects.create(
+            user=get_user_model().objects.create(username="requester"),
+            name="lab",
+            file_name="/nonexistent/credentials",
+        )
+        self.stub_hits(hit_response("a", self.url))
+        tasks.sync_hits(self.wrapper, sandbox=False, credentials=credentials)
+        # the default account's sync leaves the lab's HITs alone
+        self.stub_hits(hit_response("b", self.url))
+        tasks.sync_hits(self.wrapper, sandbox=False)
+        self.assertEqual(
+            dict(models.MturkHit.objects.values_list("hit_id", "credentials")),
+            {"a": credentials.id, "b": None},
+        )
+        # the same keys configured as the default see the lab's HIT too
+        self.stub_hits(hit_response("a", self.url, available=8), hit_response("b", self.url))
+        report = tasks.sync_hits(self.wrapper, sandbox=False)
+        self.stubber.assert_no_pending_responses()
+        self.assertEqual((report["created"], report["conflicts"]), (0, 1))
+        self.assertEqual(models.MturkHit.objects.get(hit_id="a").credentials, credentials)
+
+        details = models.HitGroupDetails.objects.create(title="t", description="d", reward="1.00")
+        models.HitGroup.objects.create(
+            battery=make_battery(1), details=details, credentials=credentials,
+            sandbox=False, number_of_assignments=9, published=now,
+        )
+        self.assertEqual(tasks.mturk_accounts(), {(None, True), (credentials, False)})
+
+        # an account with missing credentials is reported, the rest still sync
+        BotoWrapper = boto_utils.BotoWrapper
+        self.stub_hits()
+        with mock.patch.object(
+            boto_utils,
+            "BotoWrapper",
+            side_effect=lambda credentials, sandbox: BotoWrapper(credentials, sandbox)
+            if credentials
+            else self.wrapper,
+        ):
+            report = tasks.sync_mturk_hits()
+        self.assertIn("error", report["lab production"])
+        self.assertEqual(report["default sandbox"]["created"], 0)
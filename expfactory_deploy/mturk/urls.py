@@ -20,6 +20,21 @@ urlpatterns = [
         views.assignments_list,
         name="assignments-list",
     ),
+    path("mturk/sync", views.sync_hits, name="sync-hits"),
+    path(
+        "mturk/review/<int:battery_id>", views.review_battery, name="review-battery"
+    ),
+    path(
+        "mturk/payments/<int:battery_id>",
+        views.battery_payments,
+        name="battery-payments",
+    ),
+    path("mturk/operation/<int:pk>", views.operation_detail, name="operation-detail"),
+    path(
+        "mturk/operation/<int:pk>/status",
+        views.operation_status,
+        name="operation-status",
+    ),
     re_path(
         "mturk/expire/(?P<hit_id>.+)",
         views.expire_hit,
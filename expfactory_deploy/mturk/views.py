@@ -1,7 +1,10 @@
-import re
+from collections import defaultdict
 
+from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
+from django.db import transaction
+from django.db.models import Count, Max, Min, Sum
 from django.shortcuts import get_object_or_404, render, redirect
 from django.urls import reverse, reverse_lazy
 from django.urls.exceptions import NoReverseMatch
@@ -11,20 +14,10 @@ from django.views.generic import TemplateView
 from mturk import forms as forms
 from mturk import boto_utils
 from mturk import models as models
+from mturk import tasks
 from experiments.models import Battery, Subject
 
 
-def battery_id_from_url(url):
-    pattern = "/serve/(\d+)/"
-    match = re.search(pattern, url)
-    if match is None:
-        return None
-    try:
-        return match.group(1)
-    except IndexError:
-        return None
-
-
 class HitGroupCreateUpdate(LoginRequiredMixin, TemplateView):
     template_name = "mturk/hitgroup_form.html"
     hit_group = None
@@ -85,7 +78,12 @@ class HitGroupCreateUpdate(LoginRequiredMixin, TemplateView):
             # Actually make mturk calls
             # I mean should really go in models
             # return redirect("mturk:hitgroup-detail", pk=hit_group.pk)
-            hit_group.publish()
+            failed = hit_group.publish()
+            if failed:
+                messages.error(
+                    request,
+                    f"{len(failed)} HIT batches could not be created: {failed[0][1]}",
+                )
             return redirect("mturk:summaries-list")
         else:
             context = self.get_context_data(**kwargs)
@@ -94,78 +92,166 @@ class HitGroupCreateUpdate(LoginRequiredMixin, TemplateView):
             return self.render_to_response(context)
 
 
+def battery_detail_url(battery_id):
+    try:
+        return reverse("experiments:battery-detail", args=[battery_id])
+    except NoReverseMatch:
+        return None
+
+
 @login_required
 def hits_list(request, url=None):
-    client = boto_utils.BotoWrapper()
-    hits_by_url = client.get_hits(url)
+    hits = models.MturkHit.objects.exclude(url="").order_by("url", "created")
+    if url:
+        hits = hits.filter(url=url)
+    hits_by_url = defaultdict(list)
     battery_urls = {}
-    for key in hits_by_url.keys():
-        bid = battery_id_from_url(key)
-        try:
-            detail_url = reverse("experiments:battery-detail", args=[bid])
-        except NoReverseMatch:
-            detail_url = None
-        battery_urls[key] = detail_url
+    for hit in hits:
+        hits_by_url[hit.url].append(hit)
+        battery_urls[hit.url] = battery_detail_url(hit.battery_id)
     all = False if url else True
     context = {
         "hits_by_url": dict(hits_by_url),
         "battery_urls": battery_urls,
         "all": all,
+        "url": url,
+        "last_synced": models.MturkHit.objects.aggregate(Max("synced"))["synced__max"],
     }
     return render(request, "mturk/list_hits.html", context)
 
 
 @login_required
 def summaries_list(request):
-    client = boto_utils.BotoWrapper()
-    hits = client.get_hits()
-    summaries = []
-    for key in hits.keys():
-        bid = battery_id_from_url(key)
-        try:
-            detail_url = reverse("experiments:battery-detail", args=[bid])
-        except NoReverseMatch:
-            detail_url = None
-        summary = {
-            "url": key,
-            "detail_url": detail_url,
-            "pending": 0,
-            "available": 0,
-            "complete": 0,
-            "total": 0,
-            "earliest_expiration": None,
-            "completed": 0,
-            "total_hits": len(hits[key]),
-        }
-        for hit in hits[key]:
-            summary["available"] += hit["NumberOfAssignmentsAvailable"]
-            summary["complete"] += hit["NumberOfAssignmentsCompleted"]
-            summary["pending"] += hit["NumberOfAssignmentsPending"]
-            summary["total"] += hit["MaxAssignments"]
-            if (
-                summary["earliest_expiration"] is None
-                or hit["Expiration"] < summary["earliest_expiration"]
-            ):
-                summary["earliest_expiration"] = hit["Expiration"]
-        summaries.append(summary)
-
-    context = {"summaries": summaries}
+    summaries = (
+        models.MturkHit.objects.exclude(url="")
+        .values("url", "battery_id")
+        .annotate(
+            pending=Sum("assignments_pending"),
+            available=Sum("assignments_available"),
+            complete=Sum("assignments_completed"),
+            total=Sum("max_assignments"),
+            earliest_expiration=Min("expiration"),
+            total_hits=Count("id"),
+        )
+        .order_by("url")
+    )
+    for summary in summaries:
+        summary["detail_url"] = battery_detail_url(summary["battery_id"])
+
+    context = {
+        "summaries": summaries,
+        "last_synced": models.MturkHit.objects.aggregate(Max("synced"))["synced__max"],
+    }
     return render(request, "mturk/summaries.html", context)
 
 
 @login_required
 def assignments_list(request, url):
-    client = boto_utils.BotoWrapper()
-    assignments = client.list_assignments(url)
-    bid = battery_id_from_url(url)
-    context = {assignments: assignments, bid: bid}
+    assignments = (
+        models.MturkAssignment.objects.filter(hit__url=url)
+        .select_related("hit")
+        .order_by("submitted")
+    )
+    bid = boto_utils.battery_id_from_url(url)
+    context = {"assignments": assignments, "bid": bid, "url": url}
     return render(request, "mturk/assignments_list.html", context)
 
 
+@login_required
+def sync_hits(request):
+    if request.method == "POST":
+        transaction.on_commit(lambda: tasks.sync_mturk_hits.delay())
+        messages.info(request, "Refreshing hits from mturk in the background")
+    return redirect("mturk:summaries-list")
+
+
+def queue_operation(request, battery, operation, options):
+    """Create an MturkApiOperation for battery using the credentials and
+    endpoint of its latest HitGroup, and run it once the request commits."""
+    hit_group = models.HitGroup.objects.filter(battery=battery).order_by("-id").first()
+    operation = models.MturkApiOperation.objects.create(
+        operation=operation,
+        user=request.user,
+        battery=battery,
+        credentials=hit_group.credentials if hit_group else None,
+        sandbox=hit_group.sandbox if hit_group else True,
+        options=options,
+    )
+    transaction.on_commit(lambda: tasks.run_api_operation.delay(operation.id))
+    return redirect("mturk:operation-detail", pk=operation.id)
+
+
+@login_required
+def review_battery(request, battery_id):
+    """Queue a bulk approve/reject of the battery's submitted assignments."""
+    battery = get_object_or_404(Battery, pk=battery_id)
+    if request.method != "POST":
+        return redirect("mturk:summaries-list")
+    return queue_operation(
+        request,
+        battery,
+        models.MturkApiOperation.OPERATION.review,
+        {
+            "reject_incomplete": bool(request.POST.get("reject_incomplete")),
+            "feedback": request.POST.get("feedback", ""),
+        },
+    )
+
+
+@login_required
+def battery_payments(request, battery_id):
+    """Bonus form for a battery, and a button to reconcile recorded
+    payments against mturk."""
+    battery = get_object_or_404(Battery, pk=battery_id)
+    Operation = models.MturkApiOperation
+    form = forms.BonusForm(request.POST or None)
+    if request.method == "POST" and "reconcile" in request.POST:
+        return queue_operation(request, battery, Operation.OPERATION.reconcile, {})
+    if request.method == "POST" and form.is_valid():
+        return queue_operation(
+            request,
+            battery,
+            Operation.OPERATION.bonus,
+            {
+                "bonus_per_experiment": str(form.cleaned_data["bonus_per_experiment"]),
+                "completion_bonus": str(form.cleaned_data["completion_bonus"]),
+                "reason": form.cleaned_data["reason"],
+            },
+        )
+    context = {
+        "battery": battery,
+        "form": form,
+        "payments": models.MturkPayment.objects.filter(battery=battery).aggregate(
+            count=Count("id"), total=Sum("amount")
+        ),
+        "operations": Operation.objects.filter(
+            battery=battery,
+            operation__in=[Operation.OPERATION.bonus, Operation.OPERATION.reconcile],
+        ).order_by("-created")[:10],
+    }
+    return render(request, "mturk/battery_payments.html", context)
+
+
+@login_required
+def operation_detail(request, pk):
+    operation = get_object_or_404(models.MturkApiOperation, pk=pk)
+    return render(request, "mturk/operation_detail.html", {"operation": operation})
+
+
+@login_required
+def operation_status(request, pk):
+    operation = get_object_or_404(models.MturkApiOperation, pk=pk)
+    return render(request, "mturk/operation_status.html", {"operation": operation})
+
+
 # should we delete the hit?
 @login_required
 def expire_hit(request, hit_id):
-    client = boto_utils.BotoWrapper()
+    hit = models.MturkHit.objects.filter(hit_id=hit_id).select_related("credentials").first()
+    client = boto_utils.BotoWrapper(
+        hit.credentials if hit else None, hit.sandbox if hit else True
+    )
     client.expire_hits_by_id([hit_id])
-    client.delete_hits_by_id([hit_id])
+    if not client.delete_hits_by_id([hit_id]):
+        models.MturkHit.objects.filter(hit_id=hit_id).delete()
     return redirect("mturk:hits-list")